@@ -0,0 +1,284 @@
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+from src.domain.codec.dct import ENGINES, DEFAULT_ENGINE
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.encoder import JPEGEncoder, get_source_planes
+from src.domain.codec.quantization import Quantizer
+from src.domain.models.Image import Image, PixelType, DCTImage, QuantizationImage
+from src.util.netpbm import write_netpbm
+from src.util.synthetic import PATTERNS, generate
+
+DEFAULT_SIZES = ("128x96", "512x384")
+STORAGES = ("planar", "objects")
+
+# Stages of one run, in order. jpeg_encode / jpeg_decode / jpeg_thumbnail are the stripe encoder and the streaming
+# decoder (at full and 1/8 size), the others the block pipeline of src/main.py; thumbnail decodes its blocks at 1/8.
+STAGES = ("load", "jpeg_encode", "jpeg_decode", "jpeg_thumbnail", "convert_color_space", "split_into_blocks", "dct",
+          "quantize", "entropy_encode", "entropy_decode", "thumbnail", "dequantize", "idct", "construct_from_blocks",
+          "convert_color_space_back", "save")
+
+# Stages faster than this are left out of regression checks, their timings are mostly noise
+MIN_COMPARED_SECONDS = 0.005
+
+
+class StageTimer:
+    """
+    Records the duration of every stage of a run and, when memory is traced (tracemalloc), the peak of the memory
+    allocated during the stage on top of what was allocated when it started.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peak_bytes = {}
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        self.seconds[name] = time.perf_counter() - start
+        if self.trace_memory:
+            self.peak_bytes[name] = tracemalloc.get_traced_memory()[1] - allocated
+
+
+# <editor-fold desc="Corpus">
+def get_size(value):
+    try:
+        width, height = (int(side) for side in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("size must be WIDTHxHEIGHT, got {0}".format(value))
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("size must be positive, got {0}".format(value))
+    return width, height
+
+
+def generate_corpus(directory, patterns, sizes, seed=0):
+    """
+    Writes every pattern at every size as a binary PPM, keeping files that already exist (they are deterministic).
+    :return: list of (path, pattern, width, height)
+    """
+    os.makedirs(directory, exist_ok=True)
+    corpus = []
+    for pattern in patterns:
+        for width, height in sizes:
+            path = os.path.join(directory, "{0}_{1}x{2}_{3}.ppm".format(pattern, width, height, seed))
+            if not os.path.isfile(path):
+                write_netpbm(path, b"P6", generate(pattern, width, height, seed), description="# " + pattern)
+            corpus.append((path, pattern, width, height))
+    return corpus
+
+
+# </editor-fold>
+
+# <editor-fold desc="Pipeline">
+def psnr(original, decoded):
+    """
+    :return: Peak signal to noise ratio in dB of two uint8 arrays, None if they are identical
+    """
+    error = np.mean((original.astype(np.float64) - decoded.astype(np.float64)) ** 2)
+    return float(10 * np.log10(255 ** 2 / error)) if error else None
+
+
+def run_pipeline(filename, timer, planar, engine, quality, directory):
+    """
+    Runs every stage once on an image.
+    :param timer: StageTimer the stages are recorded with
+    :param directory: Directory the decoded image is saved to
+    :return: dict with the quality figures of the run
+    """
+    with timer.stage("load"):
+        image = Image.load(filename, planar=planar)
+    original = np.array(get_source_planes(image))
+
+    with timer.stage("jpeg_encode"):
+        data = JPEGEncoder(engine=engine, quality=quality).encode(image)
+    with timer.stage("jpeg_decode"):
+        decoded = JPEGDecoder(io.BytesIO(data), engine).decode()
+    with timer.stage("jpeg_thumbnail"):
+        JPEGDecoder(io.BytesIO(data), engine, scale_denominator=8).decode()
+
+    with timer.stage("convert_color_space"):
+        image.convert_color_space(PixelType.YUV)
+    with timer.stage("split_into_blocks"):
+        y_blocks, u_blocks, v_blocks = image.split_into_blocks()
+    with timer.stage("dct"):
+        dct_image = DCTImage(y_blocks, u_blocks, v_blocks, engine=engine, blocks_per_line=image.blocks_per_line)
+    with timer.stage("quantize"):
+        quantization_image = QuantizationImage(dct_image, Quantizer(quality))
+    with timer.stage("entropy_encode"):
+        quantization_image.entropy_encoding()
+    with timer.stage("entropy_decode"):
+        quantization_image.entropy_decoding()
+    with timer.stage("thumbnail"):
+        quantization_image.decode_scaled(image.width, image.height, 8, planar=planar)
+    with timer.stage("dequantize"):
+        quantization_image.dequantize()
+    with timer.stage("idct"):
+        blocks = DCTImage.inverse_dct(quantization_image, engine)
+    with timer.stage("construct_from_blocks"):
+        new_image = Image.construct_from_blocks(blocks, image.width, image.height, planar=planar)
+    with timer.stage("convert_color_space_back"):
+        new_image.convert_color_space(PixelType.RGB)
+    with timer.stage("save"):
+        new_image.save(os.path.join(directory, "decoded"))
+
+    return {
+        "psnr": psnr(original, get_source_planes(new_image)),
+        "jpeg_psnr": psnr(original, decoded),
+        "jpeg_bytes": len(data),
+    }
+
+
+def benchmark_image(filename, planar, engine, quality, repeat, trace_memory, directory):
+    """
+    Runs the pipeline repeat times, keeping the fastest time of every stage, then once more with memory traced
+    (tracemalloc slows allocations down, so it never runs while timing).
+    :return: dict with the timings, peak memory and quality figures of the image
+    """
+    timers = []
+    for _ in range(0, max(1, repeat)):
+        timers.append(StageTimer())
+        figures = run_pipeline(filename, timers[-1], planar, engine, quality, directory)
+
+    memory = StageTimer(trace_memory=True) if trace_memory else None
+    if memory is not None:
+        tracemalloc.start()
+        try:
+            run_pipeline(filename, memory, planar, engine, quality, directory)
+        finally:
+            tracemalloc.stop()
+
+    stages = {}
+    for name in STAGES:
+        seconds = min(timer.seconds[name] for timer in timers)
+        stages[name] = {"seconds": seconds, "peak_bytes": memory.peak_bytes[name] if memory is not None else None}
+    figures["stages"] = stages
+    figures["seconds"] = sum(stage["seconds"] for stage in stages.values())
+    figures["peak_bytes"] = max(stage["peak_bytes"] for stage in stages.values()) if memory is not None else None
+    return figures
+
+
+def run_benchmark(corpus, storages, engine, quality, repeat, trace_memory):
+    """
+    :return: list with the figures of every image of the corpus, for every storage mode
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for path, pattern, width, height in corpus:
+            for storage in storages:
+                figures = benchmark_image(path, storage == "planar", engine, quality, repeat, trace_memory, directory)
+                megapixels = width * height / 1e6
+                for stage in figures["stages"].values():
+                    stage["megapixels_per_second"] = megapixels / stage["seconds"] if stage["seconds"] else None
+                result = {"image": os.path.splitext(os.path.basename(path))[0], "pattern": pattern, "width": width,
+                          "height": height, "storage": storage, "megapixels": megapixels,
+                          "megapixels_per_second": megapixels / figures["seconds"]}
+                result.update(figures)
+                results.append(result)
+    return results
+
+
+# </editor-fold>
+
+# <editor-fold desc="Report">
+def compare(results, baseline, threshold):
+    """
+    Compares the stage timings of two runs, matching images by name and storage.
+    :param threshold: Relative slowdown reported as a regression, e.g. 0.2 for 20 %
+    :return: list of (image, storage, stage, baseline seconds, seconds) of the regressions
+    """
+    previous = {(result["image"], result["storage"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["image"], result["storage"]))
+        if old is None:
+            continue
+        for name, stage in result["stages"].items():
+            old_stage = old["stages"].get(name)
+            if old_stage is None or max(stage["seconds"], old_stage["seconds"]) < MIN_COMPARED_SECONDS:
+                continue
+            if stage["seconds"] > old_stage["seconds"] * (1 + threshold):
+                regressions.append((result["image"], result["storage"], name, old_stage["seconds"],
+                                    stage["seconds"]))
+    return regressions
+
+
+def format_result(result):
+    stages = ", ".join("{0} {1:.3f}".format(name, stage["seconds"]) for name, stage in result["stages"].items())
+    peak = "{0:.1f} MB".format(result["peak_bytes"] / 2 ** 20) if result["peak_bytes"] is not None else "-"
+    return "{image} ({storage}): {seconds:.3f} s, {megapixels_per_second:.2f} MP/s, peak {0}, PSNR {1}, JPEG PSNR " \
+           "{2}\n  {3}".format(peak, _format_psnr(result["psnr"]), _format_psnr(result["jpeg_psnr"]), stages,
+                               **result)
+
+
+def _format_psnr(value):
+    return "inf" if value is None else "{0:.2f} dB".format(value)
+
+
+# </editor-fold>
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m src.benchmark",
+                                     description="Times every stage of the codec on a synthetic image corpus")
+    parser.add_argument("--sizes", nargs="+", type=get_size, default=[get_size(size) for size in DEFAULT_SIZES],
+                        metavar="WxH", help="image sizes")
+    parser.add_argument("--patterns", nargs="+", choices=PATTERNS, default=list(PATTERNS), help="image contents")
+    parser.add_argument("--storage", nargs="+", choices=STORAGES, default=list(STORAGES),
+                        help="pixel storage of the loaded images")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random patterns")
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "jpeg-benchmark-corpus"),
+                        help="directory the generated images are kept in")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default=DEFAULT_ENGINE, help="DCT engine")
+    parser.add_argument("-q", "--quality", type=int, default=75, help="IJG quality")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per image, the fastest time is kept")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run measuring peak memory")
+    parser.add_argument("-o", "--output", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare the timings with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown of a stage reported as a regression")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    corpus = generate_corpus(args.corpus, args.patterns, args.sizes, args.seed)
+    results = run_benchmark(corpus, args.storage, args.engine, args.quality, args.repeat, not args.no_memory)
+    for result in results:
+        print(format_result(result))
+
+    report = {
+        "settings": {"engine": args.engine, "quality": args.quality, "repeat": args.repeat, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for image, storage, stage, old_seconds, seconds in regressions:
+            print("regression: {0} ({1}) {2}: {3:.3f} s -> {4:.3f} s".format(image, storage, stage, old_seconds,
+                                                                           seconds), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
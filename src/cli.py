@@ -0,0 +1,436 @@
+import argparse
+import glob
+import io
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.domain.codec.dct import ENGINES, DEFAULT_ENGINE, SCALE_DENOMINATORS
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.encoder import JPEGEncoder, DEFAULT_STRIPE_ROWS, DEFAULT_MAX_STRIPES, POOLS, DEFAULT_POOL
+from src.domain.codec.lossless import TRANSFORMS, transform_jpeg
+from src.domain.codec.progressive import parse_scan_script
+from src.domain.exceptions.BadImageException import BadImageException
+from src.domain.exceptions.FormatNotSupportedException import FormatNotSupportedException
+from src.domain.exceptions.PixelFormatException import PixelFormatException
+from src.domain.models.Image import Image, PixelType
+from src.util.cache import DEFAULT_MAX_BYTES, get_cache, make_key
+from src.util.instrumentation import Instrumentation
+from src.util.subsampling import SUBSAMPLING_MODES, DEFAULT_SUBSAMPLING, FILTERS, DEFAULT_FILTER
+
+NETPBM_EXTENSIONS = (".ppm", ".pgm", ".pnm")
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+# Extensions picked up when walking directories, per command
+INPUT_EXTENSIONS = {
+    "encode": NETPBM_EXTENSIONS,
+    "decode": JPEG_EXTENSIONS,
+    "roundtrip": NETPBM_EXTENSIONS,
+    "transform": JPEG_EXTENSIONS,
+}
+
+# Outputs of the commands that are not plain encodes / decodes, left out of directory walks and glob patterns so that
+# a second run over the same directory does not process the outputs of the first one
+GENERATED_SUFFIXES = (".roundtrip.ppm", ".roundtrip.pgm", ".roundtrip.jpg", ".transformed.jpg")
+
+# Settings the outputs of every command depend on; the others (workers, trace, cache...) do not change the files
+OUTPUT_SETTINGS = {
+    "encode": ("engine", "optimize_huffman", "stripe_rows", "quality", "subsampling", "chroma_filter", "progressive",
+               "scan_script", "restart_index"),
+    "decode": ("scale_denominator", "region"),
+    "transform": ("transform", "region", "optimize_huffman"),
+}
+OUTPUT_SETTINGS["roundtrip"] = OUTPUT_SETTINGS["encode"] + OUTPUT_SETTINGS["decode"]
+
+# Hidden file of every output directory with the settings key of the outputs written there
+SETTINGS_FILE = ".outputs.json"
+
+
+class Job:
+    def __init__(self, command, source, target, settings):
+        self.command = command
+        self.source = source
+        self.target = target
+        self.settings = settings
+
+
+class JobResult:
+    def __init__(self, job, bytes_in=0, bytes_out=0, pixels=0, seconds=0.0, skipped=False, error=None, events=()):
+        self.job = job
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.pixels = pixels
+        self.seconds = seconds
+        self.skipped = skipped
+        self.error = error
+        # Instrumentation events of the job, only recorded with --trace / --log
+        self.events = events
+
+
+# <editor-fold desc="Job discovery">
+def find_inputs(patterns, extensions):
+    """
+    Expands files, glob patterns and directories (walked recursively) into input files. Outputs of the roundtrip and
+    transform commands (GENERATED_SUFFIXES) are only taken when named explicitly.
+    :return: list of (path, root) where root is the directory the path was found under, None for plain files
+    """
+    inputs = []
+    for pattern in patterns:
+        matched = glob.has_magic(pattern)
+        paths = sorted(glob.glob(pattern, recursive=True)) if matched else [pattern]
+        for path in paths:
+            if os.path.isdir(path):
+                for directory, _, files in sorted(os.walk(path)):
+                    for name in sorted(files):
+                        if name.lower().endswith(extensions) and not is_generated(name):
+                            inputs.append((os.path.join(directory, name), path))
+            elif not (matched and is_generated(path)):
+                inputs.append((path, None))
+    return inputs
+
+
+def is_generated(path):
+    return path.lower().endswith(GENERATED_SUFFIXES)
+
+
+def get_target(command, source, root, output):
+    """
+    :param output: Output directory, None to write next to the input. Inputs found under a directory keep their
+    path relative to it.
+    """
+    base, _ = os.path.splitext(source)
+    if output is not None:
+        relative = os.path.relpath(base, root) if root is not None else os.path.basename(base)
+        base = os.path.join(output, relative)
+
+    if command == "encode":
+        return base + ".jpg"
+    if command == "decode":
+        return base + ".ppm"
+    if command == "transform":
+        return base + ".transformed.jpg"
+    return base + ".roundtrip.ppm"
+
+
+def is_up_to_date(source, target):
+    return os.path.isfile(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+
+def get_settings_key(command, settings):
+    """
+    :return: Key of the settings the output of a command depends on
+    """
+    return make_key(command, tuple((name, settings[name]) for name in OUTPUT_SETTINGS[command]))
+
+
+def read_settings_keys(directory):
+    """
+    :return: dict of the settings key of every output written in the directory, by file name
+    """
+    try:
+        with open(os.path.join(directory or ".", SETTINGS_FILE)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_settings_keys(results, key):
+    """
+    Records the settings key of the outputs of the completed jobs, in the SETTINGS_FILE of their directory.
+    """
+    written = {}
+    for result in results:
+        if not result.skipped and result.error is None:
+            directory, name = os.path.split(result.job.target)
+            written.setdefault(directory, {})[name] = key
+    for directory, keys in written.items():
+        try:
+            recorded = read_settings_keys(directory)
+            recorded.update(keys)
+            with open(os.path.join(directory or ".", SETTINGS_FILE), "w") as file:
+                json.dump(recorded, file, indent=1, sort_keys=True)
+        except OSError as e:
+            print("{0}: {1}: {2}".format(directory, type(e).__name__, e), file=sys.stderr)
+
+
+# </editor-fold>
+
+# <editor-fold desc="Jobs">
+def run_job(job: Job):
+    """
+    Runs one job, in a worker process.
+    :return: JobResult
+    """
+    start = time.perf_counter()
+    instrumentation = Instrumentation() if job.settings["trace"] else None
+    try:
+        directory = os.path.dirname(job.target)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if job.command == "decode":
+            image = Image.load(job.source, planar=True, instrumentation=instrumentation,
+                               scale_denominator=job.settings["scale_denominator"], region=job.settings["region"])
+            if image is None:
+                raise FileNotFoundError(job.source)
+            target = os.path.splitext(job.target)[0] + (".pgm" if image.pixel_type == PixelType.GRAY else ".ppm")
+            image.save(target)
+            pixels = image.width * image.height
+        elif job.command == "transform":
+            target = job.target
+            with open(job.source, "rb") as file:
+                data = transform_jpeg(file, job.settings["transform"], job.settings["region"],
+                                      job.settings["optimize_huffman"])
+            with open(target, "wb") as file:
+                file.write(data)
+            # Only the headers are read
+            decoder = JPEGDecoder(io.BytesIO(data))
+            pixels = decoder.width * decoder.height
+        else:
+            encoder = JPEGEncoder(engine=job.settings["engine"], optimize_huffman=job.settings["optimize_huffman"],
+                                  stripe_rows=job.settings["stripe_rows"], quality=job.settings["quality"],
+                                  subsampling=job.settings["subsampling"], chroma_filter=job.settings["chroma_filter"],
+                                  progressive=job.settings["progressive"], scan_script=job.settings["scan_script"],
+                                  restart_index=job.settings["restart_index"], instrumentation=instrumentation,
+                                  cache=get_cache(*job.settings["cache"]) if job.settings["cache"] else None)
+            # Streamed a few stripes at a time, so images larger than memory can be encoded
+            target = job.target if job.command == "encode" else os.path.splitext(job.target)[0] + ".jpg"
+            width, height, _ = encoder.encode_file(job.source, target, job.settings["max_stripes"])
+            pixels = width * height
+
+            if job.command == "roundtrip":
+                decoded = Image.load(target, planar=True, instrumentation=instrumentation,
+                                     scale_denominator=job.settings["scale_denominator"],
+                                     region=job.settings["region"])
+                target = os.path.splitext(job.target)[0] + (
+                    ".pgm" if decoded.pixel_type == PixelType.GRAY else ".ppm")
+                decoded.save(target)
+
+        return JobResult(job, os.path.getsize(job.source), os.path.getsize(target), pixels,
+                         time.perf_counter() - start, events=_get_events(instrumentation))
+    # ValueError: a scan script that does not fit the components of the image, or a region outside of it (or not
+    # MCU aligned, for transform)
+    except (BadImageException, FormatNotSupportedException, PixelFormatException, OSError, ValueError) as e:
+        return JobResult(job, seconds=time.perf_counter() - start, error="{0}: {1}".format(type(e).__name__, e),
+                         events=_get_events(instrumentation))
+
+
+def _get_events(instrumentation):
+    return instrumentation.events if instrumentation is not None else ()
+
+
+def run_jobs(jobs, workers, queue_size, on_result=None, pool=DEFAULT_POOL):
+    """
+    Runs jobs over a process pool, keeping at most queue_size jobs submitted at any time.
+    :param on_result: Optional callback receiving every JobResult as it completes
+    :param pool: "process", or "thread" to run the jobs in threads of this process
+    :return: list of JobResult, in completion order
+    """
+    results = []
+    if workers <= 1:
+        for job in jobs:
+            result = run_job(job)
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+        return results
+
+    pending = set()
+    jobs = iter(jobs)
+    executor_class = ThreadPoolExecutor if pool == "thread" else ProcessPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        while True:
+            for job in jobs:
+                pending.add(executor.submit(run_job, job))
+                if len(pending) >= queue_size:
+                    break
+
+            if not pending:
+                return results
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+
+
+# </editor-fold>
+
+# <editor-fold desc="Report">
+def percentile(values, percent):
+    """
+    :return: The nearest-rank percentile of values, 0 for no values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def summarize(results, wall_seconds):
+    """
+    :return: dict with the throughput figures of a run
+    """
+    completed = [result for result in results if not result.skipped and result.error is None]
+    latencies = [result.seconds for result in completed]
+    megapixels = sum(result.pixels for result in completed) / 1e6
+    bytes_in = sum(result.bytes_in for result in completed)
+    bytes_out = sum(result.bytes_out for result in completed)
+    return {
+        "images": len(completed),
+        "skipped": sum(1 for result in results if result.skipped),
+        "failed": sum(1 for result in results if result.error is not None),
+        "seconds": wall_seconds,
+        "images_per_second": len(completed) / wall_seconds if wall_seconds else 0.0,
+        "megapixels_per_second": megapixels / wall_seconds if wall_seconds else 0.0,
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def format_summary(summary):
+    return "\n".join([
+        "{images} images in {seconds:.2f} s ({skipped} skipped, {failed} failed)".format(**summary),
+        "throughput: {images_per_second:.2f} images/s, {megapixels_per_second:.2f} MP/s".format(**summary),
+        "bytes: {bytes_in} in, {bytes_out} out".format(**summary),
+        "latency per image: p50 {p50:.3f} s, p95 {p95:.3f} s, p99 {p99:.3f} s".format(**summary),
+    ])
+
+
+# </editor-fold>
+
+def get_quality(value):
+    quality = int(value)
+    if not 1 <= quality <= 100:
+        raise argparse.ArgumentTypeError("quality must be between 1 and 100, got {0}".format(value))
+    return quality
+
+
+def get_region(value):
+    try:
+        region = tuple(int(part) for part in value.split(","))
+    except ValueError:
+        region = ()
+    if len(region) != 4:
+        raise argparse.ArgumentTypeError("expected LEFT,TOP,WIDTH,HEIGHT, got {0}".format(value))
+    return region
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m src", description="Batch JPEG encoder / decoder")
+    parser.add_argument("command", choices=sorted(INPUT_EXTENSIONS),
+                        help="encode PPM/PGM to JPEG, decode JPEG to PPM/PGM, roundtrip PPM/PGM through JPEG or "
+                             "transform JPEG files losslessly (--transform, --crop)")
+    parser.add_argument("inputs", nargs="+", help="files, glob patterns or directories (walked recursively)")
+    parser.add_argument("-o", "--output", help="output directory, defaults to next to each input")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="workers")
+    parser.add_argument("--pool", choices=POOLS, default=DEFAULT_POOL,
+                        help="run the workers as processes or as threads of a single process")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="maximum number of queued images, defaults to twice the number of jobs")
+    parser.add_argument("-f", "--force", action="store_true", help="also process inputs with up-to-date outputs")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default=DEFAULT_ENGINE, help="DCT engine")
+    parser.add_argument("-q", "--quality", type=get_quality, metavar="1-100",
+                        help="IJG quality of the standard quantization tables, defaults to the built-in table")
+    parser.add_argument("--subsampling", choices=sorted(SUBSAMPLING_MODES), default=DEFAULT_SUBSAMPLING,
+                        help="chroma subsampling of colour images")
+    parser.add_argument("--chroma-filter", choices=FILTERS, default=DEFAULT_FILTER,
+                        help="filter the chroma planes are downsampled with")
+    parser.add_argument("--optimize", action="store_true", help="build optimized Huffman tables per image")
+    parser.add_argument("--progressive", action="store_true", help="write progressive JPEG files")
+    parser.add_argument("--scans", metavar="FILE",
+                        help="scan script of progressive files, in the format of jpegtran -scans")
+    parser.add_argument("--scale", type=int, choices=SCALE_DENOMINATORS, default=1, metavar="N",
+                        help="decode JPEG files at 1/N of their size (N = 1, 2, 4 or 8), for thumbnails")
+    parser.add_argument("--crop", type=get_region, metavar="LEFT,TOP,WIDTH,HEIGHT",
+                        help="only decode this rectangle of JPEG files (of the scaled image with --scale); with "
+                             "transform, crop to it losslessly (LEFT and TOP multiples of the MCU size)")
+    parser.add_argument("--transform", choices=sorted(TRANSFORMS),
+                        help="rotate or flip JPEG files losslessly with the transform command, like jpegtran")
+    parser.add_argument("--stripe-rows", type=int, default=DEFAULT_STRIPE_ROWS,
+                        help="MCU rows per restart interval, 0 for none")
+    parser.add_argument("--restart-index", action="store_true",
+                        help="write the offsets of the restart intervals in an APP9 segment, for random access")
+    parser.add_argument("--max-stripes", type=int, default=DEFAULT_MAX_STRIPES,
+                        help="stripes held in memory at once while encoding")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="directory encoded files are cached in, keyed by the samples and the settings")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES,
+                        help="bytes the cache takes at most, least recently used files are evicted first")
+    parser.add_argument("--trace", metavar="FILE", help="write the stages of every image as a Chrome trace (JSON)")
+    parser.add_argument("--log", metavar="FILE", help="write the stages of every image as JSON lines")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print a line per image")
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    scan_script = None
+    if args.scans:
+        try:
+            with open(args.scans) as file:
+                scan_script = parse_scan_script(file.read())
+        except (OSError, ValueError) as e:
+            parser.error("--scans: {0}".format(e))
+    settings = {"engine": args.engine, "optimize_huffman": args.optimize, "stripe_rows": args.stripe_rows,
+                "quality": args.quality, "subsampling": args.subsampling, "chroma_filter": args.chroma_filter,
+                "max_stripes": args.max_stripes, "trace": bool(args.trace or args.log),
+                "cache": (args.cache, args.cache_size) if args.cache else None,
+                "progressive": args.progressive or scan_script is not None, "scan_script": scan_script,
+                "scale_denominator": args.scale, "region": args.crop, "restart_index": args.restart_index,
+                "transform": args.transform}
+
+    results = []
+    jobs = []
+    inputs = find_inputs(args.inputs, INPUT_EXTENSIONS[args.command])
+    # Inputs that are also outputs of this run (e.g. with -o set to an input directory) would be overwritten
+    targets = {os.path.abspath(get_target(args.command, source, root, args.output)) for source, root in inputs}
+    settings_key = get_settings_key(args.command, settings)
+    settings_keys = {}
+    for source, root in inputs:
+        if os.path.abspath(source) in targets:
+            continue
+        job = Job(args.command, source, get_target(args.command, source, root, args.output), settings)
+        directory, name = os.path.split(job.target)
+        if directory not in settings_keys:
+            settings_keys[directory] = read_settings_keys(directory)
+        # Gray images are decoded to .pgm instead of .ppm
+        gray_target = os.path.splitext(job.target)[0] + ".pgm"
+        up_to_date = is_up_to_date(source, job.target) or \
+            (args.command in ("decode", "roundtrip") and is_up_to_date(source, gray_target))
+        if not args.force and up_to_date and settings_keys[directory].get(name) == settings_key:
+            results.append(JobResult(job, skipped=True))
+        else:
+            jobs.append(job)
+
+    def report(result):
+        if result.error is not None:
+            print("{0}: {1}".format(result.job.source, result.error), file=sys.stderr)
+        elif args.verbose:
+            print("{0} -> {1} ({2:.3f} s)".format(result.job.source, result.job.target, result.seconds))
+
+    start = time.perf_counter()
+    results += run_jobs(jobs, args.jobs, args.queue_size or 2 * max(1, args.jobs), report, args.pool)
+    summary = summarize(results, time.perf_counter() - start)
+    write_settings_keys(results, settings_key)
+
+    print(format_summary(summary))
+
+    if args.trace or args.log:
+        instrumentation = Instrumentation()
+        for result in results:
+            instrumentation.extend(result.events)
+        if args.trace:
+            instrumentation.write_chrome_trace(args.trace)
+        if args.log:
+            instrumentation.write_log(args.log)
+    return 1 if summary["failed"] else 0
@@ -0,0 +1,250 @@
+import numpy as np
+
+
+class BitWriter:
+    """
+    Packs variable length codes MSB first into bytes, inserting a 0x00 after every 0xFF byte as required for
+    entropy-coded JPEG data.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.__accumulator = 0
+        self.__count = 0
+
+    def write(self, value, length):
+        """
+        Appends the lowest length bits of value.
+        """
+        if length == 0:
+            return
+        self.__accumulator = (self.__accumulator << length) | (value & ((1 << length) - 1))
+        self.__count += length
+
+        while self.__count >= 8:
+            self.__count -= 8
+            byte = (self.__accumulator >> self.__count) & 0xFF
+            self.data.append(byte)
+            if byte == 0xFF:
+                self.data.append(0x00)
+
+        self.__accumulator &= (1 << self.__count) - 1
+
+    def flush(self):
+        """
+        Pads the last partial byte with 1 bits.
+        """
+        if self.__count > 0:
+            self.write((1 << (8 - self.__count)) - 1, 8 - self.__count)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def pack_bits(values, lengths):
+    """
+    Packs a whole array of variable length codes at once, giving the same bytes as writing them one by one to a
+    BitWriter and flushing it.
+    :param values: int array, the codes
+    :param lengths: int array, the length in bits of every code, at most 32
+    :return: bytes, padded with 1 bits and byte stuffed
+    """
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    total = int(ends[-1]) if len(ends) else 0
+    padding = -total % 8
+    if padding:
+        values = np.append(values, (1 << padding) - 1)
+        lengths = np.append(lengths, padding)
+        ends = np.append(ends, total + padding)
+    starts = ends - lengths
+    byte_count = (total + padding) // 8
+
+    # Every code fits a 40 bit window starting at its first byte. Codes never share bits, so adding up the bytes of
+    # the windows gives the packed bytes.
+    windows = (values & ((1 << lengths) - 1)) << (40 - (starts & 7) - lengths)
+    first_bytes = starts >> 3
+    data = np.zeros(byte_count + 5)
+    for k in range(0, 5):
+        data += np.bincount(first_bytes + k, weights=(windows >> (32 - 8 * k)) & 0xFF, minlength=byte_count + 5)
+    data = data[:byte_count].astype(np.uint8)
+
+    return np.insert(data, np.flatnonzero(data == 0xFF) + 1, 0).tobytes()
+
+
+class ByteSource:
+    """
+    Buffered reader over a binary file object, shared by the marker parser and the BitReader so that a file is read
+    front to back exactly once, a chunk at a time.
+    """
+
+    def __init__(self, file, chunk_size=64 * 1024):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.__buffer = b""
+        self.__position = 0
+        # Offset in the file of the first byte of the buffer
+        self.__offset = file.tell() if self.seekable() else 0
+
+    def __fill(self):
+        self.__offset += self.__position
+        self.__buffer = self.__buffer[self.__position:] + self.file.read(self.chunk_size)
+        self.__position = 0
+
+    def seekable(self):
+        """
+        :return: Whether seek can be used, so whether the file is seekable
+        """
+        seekable = getattr(self.file, "seekable", None)
+        return seekable is not None and seekable()
+
+    def tell(self):
+        """
+        :return: Offset in the file of the next byte read (from where the file was when it was given, if it is not
+        seekable)
+        """
+        return self.__offset + self.__position
+
+    def seek(self, position):
+        """
+        Moves to an offset of the file, keeping the buffer if the offset is in it.
+        :raise: ValueError if the file is not seekable
+        """
+        if self.__offset <= position <= self.__offset + len(self.__buffer):
+            self.__position = position - self.__offset
+            return
+        if not self.seekable():
+            raise ValueError("The file is not seekable")
+        self.file.seek(position)
+        self.__buffer = b""
+        self.__position = 0
+        self.__offset = position
+
+    def read_rest(self):
+        """
+        :return: Every byte left in the file
+        """
+        data = self.__buffer[self.__position:] + self.file.read()
+        self.__offset = self.tell() + len(data)
+        self.__buffer = b""
+        self.__position = 0
+        return data
+
+    def read_byte(self):
+        """
+        :return: The next byte as an int, None at the end of the file
+        """
+        if self.__position >= len(self.__buffer):
+            self.__fill()
+            if self.__position >= len(self.__buffer):
+                return None
+        byte = self.__buffer[self.__position]
+        self.__position += 1
+        return byte
+
+    def read(self, count):
+        """
+        :return: The next count bytes, fewer at the end of the file
+        """
+        if self.__position + count > len(self.__buffer):
+            self.__fill()
+            if count > len(self.__buffer):
+                self.__buffer += self.file.read(count - len(self.__buffer))
+        data = self.__buffer[self.__position:self.__position + count]
+        self.__position += len(data)
+        return data
+
+    def read_marker(self):
+        """
+        Skips to the next marker, searching the buffer for 0xFF bytes, so skipping entropy-coded data costs little.
+        :return: The marker code (the byte following 0xFF), None at the end of the file
+        """
+        while True:
+            position = self.__buffer.find(b"\xff", self.__position)
+            if position < 0:
+                self.__position = len(self.__buffer)
+                self.__fill()
+                if not self.__buffer:
+                    return None
+                continue
+
+            self.__position = position + 1
+            code = self.read_byte()
+            while code == 0xFF:
+                code = self.read_byte()
+            if code is None:
+                return None
+            if code != 0x00:
+                return code
+
+
+class BitReader:
+    """
+    Reads entropy-coded JPEG data MSB first, removing byte stuffing. When a marker is reached it is remembered in
+    pending_marker and zero bits are returned from then on, like libjpeg does for corrupt data. So are they at the
+    end of the file, which sets exhausted.
+    """
+
+    def __init__(self, source: ByteSource):
+        self.source = source
+        self.pending_marker = None
+        self.exhausted = False
+        self.__accumulator = 0
+        self.__count = 0
+
+    def __load_byte(self):
+        byte = None
+        if self.pending_marker is None:
+            byte = self.source.read_byte()
+            if byte is None:
+                self.exhausted = True
+            elif byte == 0xFF:
+                code = self.source.read_byte()
+                while code == 0xFF:
+                    code = self.source.read_byte()
+                if code != 0x00:
+                    self.pending_marker = code
+                    byte = None
+        self.__accumulator = (self.__accumulator << 8) | (0 if byte is None else byte)
+        self.__count += 8
+
+    def read_bit(self):
+        if self.__count == 0:
+            self.__load_byte()
+        self.__count -= 1
+        bit = (self.__accumulator >> self.__count) & 1
+        self.__accumulator &= (1 << self.__count) - 1
+        return bit
+
+    def read_bits(self, length):
+        while self.__count < length:
+            self.__load_byte()
+        self.__count -= length
+        value = (self.__accumulator >> self.__count) & ((1 << length) - 1)
+        self.__accumulator &= (1 << self.__count) - 1
+        return value
+
+    def receive_extend(self, size):
+        """
+        Reads the magnitude bits of a coefficient of the given size category and returns its signed value.
+        """
+        if size == 0:
+            return 0
+        value = self.read_bits(size)
+        if value < (1 << (size - 1)):
+            value -= (1 << size) - 1
+        return value
+
+    def read_marker(self):
+        """
+        Drops the bits left in the current byte and reads the next marker.
+        :return: The marker code, None at the end of the file
+        """
+        self.__accumulator = 0
+        self.__count = 0
+        if self.pending_marker is not None:
+            code = self.pending_marker
+            self.pending_marker = None
+            return code
+        return self.source.read_marker()
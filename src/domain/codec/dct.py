@@ -0,0 +1,446 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+
+# All engines return the orthonormal 2-D DCT-II used by the JPEG standard:
+#   F(u, v) = 1/4 * a(u) * a(v) * sum_x sum_y f(x, y) * cos((2x + 1)u*pi/16) * cos((2y + 1)v*pi/16)
+# The fast engines only reorder the arithmetic, so their results match the naive sums up to float
+# rounding. For sample values in [-128, 127] the largest absolute difference is below DCT_TOLERANCE.
+DCT_TOLERANCE = 1e-9
+
+# Fixed-point constants of the integer engine: FIX(x) = round(x * 2^CONST_BITS), as in libjpeg's jfdctint / jidctint
+CONST_BITS = 13
+PASS1_BITS = 2
+FIX_0_298631336 = 2446
+FIX_0_390180644 = 3196
+FIX_0_541196100 = 4433
+FIX_0_765366865 = 6270
+FIX_0_899976223 = 7373
+FIX_1_175875602 = 9633
+FIX_1_501321110 = 12299
+FIX_1_847759065 = 15137
+FIX_1_961570560 = 16069
+FIX_2_053119869 = 16819
+FIX_2_562915447 = 20995
+FIX_3_072711026 = 25172
+
+
+def _descale(x, n):
+    # Right shift by n bits, rounding to nearest
+    return (x + (1 << (n - 1))) >> n
+
+
+def _a(u):
+    if u > 0:
+        return 1
+    return 1 / math.sqrt(2)
+
+
+class DCTEngine:
+    """
+    Base class for the forward / inverse 2-D DCT of a square block.
+    Engines take the items of a block (a list of rows) and return a new list of rows. forward_blocks /
+    inverse_blocks transform a whole numpy array of blocks at once; engines override them with vectorized versions.
+    Integer engines (integer = True) also work on int arrays only, see IntegerDCTEngine.
+    """
+    name = None
+    integer = False
+
+    def forward(self, items):
+        raise NotImplementedError
+
+    def inverse(self, items):
+        raise NotImplementedError
+
+    def forward_blocks(self, blocks):
+        """
+        :param blocks: Array of shape (..., 8, 8)
+        :return: float64 array of the same shape with the DCT of every block
+        """
+        return self.__map_blocks(self.forward, blocks)
+
+    def inverse_blocks(self, blocks):
+        """
+        :param blocks: Array of shape (..., 8, 8)
+        :return: float64 array of the same shape with the inverse DCT of every block
+        """
+        return self.__map_blocks(self.inverse, blocks)
+
+    @staticmethod
+    def __map_blocks(transform, blocks):
+        blocks = np.asarray(blocks, dtype=np.float64)
+        result = np.empty(blocks.shape)
+        flat_blocks = blocks.reshape((-1,) + blocks.shape[-2:])
+        flat_result = result.reshape(flat_blocks.shape)
+        for i in range(0, len(flat_blocks)):
+            flat_result[i] = transform(flat_blocks[i].tolist())
+        return result
+
+
+class NaiveDCTEngine(DCTEngine):
+    """
+    Direct evaluation of the DCT formula, one cosine sum per coefficient. Kept as the reference implementation.
+    """
+    name = "naive"
+
+    def forward(self, items):
+        block_size = len(items)
+        result = [[0.0 for _ in range(0, block_size)] for _ in range(0, block_size)]
+        for u in range(0, block_size):
+            for v in range(0, block_size):
+                total = 0.0
+                for x in range(0, block_size):
+                    for y in range(0, block_size):
+                        total += items[x][y] * \
+                                 math.cos((2 * x + 1) * u * math.pi / 16) * \
+                                 math.cos((2 * y + 1) * v * math.pi / 16)
+                result[u][v] = 1 / 4 * _a(u) * _a(v) * total
+        return result
+
+    def inverse(self, items):
+        block_size = len(items)
+        result = [[0.0 for _ in range(0, block_size)] for _ in range(0, block_size)]
+        for x in range(0, block_size):
+            for y in range(0, block_size):
+                total = 0.0
+                for u in range(0, block_size):
+                    for v in range(0, block_size):
+                        total += _a(u) * _a(v) * items[u][v] * \
+                                 math.cos((2 * x + 1) * u * math.pi / 16) * \
+                                 math.cos((2 * y + 1) * v * math.pi / 16)
+                result[x][y] = 1 / 4 * total
+        return result
+
+
+class MatrixDCTEngine(DCTEngine):
+    """
+    Separable transform with a precomputed cosine matrix C: F = C * f * C^T and f = C^T * F * C.
+    Each 8x8 block costs two passes of 8 one-dimensional transforms instead of 64 full sums.
+    """
+    name = "matrix"
+
+    def __init__(self, block_size=8):
+        self.block_size = block_size
+        self.matrix = [[math.sqrt(2 / block_size) * _a(u) * math.cos((2 * x + 1) * u * math.pi / (2 * block_size))
+                        for x in range(0, block_size)]
+                       for u in range(0, block_size)]
+        self.transposed = [list(column) for column in zip(*self.matrix)]
+        self.array = np.array(self.matrix)
+
+    @staticmethod
+    def __transform_rows(rows, matrix):
+        # Applies the 1-D transform given by matrix to every row: out[r][k] = sum_i rows[r][i] * matrix[k][i]
+        return [[sum(value * weight for value, weight in zip(row, basis)) for basis in matrix] for row in rows]
+
+    def forward(self, items):
+        # Rows first, then columns (done as rows of the transposed intermediate result)
+        rows = self.__transform_rows(items, self.matrix)
+        columns = self.__transform_rows(list(zip(*rows)), self.matrix)
+        return [list(line) for line in zip(*columns)]
+
+    def inverse(self, items):
+        rows = self.__transform_rows(items, self.transposed)
+        columns = self.__transform_rows(list(zip(*rows)), self.transposed)
+        return [list(line) for line in zip(*columns)]
+
+    def forward_blocks(self, blocks):
+        return self.array @ np.asarray(blocks, dtype=np.float64) @ self.array.T
+
+    def inverse_blocks(self, blocks):
+        return self.array.T @ np.asarray(blocks, dtype=np.float64) @ self.array
+
+
+class AANDCTEngine(DCTEngine):
+    """
+    Arai-Agui-Nakajima fast 8-point DCT (the flow graph used by libjpeg's jfdctflt / jidctflt): 5 multiplications
+    and 29 additions per 1-D transform. The AAN outputs are scaled, so the per-coefficient scale factors are folded
+    into a precomputed 8x8 table that is applied once per block.
+    """
+    name = "aan"
+
+    def __init__(self):
+        scale_factors = [1.0] + [math.cos(k * math.pi / 16) * math.sqrt(2) for k in range(1, 8)]
+        self.descale = [[1 / (8 * scale_factors[u] * scale_factors[v]) for v in range(0, 8)] for u in range(0, 8)]
+        self.prescale = [[scale_factors[u] * scale_factors[v] / 8 for v in range(0, 8)] for u in range(0, 8)]
+        self.descale_array = np.array(self.descale)
+        self.prescale_array = np.array(self.prescale)
+
+    @staticmethod
+    def __forward_1d(d):
+        tmp0 = d[0] + d[7]
+        tmp7 = d[0] - d[7]
+        tmp1 = d[1] + d[6]
+        tmp6 = d[1] - d[6]
+        tmp2 = d[2] + d[5]
+        tmp5 = d[2] - d[5]
+        tmp3 = d[3] + d[4]
+        tmp4 = d[3] - d[4]
+
+        # Even part
+        tmp10 = tmp0 + tmp3
+        tmp13 = tmp0 - tmp3
+        tmp11 = tmp1 + tmp2
+        tmp12 = tmp1 - tmp2
+
+        z1 = (tmp12 + tmp13) * 0.707106781186547524
+        out0 = tmp10 + tmp11
+        out4 = tmp10 - tmp11
+        out2 = tmp13 + z1
+        out6 = tmp13 - z1
+
+        # Odd part
+        tmp10 = tmp4 + tmp5
+        tmp11 = tmp5 + tmp6
+        tmp12 = tmp6 + tmp7
+
+        z5 = (tmp10 - tmp12) * 0.382683432365089772
+        z2 = 0.541196100146196984 * tmp10 + z5
+        z4 = 1.306562964876376527 * tmp12 + z5
+        z3 = tmp11 * 0.707106781186547524
+
+        z11 = tmp7 + z3
+        z13 = tmp7 - z3
+
+        return [out0, z11 + z4, out2, z13 - z2, out4, z13 + z2, out6, z11 - z4]
+
+    @staticmethod
+    def __inverse_1d(d):
+        # Even part
+        tmp10 = d[0] + d[4]
+        tmp11 = d[0] - d[4]
+        tmp13 = d[2] + d[6]
+        tmp12 = (d[2] - d[6]) * 1.414213562373095049 - tmp13
+
+        tmp0 = tmp10 + tmp13
+        tmp3 = tmp10 - tmp13
+        tmp1 = tmp11 + tmp12
+        tmp2 = tmp11 - tmp12
+
+        # Odd part
+        z13 = d[5] + d[3]
+        z10 = d[5] - d[3]
+        z11 = d[1] + d[7]
+        z12 = d[1] - d[7]
+
+        tmp7 = z11 + z13
+        tmp11 = (z11 - z13) * 1.414213562373095049
+
+        z5 = (z10 + z12) * 1.847759065022573512
+        tmp10 = 1.082392200292393968 * z12 - z5
+        tmp12 = -2.613125929752753055 * z10 + z5
+
+        tmp6 = tmp12 - tmp7
+        tmp5 = tmp11 - tmp6
+        tmp4 = tmp10 + tmp5
+
+        return [tmp0 + tmp7, tmp1 + tmp6, tmp2 + tmp5, tmp3 - tmp4,
+                tmp3 + tmp4, tmp2 - tmp5, tmp1 - tmp6, tmp0 - tmp7]
+
+    def forward(self, items):
+        rows = [self.__forward_1d(row) for row in items]
+        columns = [self.__forward_1d(column) for column in zip(*rows)]
+        return [[columns[v][u] * self.descale[u][v] for v in range(0, 8)] for u in range(0, 8)]
+
+    def inverse(self, items):
+        scaled = [[items[u][v] * self.prescale[u][v] for v in range(0, 8)] for u in range(0, 8)]
+        rows = [self.__inverse_1d(row) for row in scaled]
+        columns = [self.__inverse_1d(column) for column in zip(*rows)]
+        return [[columns[y][x] for y in range(0, 8)] for x in range(0, 8)]
+
+    # The 1-D flow graphs only use indexing and arithmetic, so they also run on the 8 slices of a numpy array
+    # along the transformed axis, transforming every block at once.
+    def forward_blocks(self, blocks):
+        blocks = np.asarray(blocks, dtype=np.float64)
+        rows = np.stack(self.__forward_1d(np.moveaxis(blocks, -1, 0)), axis=-1)
+        columns = np.stack(self.__forward_1d(np.moveaxis(rows, -2, 0)), axis=-2)
+        return columns * self.descale_array
+
+    def inverse_blocks(self, blocks):
+        blocks = np.asarray(blocks, dtype=np.float64) * self.prescale_array
+        rows = np.stack(self.__inverse_1d(np.moveaxis(blocks, -1, 0)), axis=-1)
+        return np.stack(self.__inverse_1d(np.moveaxis(rows, -2, 0)), axis=-2)
+
+
+class IntegerDCTEngine(DCTEngine):
+    """
+    The "islow" integer DCT of libjpeg's jfdctint / jidctint (Loeffler-Ligtenberg-Moschytz with 13 bit fixed-point
+    constants). It only uses integer additions, multiplications and shifts, so its results are exact and the same on
+    every platform, unlike the float engines.
+
+    forward_integers / inverse_integers work on int arrays, the forward output being scaled by `scale` like libjpeg's
+    so the quantizer can divide once (Quantizer.quantize_integers). forward_blocks / inverse_blocks round their input
+    to integers and give the plain DCT, so the engine can stand in for the float ones anywhere.
+    """
+    name = "islow"
+    integer = True
+    scale = 8
+
+    @staticmethod
+    def __forward_1d(d, first_pass):
+        tmp0 = d[0] + d[7]
+        tmp7 = d[0] - d[7]
+        tmp1 = d[1] + d[6]
+        tmp6 = d[1] - d[6]
+        tmp2 = d[2] + d[5]
+        tmp5 = d[2] - d[5]
+        tmp3 = d[3] + d[4]
+        tmp4 = d[3] - d[4]
+
+        # Even part, the first pass keeps PASS1_BITS more bits of precision
+        tmp10 = tmp0 + tmp3
+        tmp13 = tmp0 - tmp3
+        tmp11 = tmp1 + tmp2
+        tmp12 = tmp1 - tmp2
+        if first_pass:
+            shift = CONST_BITS - PASS1_BITS
+            out0 = (tmp10 + tmp11) << PASS1_BITS
+            out4 = (tmp10 - tmp11) << PASS1_BITS
+        else:
+            shift = CONST_BITS + PASS1_BITS
+            out0 = _descale(tmp10 + tmp11, PASS1_BITS)
+            out4 = _descale(tmp10 - tmp11, PASS1_BITS)
+
+        z1 = (tmp12 + tmp13) * FIX_0_541196100
+        out2 = _descale(z1 + tmp13 * FIX_0_765366865, shift)
+        out6 = _descale(z1 - tmp12 * FIX_1_847759065, shift)
+
+        # Odd part
+        z1 = tmp4 + tmp7
+        z2 = tmp5 + tmp6
+        z3 = tmp4 + tmp6
+        z4 = tmp5 + tmp7
+        z5 = (z3 + z4) * FIX_1_175875602
+
+        tmp4 = tmp4 * FIX_0_298631336
+        tmp5 = tmp5 * FIX_2_053119869
+        tmp6 = tmp6 * FIX_3_072711026
+        tmp7 = tmp7 * FIX_1_501321110
+        z1 = z1 * -FIX_0_899976223
+        z2 = z2 * -FIX_2_562915447
+        z3 = z3 * -FIX_1_961570560 + z5
+        z4 = z4 * -FIX_0_390180644 + z5
+
+        return [out0, _descale(tmp7 + z1 + z4, shift), out2, _descale(tmp6 + z2 + z3, shift),
+                out4, _descale(tmp5 + z2 + z4, shift), out6, _descale(tmp4 + z1 + z3, shift)]
+
+    @staticmethod
+    def __inverse_1d(d, first_pass):
+        # The second pass also removes the factor 8 of the 2-D transform
+        shift = CONST_BITS - PASS1_BITS if first_pass else CONST_BITS + PASS1_BITS + 3
+
+        # Even part
+        z1 = (d[2] + d[6]) * FIX_0_541196100
+        tmp2 = z1 - d[6] * FIX_1_847759065
+        tmp3 = z1 + d[2] * FIX_0_765366865
+        tmp0 = (d[0] + d[4]) << CONST_BITS
+        tmp1 = (d[0] - d[4]) << CONST_BITS
+
+        tmp10 = tmp0 + tmp3
+        tmp13 = tmp0 - tmp3
+        tmp11 = tmp1 + tmp2
+        tmp12 = tmp1 - tmp2
+
+        # Odd part
+        tmp0, tmp1, tmp2, tmp3 = d[7], d[5], d[3], d[1]
+        z1 = tmp0 + tmp3
+        z2 = tmp1 + tmp2
+        z3 = tmp0 + tmp2
+        z4 = tmp1 + tmp3
+        z5 = (z3 + z4) * FIX_1_175875602
+
+        z1 = z1 * -FIX_0_899976223
+        z2 = z2 * -FIX_2_562915447
+        z3 = z3 * -FIX_1_961570560 + z5
+        z4 = z4 * -FIX_0_390180644 + z5
+        tmp0 = tmp0 * FIX_0_298631336 + z1 + z3
+        tmp1 = tmp1 * FIX_2_053119869 + z2 + z4
+        tmp2 = tmp2 * FIX_3_072711026 + z2 + z3
+        tmp3 = tmp3 * FIX_1_501321110 + z1 + z4
+
+        return [_descale(tmp10 + tmp3, shift), _descale(tmp11 + tmp2, shift),
+                _descale(tmp12 + tmp1, shift), _descale(tmp13 + tmp0, shift),
+                _descale(tmp13 - tmp0, shift), _descale(tmp12 - tmp1, shift),
+                _descale(tmp11 - tmp2, shift), _descale(tmp10 - tmp3, shift)]
+
+    def forward_integers(self, blocks):
+        """
+        :param blocks: int array of shape (..., 8, 8) with level shifted samples
+        :return: int64 array of the same shape with the DCT of every block, scaled by self.scale
+        """
+        blocks = np.asarray(blocks, dtype=np.int64)
+        rows = np.stack(self.__forward_1d(np.moveaxis(blocks, -1, 0), True), axis=-1)
+        return np.stack(self.__forward_1d(np.moveaxis(rows, -2, 0), False), axis=-2)
+
+    def inverse_integers(self, blocks):
+        """
+        :param blocks: int array of shape (..., 8, 8) with dequantized (unscaled) coefficients
+        :return: int64 array of the same shape with the level shifted samples, not clamped
+        """
+        blocks = np.asarray(blocks, dtype=np.int64)
+        columns = np.stack(self.__inverse_1d(np.moveaxis(blocks, -2, 0), True), axis=-2)
+        return np.stack(self.__inverse_1d(np.moveaxis(columns, -1, 0), False), axis=-1)
+
+    def forward(self, items):
+        return self.forward_blocks(items).tolist()
+
+    def inverse(self, items):
+        return self.inverse_blocks(items).tolist()
+
+    def forward_blocks(self, blocks):
+        return self.forward_integers(np.rint(blocks)) / self.scale
+
+    def inverse_blocks(self, blocks):
+        return self.inverse_integers(np.rint(blocks)).astype(np.float64)
+
+
+# Reductions of the scaled inverse DCT: a block is decoded into 8 / denominator samples a side
+SCALE_DENOMINATORS = (1, 2, 4, 8)
+
+
+@lru_cache(maxsize=None)
+def _get_reduced_matrix(size):
+    # Orthonormal size-point DCT matrix, times sqrt(size / 8): the lowest size x size coefficients of an 8x8 block
+    # are (up to that factor per axis) the coefficients of the block averaged down to size x size samples
+    return np.array([[math.sqrt(2 / size) * _a(u) * math.cos((2 * x + 1) * u * math.pi / (2 * size))
+                      for x in range(0, size)]
+                     for u in range(0, size)]) * math.sqrt(size / 8)
+
+
+def inverse_reduced_blocks(blocks, size):
+    """
+    Scaled inverse DCT, like libjpeg's jidctred: only the lowest size x size frequencies of every block are
+    transformed, into size x size samples, each the average of the (8 / size)^2 samples it stands for (for size 1,
+    the DC coefficient / 8).
+    :param blocks: Array of shape (..., n, n), n >= size, of dequantized coefficients in natural order
+    :param size: 1, 2, 4 or 8 samples a side
+    :return: float64 array of shape (..., size, size)
+    """
+    matrix = _get_reduced_matrix(size)
+    return matrix.T @ np.asarray(blocks[..., :size, :size], dtype=np.float64) @ matrix
+
+
+ENGINES = {
+    NaiveDCTEngine.name: NaiveDCTEngine,
+    MatrixDCTEngine.name: MatrixDCTEngine,
+    AANDCTEngine.name: AANDCTEngine,
+    IntegerDCTEngine.name: IntegerDCTEngine,
+}
+
+DEFAULT_ENGINE = AANDCTEngine.name
+
+
+def get_engine(engine=None):
+    """
+    Resolves a DCT engine.
+    :param engine: None for the default engine, an engine name from ENGINES or a DCTEngine instance
+    :return: DCTEngine instance
+    :raise: KeyError if the engine name is unknown
+    """
+    if engine is None:
+        engine = DEFAULT_ENGINE
+    if isinstance(engine, DCTEngine):
+        return engine
+    if engine not in ENGINES:
+        raise KeyError("Unknown DCT engine '{0}', expected one of {1}".format(engine, sorted(ENGINES)))
+    return ENGINES[engine]()
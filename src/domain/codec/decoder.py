@@ -0,0 +1,830 @@
+import io
+import re
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.domain.codec.bit_io import ByteSource, BitReader
+from src.domain.codec.dct import SCALE_DENOMINATORS, get_engine, inverse_reduced_blocks
+from src.domain.codec.huffman import HuffmanTable, decode_block
+from src.domain.codec.jfif import SOI, EOI, SOF0, SOF2, DHT, DQT, SOS, APP9, ZIGZAG, Component, read_restart_index
+from src.domain.codec.progressive import Scan, get_component_blocks, decode_dc_first, decode_dc_refinement, \
+    decode_ac_first, decode_ac_refinement
+from src.domain.exceptions.CorruptStreamException import CorruptStreamException
+from src.domain.exceptions.FormatNotSupportedException import FormatNotSupportedException
+from src.util.color_space import yuv_to_rgb, ycc_to_rgb_integers
+from src.util.instrumentation import get_instrumentation
+
+SOF1 = 0xC1
+DRI = 0xDD
+RST0 = 0xD0
+RST7 = 0xD7
+
+# Start of frame markers of the processes we can't decode
+UNSUPPORTED_FRAMES = {0xC3: "lossless", 0xC5: "differential", 0xC6: "differential",
+                      0xC7: "differential", 0xC9: "arithmetic", 0xCA: "arithmetic", 0xCB: "arithmetic",
+                      0xCD: "arithmetic", 0xCE: "arithmetic", 0xCF: "arithmetic"}
+
+# Zig-zag position of every natural (row-major) coefficient index
+NATURAL_ORDER = np.argsort(ZIGZAG)
+
+# Splits entropy-coded data at its RSTn markers (0xFF is always followed by 0x00 inside the coded data)
+RESTART_MARKERS = re.compile(rb"\xff[\xd0-\xd7]")
+
+
+def _decode_interval_task(task):
+    """
+    Entropy decodes one restart interval of a sequential scan, in a worker process.
+    :param task: (number of the interval, its coded bytes followed by the marker after it, number of MCUs,
+    (component index, DC table, AC table) of every block of an MCU, whether to stop at corrupt data instead of
+    raising)
+    :return: (int32 array of shape (MCUs, blocks per MCU, 64) with the coefficients in zig-zag order, whether the
+    interval decoded without errors); the blocks after an error are left zero
+    :raise: CorruptStreamException if the interval is corrupt or reaches its marker before its last MCU, and
+    recover is not set
+    """
+    interval, data, count, blocks, recover = task
+    reader = BitReader(ByteSource(io.BytesIO(data)))
+    coefficients = np.zeros((count, len(blocks), 64), dtype=np.int32)
+    predictors = {}
+    try:
+        for mcu in range(0, count):
+            for k, (index, dc_table, ac_table) in enumerate(blocks):
+                coefficients[mcu, k], predictors[index] = decode_block(reader, predictors.get(index, 0), dc_table,
+                                                                       ac_table)
+        if reader.pending_marker is not None:
+            raise CorruptStreamException("Restart interval {0} ended before its last MCU".format(interval))
+    except CorruptStreamException:
+        if not recover:
+            raise
+        return coefficients, False
+    return coefficients, True
+
+
+class JPEGDecoder:
+    """
+    Streaming decoder for baseline (sequential, Huffman coded) and progressive JPEG files.
+    The file is read front to back once. Sequential files are decoded one MCU row at a time, so memory stays
+    bounded by one MCU row of coefficients and samples whatever the image size.
+
+    Progressive files keep the coefficients of the whole image, every scan adding to them. read_scans reads them a
+    few at a time and preview renders the image from the scans read so far; a file that ends early (e.g. still
+    downloading) decodes to the scans that arrived.
+
+    Usage:
+        with open(filename, "rb") as file:
+            decoder = JPEGDecoder(file)
+            for line in decoder.scanlines():
+                ...
+
+        decoder = JPEGDecoder(file)  # progressive
+        thumbnail = decoder.preview(scans=1)  # DC only
+        image = decoder.decode()  # every scan
+
+    With scale_denominator > 1 the image is decoded at 1 / scale_denominator of its size (output_width x
+    output_height): only the lowest frequencies of every block are dequantized and inverse transformed, the DC
+    coefficient alone at 1/8. Entropy decoding still reads every coefficient.
+
+    Sequential files with restart intervals (as JPEGEncoder writes them, one per stripe) can be decoded by several
+    worker processes, an interval each, and with recover an interval that fails to decode is left blank instead of
+    ending the decode. A restart index (APP9 segment, see jfif.restart_index_segments) gives the offset of every
+    interval: regions seek straight to their first interval, and corrupt intervals are skipped without searching
+    for the next marker.
+    """
+
+    def __init__(self, file, engine=None, instrumentation=None, scale_denominator=1, workers=1, recover=False):
+        """
+        :param file: Binary file object positioned at the start of the JPEG data
+        :param engine: DCT engine used for the inverse transform (see src.domain.codec.dct); scaled decoding always
+        uses the float scaled transform
+        :param instrumentation: src.util.instrumentation.Instrumentation recording the stages of every MCU row
+        :param scale_denominator: 1, 2, 4 or 8, the image is decoded at 1 / scale_denominator of its size
+        :param workers: Processes entropy decoding the restart intervals of sequential files. With more than one,
+        the coefficients of the whole image are kept (like for progressive files) and the file is read at once.
+        :param recover: Whether to go on decoding sequential files after corrupt data, from the next restart
+        interval (listed in corrupt_intervals), instead of raising CorruptStreamException
+        :raise: KeyError if the scale is not one of SCALE_DENOMINATORS
+        """
+        if scale_denominator not in SCALE_DENOMINATORS:
+            raise KeyError("Unknown scale 1/{0}, expected one of {1}".format(
+                scale_denominator, ", ".join("1/{0}".format(d) for d in SCALE_DENOMINATORS)))
+        self.source = ByteSource(file)
+        self.engine = get_engine(engine)
+        self.instrumentation = get_instrumentation(instrumentation)
+        self.scale_denominator = scale_denominator
+        self.workers = workers
+        self.recover = recover
+
+        self.width = None
+        self.height = None
+        self.components = []
+        self.quantization_tables = {}
+        self.dc_tables = {}
+        self.ac_tables = {}
+        self.restart_interval = 0
+        self.scan_components = None
+        self.progressive = False
+        # Header of the next scan to decode, None once there are no more
+        self.scan = None
+        self.scans_read = 0
+        self.__coefficients = None
+        # Offset of every restart interval from the start of the scan, None without a (valid) restart index
+        self.restart_offsets = None
+        self.__index_interval = None
+        self.__scan_start = None
+        # Restart intervals (numbered from 0) with corrupt data, decoded with recover
+        self.corrupt_intervals = []
+
+        self.__read_headers()
+
+    @property
+    def output_width(self):
+        return -(-self.width // self.scale_denominator)
+
+    @property
+    def output_height(self):
+        return -(-self.height // self.scale_denominator)
+
+    # <editor-fold desc="Headers">
+    def __read_headers(self):
+        """
+        Reads every marker segment up to and including the first SOS.
+        """
+        if self.source.read(2) != bytes((0xFF, SOI)):
+            raise CorruptStreamException("Missing SOI marker, not a JPEG file")
+        if not self.__read_segments(self.source.read_marker()):
+            raise CorruptStreamException("No scan found")
+        self.__scan_start = self.source.tell()
+
+        # An index that does not fit the frame is ignored, the intervals are then found by their markers
+        if self.restart_offsets is not None and (self.progressive or self.__index_interval != self.restart_interval
+                                                 or len(self.restart_offsets) != self.interval_count):
+            self.restart_offsets = None
+
+    def __read_segments(self, code):
+        """
+        Reads marker segments up to and including the next SOS.
+        :param code: The first marker
+        :return: Whether a scan follows, False at EOI or the end of the file
+        """
+        while True:
+            if code is None or code == EOI:
+                return False
+
+            if code in UNSUPPORTED_FRAMES:
+                raise FormatNotSupportedException("{0} JPEG files are not supported :(".format(
+                    UNSUPPORTED_FRAMES[code].capitalize()))
+
+            payload = self.__read_segment()
+            if code in (SOF0, SOF1, SOF2):
+                self.progressive = code == SOF2
+                self.__read_frame(payload)
+            elif code == DQT:
+                self.__read_quantization_tables(payload)
+            elif code == DHT:
+                self.__read_huffman_tables(payload)
+            elif code == DRI:
+                self.restart_interval = struct.unpack(">H", payload[0:2])[0]
+            elif code == APP9:
+                self.__read_restart_index(payload)
+            elif code == SOS:
+                self.__read_scan_header(payload)
+                return True
+            # APPn, COM and the rest carry nothing we need
+            code = self.source.read_marker()
+
+    def __read_segment(self):
+        length_bytes = self.source.read(2)
+        if len(length_bytes) < 2:
+            raise CorruptStreamException("Truncated marker segment")
+        length = struct.unpack(">H", length_bytes)[0]
+        payload = self.source.read(length - 2)
+        if len(payload) < length - 2:
+            raise CorruptStreamException("Truncated marker segment")
+        return payload
+
+    def __read_frame(self, payload):
+        precision, self.height, self.width, count = struct.unpack(">BHHB", payload[0:6])
+        if precision != 8:
+            raise FormatNotSupportedException("Only 8 bit JPEG files are supported, got {0} bits".format(precision))
+        if self.height == 0:
+            raise FormatNotSupportedException("JPEG files with a DNL marker are not supported")
+
+        self.components = []
+        for i in range(0, count):
+            identifier, sampling, table = struct.unpack(">BBB", payload[6 + 3 * i:9 + 3 * i])
+            self.components.append(Component(identifier, sampling >> 4, sampling & 0x0F, table))
+
+    def __read_quantization_tables(self, payload):
+        position = 0
+        while position < len(payload):
+            precision, table_id = payload[position] >> 4, payload[position] & 0x0F
+            position += 1
+            if precision == 0:
+                values = list(payload[position:position + 64])
+                position += 64
+            else:
+                values = list(struct.unpack(">64H", payload[position:position + 128]))
+                position += 128
+
+            # Stored in zig-zag order
+            table = np.zeros(64)
+            table[ZIGZAG] = values
+            self.quantization_tables[table_id] = table.reshape(8, 8)
+
+    def __read_huffman_tables(self, payload):
+        position = 0
+        while position < len(payload):
+            table_class, table_id = payload[position] >> 4, payload[position] & 0x0F
+            bits = list(payload[position + 1:position + 17])
+            values = list(payload[position + 17:position + 17 + sum(bits)])
+            position += 17 + sum(bits)
+
+            tables = self.dc_tables if table_class == 0 else self.ac_tables
+            tables[table_id] = HuffmanTable(bits, values)
+
+    def __read_restart_index(self, payload):
+        index = read_restart_index(payload)
+        if index is None:
+            return
+        restart_interval, first, offsets = index
+        if first == 0:
+            self.restart_offsets = []
+            self.__index_interval = restart_interval
+        if self.restart_offsets is not None and first == len(self.restart_offsets):
+            self.restart_offsets += offsets
+
+    def __read_scan_header(self, payload):
+        if not self.components:
+            raise CorruptStreamException("SOS before SOF")
+
+        count = payload[0]
+        self.scan_components = []
+        for i in range(0, count):
+            identifier, tables = payload[1 + 2 * i], payload[2 + 2 * i]
+            component_index = next((k for k, c in enumerate(self.components) if c.identifier == identifier), None)
+            if component_index is None:
+                raise CorruptStreamException("Scan references unknown component {0}".format(identifier))
+            self.components[component_index].dc_table = tables >> 4
+            self.components[component_index].ac_table = tables & 0x0F
+            self.scan_components.append(component_index)
+
+        spectral_start, spectral_end, approximation = payload[1 + 2 * count:4 + 2 * count]
+        self.scan = Scan(self.scan_components, spectral_start, spectral_end, approximation >> 4, approximation & 0x0F)
+        if count != len(self.components) and not self.progressive:
+            raise FormatNotSupportedException("Only single scan sequential JPEG files are supported")
+
+    # </editor-fold>
+
+    # A single component scan is not interleaved: every block is an MCU, so its sampling factors count as 1x1
+    @property
+    def max_horizontal(self):
+        if len(self.components) == 1:
+            return 1
+        return max(component.horizontal for component in self.components)
+
+    @property
+    def max_vertical(self):
+        if len(self.components) == 1:
+            return 1
+        return max(component.vertical for component in self.components)
+
+    @property
+    def mcus_per_line(self):
+        return -(-self.width // (8 * self.max_horizontal))
+
+    @property
+    def mcu_lines(self):
+        return -(-self.height // (8 * self.max_vertical))
+
+    @property
+    def interval_count(self):
+        """
+        :return: The number of restart intervals of a sequential file, 1 without restart markers
+        """
+        if not self.restart_interval:
+            return 1
+        return -(-self.mcus_per_line * self.mcu_lines // self.restart_interval)
+
+    def coefficient_rows(self, columns=None, lines=None):
+        """
+        Entropy decodes the scan (every scan left of a progressive file).
+        :param columns: (first, last) MCU columns the rows hold, None for all of them
+        :param lines: (first, last) MCU lines to yield, None for all of them. Sequential files are only read up to
+        the last line, and their restart intervals without any MCU of the columns and lines are skipped undecoded
+        (seeked over, with a restart index).
+        :return: Generator yielding, for every MCU row, one array per component of shape
+        (vertical, blocks per line, 64) with the quantized coefficients of the row in natural order.
+        :raise: CorruptStreamException if the data is corrupt, unless recover is set
+        """
+        first_column, last_column = (0, self.mcus_per_line) if columns is None else columns
+        first_line, last_line = (0, self.mcu_lines) if lines is None else lines
+        if self.progressive:
+            self.read_scans()
+            yield from self.__buffered_rows(columns, lines)
+            return
+        if self.workers > 1 and self.restart_interval:
+            self.__decode_intervals(columns, lines)
+            yield from self.__buffered_rows(columns, lines)
+            return
+
+        reader = BitReader(self.source)
+        mcus_per_line = self.mcus_per_line
+        # A single component scan is not interleaved, each block is an MCU
+        interleaved = len(self.scan_components) > 1
+        seeking = self.restart_offsets is not None and self.source.seekable()
+
+        predictors = [0] * len(self.components)
+        skipping = False
+        # Set once the current interval turned out corrupt, its other MCUs are left zero
+        lost = False
+        interval = 0
+
+        for mcu_line in range(0, last_line):
+            kept = mcu_line >= first_line
+            with self.instrumentation.stage("entropy_decode", mcu_line=mcu_line) as span:
+                rows = [np.zeros((c.vertical if interleaved else 1,
+                                  (last_column - first_column) * (c.horizontal if interleaved else 1), 64),
+                                 dtype=np.int32) for c in self.components]
+                decoded = 0
+
+                for mcu_x in range(0, mcus_per_line):
+                    mcu = mcu_line * mcus_per_line + mcu_x
+                    if self.restart_interval and mcu % self.restart_interval == 0:
+                        interval = mcu // self.restart_interval
+                        # Whether the interval before was decoded up to its end
+                        decoded_before = mcu > 0 and not (skipping or lost)
+                        skipping = not self.__intersects(mcu, mcu + self.restart_interval, columns, lines)
+                        if mcu > 0:
+                            predictors = [0] * len(self.components)
+                            if decoded_before:
+                                self.__check_interval_end(reader, interval - 1)
+                            if not seeking:
+                                # Also skips the data of the interval before, if it was not decoded
+                                lost = not self.__read_restart_marker(reader, interval)
+                            elif not skipping:
+                                if decoded_before and reader.read_marker() != RST0 + (interval - 1) % 8:
+                                    self.__report_corrupt(interval - 1, "Expected RST{0} marker".format(
+                                        (interval - 1) % 8))
+                                    decoded_before = False
+                                lost = False
+                                if not decoded_before:
+                                    lost = not self.__seek_interval(interval)
+                                    reader = BitReader(self.source)
+                    if skipping or lost:
+                        continue
+
+                    stored = kept and first_column <= mcu_x < last_column
+                    try:
+                        for component_index in self.scan_components:
+                            component = self.components[component_index]
+                            vertical = component.vertical if interleaved else 1
+                            horizontal = component.horizontal if interleaved else 1
+                            for block_y in range(0, vertical):
+                                for block_x in range(0, horizontal):
+                                    coefficients, predictors[component_index] = decode_block(
+                                        reader, predictors[component_index],
+                                        self.dc_tables[component.dc_table], self.ac_tables[component.ac_table])
+                                    decoded += 1
+                                    if stored:
+                                        rows[component_index][block_y,
+                                                              (mcu_x - first_column) * horizontal + block_x] \
+                                            = np.array(coefficients)[NATURAL_ORDER]
+                    except CorruptStreamException:
+                        if not self.recover:
+                            raise
+                        self.__add_corrupt_interval(interval)
+                        lost = True
+                span.count("blocks", decoded)
+
+            if mcu_line == self.mcu_lines - 1 and not (skipping or lost):
+                self.__check_interval_end(reader, interval)
+            if kept:
+                yield rows
+
+    def read_coefficients(self, columns=None, lines=None):
+        """
+        Entropy decodes the image, or the MCUs of some columns and lines of it (see coefficient_rows), for lossless
+        transforms (see src.domain.codec.lossless).
+        :return: One int32 array per component of shape (block lines, blocks per line, 8, 8) with the quantized
+        coefficients in natural order, covering whole MCUs
+        """
+        rows = list(self.coefficient_rows(columns, lines))
+        return [np.concatenate([row[index] for row in rows]).reshape(-1, rows[0][index].shape[1], 8, 8)
+                for index in range(0, len(self.components))]
+
+    def __read_restart_marker(self, reader, interval):
+        """
+        Reads the RSTn marker starting an interval, skipping the coded data before it. With recover, searches for
+        the marker if another one comes first.
+        :return: Whether the interval can be decoded, False if its marker was not found (recover only)
+        :raise: CorruptStreamException if the marker is not the next one, unless recover is set
+        """
+        expected = RST0 + (interval - 1) % 8
+        code = reader.read_marker()
+        if code == expected:
+            return True
+
+        # The interval before ended late
+        self.__report_corrupt(interval - 1, "Expected RST{0} marker".format(expected - RST0))
+        while code is not None and code != EOI and code != expected:
+            code = self.source.read_marker()
+        if code != expected:
+            self.__add_corrupt_interval(interval)
+            return False
+        return True
+
+    def __check_interval_end(self, reader, interval):
+        """
+        Checks that an interval decoded all of its MCUs before reaching the marker after it. The end of the file is
+        not checked, truncated files decode to zeros.
+        :raise: CorruptStreamException if it did not, unless recover is set
+        """
+        if reader.pending_marker is not None:
+            self.__report_corrupt(interval, "Restart interval {0} ended before its last MCU".format(interval))
+
+    def __seek_interval(self, interval):
+        """
+        Seeks to an interval with the restart index, checking that the RSTn marker before it is there.
+        :return: Whether the interval can be decoded, False if the index is wrong (recover only)
+        :raise: CorruptStreamException if the index is wrong, unless recover is set
+        """
+        offset = self.__scan_start + self.restart_offsets[interval]
+        self.source.seek(offset - 2)
+        if self.source.read(2) != bytes((0xFF, RST0 + (interval - 1) % 8)):
+            self.__report_corrupt(interval, "The restart index does not point to RST{0} for interval {1}".format(
+                (interval - 1) % 8, interval))
+            return False
+        return True
+
+    def __report_corrupt(self, interval, message):
+        """
+        :raise: CorruptStreamException with the message, unless recover is set: the interval is then added to
+        corrupt_intervals
+        """
+        if not self.recover:
+            raise CorruptStreamException(message)
+        self.__add_corrupt_interval(interval)
+
+    def __add_corrupt_interval(self, interval):
+        if interval not in self.corrupt_intervals:
+            self.corrupt_intervals.append(interval)
+
+    def __decode_intervals(self, columns=None, lines=None):
+        """
+        Entropy decodes the restart intervals with MCUs in the columns and lines, self.workers at a time, into the
+        coefficients of the whole image.
+        """
+        mcu_count = self.mcus_per_line * self.mcu_lines
+        needed = [interval for interval in range(0, self.interval_count)
+                  if self.__intersects(interval * self.restart_interval, (interval + 1) * self.restart_interval,
+                                       columns, lines)]
+        intervals = self.__read_intervals(needed[-1] + 1)
+        interleaved = len(self.scan_components) > 1
+
+        # (component index, block line, block) of every block of an MCU, in coding order
+        units = [(index, block_y, block_x) for index in self.scan_components
+                 for block_y in range(0, self.components[index].vertical if interleaved else 1)
+                 for block_x in range(0, self.components[index].horizontal if interleaved else 1)]
+        blocks = [(index, self.dc_tables[self.components[index].dc_table],
+                   self.ac_tables[self.components[index].ac_table]) for index, _, _ in units]
+        # The intervals that could not be found are left zero
+        needed = [interval for interval in needed if intervals[interval] is not None]
+        tasks = ((interval, intervals[interval],
+                  min(self.restart_interval, mcu_count - interval * self.restart_interval), blocks, self.recover)
+                 for interval in needed)
+
+        buffers = self.__get_buffers()
+        with self.instrumentation.stage("entropy_decode", workers=self.workers, intervals=len(needed)) as span:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for interval, (coefficients, complete) in zip(needed, executor.map(_decode_interval_task, tasks)):
+                    first_mcu = interval * self.restart_interval
+                    mcus = np.arange(first_mcu, first_mcu + len(coefficients))
+                    mcu_lines, mcu_columns = np.divmod(mcus, self.mcus_per_line)
+                    for k, (index, block_y, block_x) in enumerate(units):
+                        vertical, horizontal = (self.components[index].vertical, self.components[index].horizontal) \
+                            if interleaved else (1, 1)
+                        buffers[index][mcu_lines * vertical + block_y, mcu_columns * horizontal + block_x] = \
+                            coefficients[:, k]
+                    if not complete:
+                        self.__add_corrupt_interval(interval)
+                    span.count("blocks", coefficients.shape[0] * coefficients.shape[1])
+
+    def __read_intervals(self, count):
+        """
+        Splits the scan into its restart intervals, checking the RSTn markers between them like coefficient_rows.
+        :param count: Number of restart intervals wanted, the data after them is not read if the file has a
+        restart index
+        :return: list of the coded bytes of the first count intervals of the scan, each followed by the marker
+        after it so that an interval ending early runs into it; None for the intervals that were not found
+        (recover only)
+        :raise: CorruptStreamException if a marker is missing or out of sequence, or the restart index does not
+        point to the markers, unless recover is set
+        """
+        if self.restart_offsets is not None:
+            if count < len(self.restart_offsets):
+                data = self.source.read(self.restart_offsets[count])
+            else:
+                data = self.source.read_rest()
+            intervals = []
+            for interval, start in enumerate(self.restart_offsets[:count]):
+                end = self.restart_offsets[interval + 1] if interval + 1 < len(self.restart_offsets) else len(data)
+                if interval > 0 and data[start - 2:start] != bytes((0xFF, RST0 + (interval - 1) % 8)):
+                    self.__report_corrupt(interval, "The restart index does not point to RST{0} for interval "
+                                                    "{1}".format((interval - 1) % 8, interval))
+                    intervals.append(None)
+                else:
+                    intervals.append(data[start:end])
+            return intervals
+
+        data = self.source.read_rest()
+        intervals = [None] * count
+        # The interval starting at start, and whether its start is still being searched for after a marker out of
+        # sequence (the data before the marker it should start at is dropped, as coefficient_rows does)
+        interval, start, searching = 0, 0, False
+        for match in RESTART_MARKERS.finditer(data):
+            if interval == count:
+                break
+            expected = RST0 + interval % 8
+            if searching:
+                if data[match.start() + 1] == expected:
+                    interval, start, searching = interval + 1, match.end(), False
+            elif data[match.start() + 1] == expected:
+                intervals[interval] = data[start:match.end()]
+                interval, start = interval + 1, match.end()
+            else:
+                intervals[interval] = data[start:match.end()]
+                self.__report_corrupt(interval, "Expected RST{0} marker".format(expected - RST0))
+                searching = True
+        if not searching and interval < count:
+            intervals[interval] = data[start:]
+            interval += 1
+        for missing in range(interval + 1 if searching else interval, count):
+            self.__report_corrupt(missing, "Expected RST{0} marker".format((missing - 1) % 8))
+        return intervals
+
+    def __intersects(self, first_mcu, last_mcu, columns, lines):
+        """
+        :return: Whether any of the MCUs first_mcu to last_mcu (excluded) is in the columns and lines
+        """
+        first_column, last_column = (0, self.mcus_per_line) if columns is None else columns
+        first_line, last_line = (0, self.mcu_lines) if lines is None else lines
+        last_mcu = min(last_mcu, self.mcus_per_line * self.mcu_lines)
+        for line in range(max(first_mcu // self.mcus_per_line, first_line),
+                          min((last_mcu - 1) // self.mcus_per_line + 1, last_line)):
+            start = max(first_mcu - line * self.mcus_per_line, 0)
+            end = min(last_mcu - line * self.mcus_per_line, self.mcus_per_line)
+            if start < last_column and end > first_column:
+                return True
+        return False
+
+    # <editor-fold desc="Progressive">
+    def read_scans(self, count=None):
+        """
+        Entropy decodes the next scans of a progressive file into the coefficients of the image. Stops without an
+        error at the end of the image or of the data, whichever comes first.
+        :param count: Most scans to read, None for all of them
+        :return: The number of scans read
+        """
+        read = 0
+        while self.scan is not None and (count is None or read < count):
+            reader = BitReader(self.source)
+            with self.instrumentation.stage("entropy_decode", scan=self.scans_read) as span:
+                span.count("blocks", self.__read_scan(reader, self.scan))
+            self.scans_read += 1
+            read += 1
+            self.scan = None
+            if not reader.exhausted:
+                self.__read_segments(reader.read_marker())
+        return read
+
+    def preview(self, scans=1):
+        """
+        Renders the image from the coefficients of its first scans, reading more of them if needed. Can be called
+        again once more scans are wanted (or have arrived).
+        :param scans: Scans to render the image from; sequential files only have one
+        :return: uint8 array of shape (channels, height, width)
+        """
+        if not self.progressive:
+            return self.decode()
+        self.read_scans(max(0, scans - self.scans_read))
+        return self.decode(self.__buffered_rows())
+
+    def __get_buffers(self):
+        """
+        :return: One int32 array per component of shape (block lines, blocks per line, 64) with the coefficients of
+        the whole image in zig-zag order, covering whole MCUs
+        """
+        if self.__coefficients is None:
+            interleaved = len(self.components) > 1
+            self.__coefficients = [np.zeros((self.mcu_lines * (c.vertical if interleaved else 1),
+                                             self.mcus_per_line * (c.horizontal if interleaved else 1), 64),
+                                            dtype=np.int32) for c in self.components]
+        return self.__coefficients
+
+    def __read_scan(self, reader, scan):
+        """
+        :return: The number of blocks read
+        """
+        buffers = self.__get_buffers()
+        if len(scan.components) > 1:
+            # Interleaved (DC scans only): every MCU holds the blocks of every component of the scan
+            units = ((mcu_line, mcu_x) for mcu_line in range(0, self.mcu_lines)
+                     for mcu_x in range(0, self.mcus_per_line))
+            blocks = [[(index, block_y, block_x) for block_y in range(0, self.components[index].vertical)
+                       for block_x in range(0, self.components[index].horizontal)] for index in scan.components]
+            blocks = [block for component_blocks in blocks for block in component_blocks]
+        else:
+            # Every block of the component covering the image is an MCU
+            index = scan.components[0]
+            component = self.components[index]
+            interleaved = len(self.components) > 1
+            lines = get_component_blocks(self.height, component.vertical, self.max_vertical) if interleaved \
+                else self.mcu_lines
+            blocks_per_line = get_component_blocks(self.width, component.horizontal, self.max_horizontal) \
+                if interleaved else self.mcus_per_line
+            units = ((line, x) for line in range(0, lines) for x in range(0, blocks_per_line))
+            blocks = [(index, 0, 0)]
+
+        predictors = [0] * len(self.components)
+        eob_run = 0
+        restarts_left = self.restart_interval
+        next_restart = 0
+        count = 0
+        for line, x in units:
+            if reader.exhausted:
+                break
+            if self.restart_interval:
+                if restarts_left == 0:
+                    code = reader.read_marker()
+                    if code != RST0 + next_restart:
+                        raise CorruptStreamException("Expected RST{0} marker".format(next_restart))
+                    next_restart = (next_restart + 1) % 8
+                    predictors = [0] * len(self.components)
+                    eob_run = 0
+                    restarts_left = self.restart_interval
+                restarts_left -= 1
+
+            for index, block_y, block_x in blocks:
+                component = self.components[index]
+                if len(scan.components) > 1:
+                    block = buffers[index][line * component.vertical + block_y, x * component.horizontal + block_x]
+                else:
+                    block = buffers[index][line, x]
+                if scan.is_dc and not scan.is_refinement:
+                    predictors[index] = decode_dc_first(reader, block, predictors[index],
+                                                        self.dc_tables[component.dc_table], scan.approximation_low)
+                elif scan.is_dc:
+                    decode_dc_refinement(reader, block, scan.approximation_low)
+                elif not scan.is_refinement:
+                    eob_run = decode_ac_first(reader, block, eob_run, self.ac_tables[component.ac_table], scan)
+                else:
+                    eob_run = decode_ac_refinement(reader, block, eob_run, self.ac_tables[component.ac_table], scan)
+                count += 1
+        return count
+
+    def __buffered_rows(self, columns=None, lines=None):
+        """
+        :return: Generator yielding the coefficients read so far like coefficient_rows
+        """
+        first_column, last_column = (0, self.mcus_per_line) if columns is None else columns
+        first_line, last_line = (0, self.mcu_lines) if lines is None else lines
+        interleaved = len(self.components) > 1
+        buffers = self.__get_buffers()
+        for mcu_line in range(first_line, last_line):
+            rows = []
+            for c, buffer in zip(self.components, buffers):
+                vertical, horizontal = (c.vertical, c.horizontal) if interleaved else (1, 1)
+                rows.append(buffer[mcu_line * vertical:(mcu_line + 1) * vertical,
+                                   first_column * horizontal:last_column * horizontal][..., NATURAL_ORDER])
+            yield rows
+
+    # </editor-fold>
+
+    def sample_rows(self, rows=None):
+        """
+        :param rows: Coefficient rows to render, defaults to coefficient_rows()
+        :return: Generator yielding one array per MCU row, of shape (channels, MCU height, width) with the samples
+        of every component, upsampled to full resolution and cropped to the image width (both scaled down by
+        scale_denominator).
+        """
+        for planes in self.__render(self.coefficient_rows() if rows is None else rows):
+            yield planes[:, :, :self.output_width]
+
+    def __render(self, coefficient_rows):
+        """
+        :return: Generator yielding the samples of every MCU row of coefficient_rows, like sample_rows but not
+        cropped
+        """
+        max_horizontal, max_vertical = self.max_horizontal, self.max_vertical
+        size = 8 // self.scale_denominator
+        for rows in coefficient_rows:
+            with self.instrumentation.stage("idct", engine=self.engine.name, size=size) as span:
+                planes = []
+                for component, coefficients in zip(self.components, rows):
+                    table = self.quantization_tables[component.quantization_table]
+                    coefficients = coefficients.reshape(coefficients.shape[:2] + (8, 8))
+                    if size < 8:
+                        # The other coefficients are never dequantized
+                        blocks = inverse_reduced_blocks(coefficients[..., :size, :size] * table[:size, :size], size)
+                        if self.engine.integer:
+                            blocks = np.rint(blocks).astype(np.int64)
+                    elif self.engine.integer:
+                        blocks = self.engine.inverse_integers(coefficients * np.asarray(table, dtype=np.int64))
+                    else:
+                        blocks = self.engine.inverse_blocks(coefficients * table)
+                    span.count("blocks", blocks.shape[0] * blocks.shape[1])
+                    # (block lines, blocks, size, size) -> (lines, samples)
+                    samples = blocks.transpose(0, 2, 1, 3).reshape(blocks.shape[0] * size, blocks.shape[1] * size)
+                    samples = np.clip(samples + 128, 0, 255)
+                    if len(self.components) > 1:
+                        samples = np.repeat(np.repeat(samples, max_vertical // component.vertical, axis=0),
+                                            max_horizontal // component.horizontal, axis=1)
+                    planes.append(samples)
+                planes = np.stack(planes)
+            yield planes
+
+    def scanlines(self, rows=None):
+        """
+        Decodes the image.
+        :param rows: Coefficient rows to decode, defaults to coefficient_rows()
+        :return: Generator yielding every line of the image as a uint8 array of shape (output width, channels), RGB
+        for colour images
+        """
+        line = 0
+        for planes in self.sample_rows(rows):
+            for samples in self.__to_output(planes).transpose(1, 2, 0):
+                if line == self.output_height:
+                    return
+                yield samples
+                line += 1
+
+    def decode(self, rows=None):
+        """
+        Decodes the whole image at once.
+        :param rows: Coefficient rows to decode, defaults to coefficient_rows()
+        :return: uint8 array of shape (channels, output height, output width)
+        """
+        with self.instrumentation.stage("decode", width=self.width, height=self.height,
+                                        engine=self.engine.name, scale_denominator=self.scale_denominator) as span:
+            span.count("pixels", self.output_width * self.output_height)
+            planes = np.empty((len(self.components), self.output_height, self.output_width), dtype=np.uint8)
+            for line, samples in enumerate(self.scanlines(rows)):
+                planes[:, line, :] = samples.T
+            return planes
+
+    def decode_region(self, left, top, width, height):
+        """
+        Decodes a rectangle of the image. Only the MCUs it overlaps are dequantized and inverse transformed. A
+        sequential file is entropy decoded up to the last MCU line of the rectangle, skipping the restart intervals
+        without any MCU of the rectangle (files of JPEGEncoder have one every few MCU lines). Progressive files are
+        entropy decoded whole.
+        :param left: First column, in the (scaled) output image
+        :param top: First line
+        :return: uint8 array of shape (channels, height, width)
+        :raise: ValueError if the rectangle is empty or not inside the image
+        """
+        if width <= 0 or height <= 0 or left < 0 or top < 0 or left + width > self.output_width or \
+                top + height > self.output_height:
+            raise ValueError("Region {0}x{1}+{2}+{3} is not inside the {4}x{5} image".format(
+                width, height, left, top, self.output_width, self.output_height))
+
+        size = 8 // self.scale_denominator
+        mcu_width, mcu_height = size * self.max_horizontal, size * self.max_vertical
+        columns = (left // mcu_width, -(-(left + width) // mcu_width))
+        lines = (top // mcu_height, -(-(top + height) // mcu_height))
+
+        with self.instrumentation.stage("decode_region", left=left, top=top, width=width, height=height,
+                                        engine=self.engine.name, scale_denominator=self.scale_denominator) as span:
+            span.count("pixels", width * height)
+            region = np.concatenate(list(self.__render(self.coefficient_rows(columns, lines))), axis=1)
+            left -= columns[0] * mcu_width
+            top -= lines[0] * mcu_height
+            return self.__to_output(region[:, top:top + height, left:left + width])
+
+    def __to_output(self, planes):
+        """
+        :param planes: Samples of shape (channels, lines, samples)
+        :return: uint8 array of the same shape, RGB for colour images
+        """
+        if len(planes) == 3:
+            return ycc_to_rgb_integers(planes) if self.engine.integer else yuv_to_rgb(planes)
+        return np.trunc(planes).astype(np.uint8)
+
+
+def read_jpeg(filename: str, engine=None, instrumentation=None, scale_denominator=1, region=None, workers=1,
+              recover=False):
+    """
+    Decodes a JPEG file.
+    :param instrumentation: src.util.instrumentation.Instrumentation recording the stages of the decoder
+    :param scale_denominator: 1, 2, 4 or 8, the file is decoded at 1 / scale_denominator of its size
+    :param region: (left, top, width, height) of the part of the image to decode, None for all of it
+    :param workers: Processes entropy decoding the restart intervals, see JPEGDecoder
+    :param recover: Whether to leave corrupt restart intervals blank instead of raising CorruptStreamException
+    :return: uint8 array of shape (channels, height, width)
+    :raise: ValueError if the region is not inside the image
+    """
+    with open(filename, "rb") as file:
+        decoder = JPEGDecoder(file, engine, instrumentation, scale_denominator, workers, recover)
+        return decoder.decode() if region is None else decoder.decode_region(*region)
@@ -0,0 +1,882 @@
+import io
+import os
+import tracemalloc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from src.domain.codec.dct import get_engine
+from src.domain.codec.jfif import STD_DC_TABLES, STD_AC_TABLES, EOI, RST0, ZIGZAG, Component, marker, \
+    get_headers, get_table_count, count_symbols, merge_frequencies, build_tables, encode_scan, join_intervals, \
+    get_restart_offsets, restart_index_segments, sos_segment
+from src.domain.codec.progressive import get_default_scan_script, validate_scan_script, encode_progressive_scan, \
+    get_progressive_headers
+from src.domain.codec.quantization import Quantizer
+from src.domain.codec.run_length import get_zero_run_statistics
+from src.domain.exceptions.BadImageException import BadImageException
+from src.domain.exceptions.PixelFormatException import PixelFormatException
+from src.domain.models.Image import PixelType, StorageMode
+from src.util.cache import hash_rows, make_key
+from src.util.color_space import rgb_to_yuv, rgb_to_ycc_integers
+from src.util.instrumentation import Instrumentation, NULL_INSTRUMENTATION, get_instrumentation
+from src.util.netpbm import read_netpbm, read_netpbm_rows
+from src.util.padding import get_padded_size, pad_edges
+from src.util.shared_array import SharedArray, AttachedArray
+from src.util.subsampling import DEFAULT_SUBSAMPLING, DEFAULT_FILTER, FILTERS, get_sampling_factors, downsample, \
+    downsample_integers
+
+GRAY_COMPONENTS = [Component(1)]
+
+# MCU rows per stripe. Every stripe is one restart interval, so stripes can be entropy coded independently.
+DEFAULT_STRIPE_ROWS = 4
+
+# Stripes read but not yet written by the streaming encoder, bounds its memory
+DEFAULT_MAX_STRIPES = 2
+
+# Pools the stripes can be encoded in with workers > 1. Threads share the planes directly and overlap in the NumPy
+# stages, which release the GIL; processes also run the Python parts in parallel but need shared memory.
+POOLS = ("process", "thread")
+DEFAULT_POOL = "process"
+
+# Part of every cache key, to be bumped whenever the output of the encoder changes for the same settings
+CACHE_VERSION = 1
+
+
+def get_source_planes(image):
+    """
+    :return: uint8 array of shape (channels, height, width) with the RGB or GRAY samples of an image, which is left
+    unchanged
+    :raise: PixelFormatException if the image is not RGB or GRAY
+    """
+    if image.pixel_type not in (PixelType.RGB, PixelType.GRAY):
+        raise PixelFormatException("Only RGB and GRAY images can be encoded")
+    if image.storage == StorageMode.PLANAR:
+        return image.planes
+    return np.array([[[pixel.r for pixel in line] for line in image.pixels],
+                     [[pixel.g for pixel in line] for line in image.pixels],
+                     [[pixel.b for pixel in line] for line in image.pixels]], dtype=np.uint8)
+
+
+def get_components(channels, subsampling=DEFAULT_SUBSAMPLING):
+    """
+    :return: The frame components of an image: Y, Cb and Cr with the sampling factors of the subsampling mode, or a
+    single component for GRAY images
+    :raise: KeyError for unknown subsampling modes
+    """
+    if channels == 1:
+        return GRAY_COMPONENTS
+    horizontal, vertical = get_sampling_factors(subsampling)
+    return [Component(1, horizontal, vertical, quantization_table=0, dc_table=0, ac_table=0),
+            Component(2, quantization_table=1, dc_table=1, ac_table=1),
+            Component(3, quantization_table=1, dc_table=1, ac_table=1)]
+
+
+class FrameLayout:
+    """
+    How an image is cut into MCUs and stripes: an MCU holds horizontal x vertical blocks of every component, in
+    raster order (e.g. four Y blocks, one Cb and one Cr block for 4:2:0), and covers 8 * the largest sampling factors
+    pixels. Stripes are runs of MCU rows.
+
+    Images of any size are coded as whole MCUs: the samples are padded to the MCU size by repeating the last line and
+    column, a stripe at a time, and the frame header keeps the real size so decoders crop the padding away.
+    """
+
+    def __init__(self, width, height, components, stripe_rows, chroma_filter=DEFAULT_FILTER):
+        self.components = components
+        self.chroma_filter = chroma_filter
+        self.max_horizontal = max(component.horizontal for component in components)
+        self.max_vertical = max(component.vertical for component in components)
+        self.mcu_width = 8 * self.max_horizontal
+        self.mcu_height = 8 * self.max_vertical
+        self.width = width
+        self.height = height
+        self.padded_width = get_padded_size(width, self.mcu_width)
+        self.padded_height = get_padded_size(height, self.mcu_height)
+
+        # Component index of every block of an MCU
+        self.block_components = [index for index, component in enumerate(components)
+                                 for _ in range(0, component.horizontal * component.vertical)]
+        self.mcus_per_line = self.padded_width // self.mcu_width
+        self.mcu_lines = self.padded_height // self.mcu_height
+
+        stripe_rows = stripe_rows if stripe_rows else self.mcu_lines
+        self.stripes = [(line, min(line + stripe_rows, self.mcu_lines))
+                        for line in range(0, self.mcu_lines, stripe_rows)]
+        self.restart_interval = stripe_rows * self.mcus_per_line if len(self.stripes) > 1 else 0
+
+        # Lines around a stripe the vertical chroma filter looks at
+        self.context = self.max_vertical if chroma_filter == "triangle" and self.max_vertical > 1 else 0
+
+    @property
+    def blocks_per_mcu(self):
+        return len(self.block_components)
+
+    @property
+    def mcu_count(self):
+        return self.mcus_per_line * self.mcu_lines
+
+    def get_mcus(self, stripe):
+        """
+        :return: (first MCU, last MCU) of a stripe
+        """
+        return stripe[0] * self.mcus_per_line, stripe[1] * self.mcus_per_line
+
+    def get_lines(self, stripe):
+        """
+        :return: (first line, last line, context lines above, context lines below) of the samples a stripe needs. The
+        last line is never past the image, the lines missing up to the end of the padded stripe are padding.
+        """
+        first, last = stripe[0] * self.mcu_height, stripe[1] * self.mcu_height
+        top = min(self.context, first)
+        bottom = min(self.context, self.padded_height - last)
+        return first - top, min(last + bottom, self.height), top, bottom
+
+    def get_stripe_samples(self, samples, stripe):
+        """
+        :param samples: Array of shape (channels, height, width) with the samples of the whole image
+        :return: (samples of the stripe and its context lines padded to whole MCUs, context lines above, context lines
+        below), the arguments transform_stripe takes
+        """
+        first, last, top, bottom = self.get_lines(stripe)
+        lines = top + (stripe[1] - stripe[0]) * self.mcu_height + bottom
+        return pad_edges(samples[:, first:last], lines, self.padded_width), top, bottom
+
+
+class StripeReader:
+    """
+    Gives the samples of the stripes of a FrameLayout, in order, from an image that is never held in memory as a
+    whole: either an array (e.g. a memory-mapped file, sliced a stripe at a time) or an iterator of lines, of which
+    only the lines of the current stripe and the context of the chroma filter are kept.
+    """
+
+    def __init__(self, rows, layout):
+        """
+        :param rows: uint8 array of shape (height, width, channels), or an iterator of lines of shape (width,
+        channels) or chunks of lines of shape (lines, width, channels)
+        :param layout: FrameLayout of the image
+        """
+        self.layout = layout
+        self.__array = rows.transpose(2, 0, 1) if isinstance(rows, np.ndarray) else None
+        self.__rows = iter(rows) if self.__array is None else None
+        self.__lines = None
+        self.__first_line = 0
+
+    def read(self, stripe):
+        """
+        :return: (samples, context lines above, context lines below) of a stripe, as FrameLayout.get_stripe_samples
+        :raise: BadImageException if the iterator ends early or gives lines of the wrong size
+        """
+        if self.__array is not None:
+            return self.layout.get_stripe_samples(self.__array, stripe)
+
+        first, last, top, bottom = self.layout.get_lines(stripe)
+        chunks = [] if self.__lines is None else [self.__lines[first - self.__first_line:]]
+        count = sum(len(chunk) for chunk in chunks)
+        while first + count < last:
+            chunk = next(self.__rows, None)
+            if chunk is None:
+                raise BadImageException("Expected {0} lines, got {1}".format(self.layout.height, first + count))
+            chunk = np.asarray(chunk, dtype=np.uint8)
+            if chunk.ndim == 2:
+                chunk = chunk[np.newaxis]
+            if chunk.shape[1:] != (self.layout.width, len(self.layout.components)):
+                raise BadImageException("Expected lines of shape {0}, got {1}".format(
+                    (self.layout.width, len(self.layout.components)), chunk.shape[1:]))
+            chunks.append(chunk)
+            count += len(chunk)
+
+        self.__lines = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+        self.__first_line = first
+        samples = self.__lines[:last - first].transpose(2, 0, 1)
+        lines = top + (stripe[1] - stripe[0]) * self.layout.mcu_height + bottom
+        return pad_edges(samples, lines, self.layout.padded_width), top, bottom
+
+
+# <editor-fold desc="Stripe stages">
+def transform_stripe(samples, engine, layout, top=0, bottom=0):
+    """
+    Runs colour conversion, chroma downsampling and forward DCT on a stripe of the image.
+    With an integer engine every stage only uses integer arithmetic: fixed-point colour conversion, integer
+    downsampling and the integer DCT, so the coefficients are the same on every platform.
+    :param samples: uint8 array of shape (channels, lines, width), lines and width multiples of the MCU size once
+    the context lines are left out (see FrameLayout.get_stripe_samples)
+    :param layout: FrameLayout of the image
+    :param top: Context lines above the stripe, only used by the chroma filter
+    :param bottom: Context lines below the stripe
+    :return: float64 array of shape (MCUs, blocks per MCU, 8, 8) with the DCT coefficients; for integer engines an
+    int64 array with the coefficients scaled by engine.scale
+    """
+    if len(samples) == 3:
+        planes = rgb_to_ycc_integers(samples) if engine.integer else rgb_to_yuv(samples)
+    else:
+        planes = samples
+
+    mcu_blocks = []
+    for plane, component in zip(planes, layout.components):
+        horizontal, vertical = component.horizontal, component.vertical
+        plane = plane.astype(np.int64 if engine.integer else np.float64)
+        if horizontal < layout.max_horizontal or vertical < layout.max_vertical:
+            plane = (downsample_integers if engine.integer else downsample)(
+                plane, layout.max_horizontal // horizontal, layout.max_vertical // vertical, layout.chroma_filter,
+                top, bottom)
+        else:
+            plane = plane[top:len(plane) - bottom]
+
+        # (lines, width) -> (MCU rows, MCUs per line, vertical, horizontal, 8, 8) -> (MCUs, blocks, 8, 8)
+        lines, width = plane.shape
+        blocks = plane.reshape(lines // (8 * vertical), vertical, 8, width // (8 * horizontal), horizontal, 8)
+        mcu_blocks.append(blocks.transpose(0, 3, 1, 4, 2, 5).reshape(-1, vertical * horizontal, 8, 8))
+
+    blocks = np.concatenate(mcu_blocks, axis=1)
+    if engine.integer:
+        return engine.forward_integers(blocks - 128)
+    return engine.forward_blocks(blocks - 128)
+
+
+def quantize_coefficients(coefficients, quantizer, layout, scale=1):
+    """
+    :param coefficients: Array of shape (MCUs, blocks per MCU, 8, 8), as returned by transform_stripe. Integer
+    coefficients are quantized with integer arithmetic only.
+    :param scale: Factor integer coefficients are scaled by (the scale of the integer engine)
+    :return: int16 array of shape (MCUs, blocks per MCU, 64) with the quantized coefficients in zig-zag order
+    """
+    table_ids = [layout.components[index].quantization_table for index in layout.block_components]
+    if np.issubdtype(coefficients.dtype, np.integer):
+        quantized = quantizer.quantize_integers(coefficients, quantizer.get_integer_tables(table_ids), scale)
+    else:
+        quantized = quantizer.quantize(coefficients, quantizer.get_reciprocals(table_ids))
+    return quantized.reshape(quantized.shape[:2] + (64,))[:, :, ZIGZAG]
+
+
+def quantize_stripe(samples, quantizer, layout, engine, top=0, bottom=0, instrumentation=None):
+    """
+    Runs colour conversion, chroma downsampling, forward DCT and quantization on a stripe of the image.
+    :param instrumentation: src.util.instrumentation.Instrumentation recording the "transform" and "quantize" stages
+    :return: int16 array of shape (MCUs, blocks per MCU, 64) with the quantized coefficients in zig-zag order
+    """
+    instrumentation = get_instrumentation(instrumentation)
+    with instrumentation.stage("transform") as span:
+        coefficients = transform_stripe(samples, engine, layout, top, bottom)
+        span.count("blocks", len(coefficients) * layout.blocks_per_mcu)
+    with instrumentation.stage("quantize") as span:
+        quantized = quantize_coefficients(coefficients, quantizer, layout, engine.scale if engine.integer else 1)
+        if instrumentation.enabled:
+            span.count("zero_coefficients", int(quantized.size - np.count_nonzero(quantized)))
+    return quantized
+
+
+def code_stripe(stripe, layout, tables, instrumentation=None):
+    """
+    :param tables: (DC tables, AC tables), None to count the symbols instead
+    :param instrumentation: src.util.instrumentation.Instrumentation recording the "entropy_encode" (or
+    "count_symbols") stage with the zero-run statistics of the stripe and the bits it is coded in
+    :return: The coded bytes of the stripe, or its symbol statistics
+    """
+    instrumentation = get_instrumentation(instrumentation)
+    with instrumentation.stage("count_symbols" if tables is None else "entropy_encode") as span:
+        if instrumentation.enabled:
+            span.update(get_zero_run_statistics(stripe))
+        if tables is None:
+            return count_symbols(layout.components, stripe, block_components=layout.block_components)
+        data = encode_scan(layout.components, stripe, *tables, block_components=layout.block_components)
+        span.count("output_bits", len(data) * 8)
+        return data
+
+
+def _get_task_instrumentation(trace):
+    """
+    :param trace: Whether the stages of the task are recorded
+    :return: Instrumentation for a task, whose events are sent back with its result. Memory is traced if it is traced
+    in the process running the task (only ever the case in the process of the encoder).
+    """
+    return Instrumentation(trace_memory=tracemalloc.is_tracing()) if trace else NULL_INSTRUMENTATION
+
+
+def _quantize_task(task):
+    source, target, stripe, quantizer, layout, engine, tables, trace = task
+    instrumentation = _get_task_instrumentation(trace)
+    first_mcu, last_mcu = layout.get_mcus(stripe)
+    with instrumentation.stage("stripe", first_row=stripe[0], last_row=stripe[1]):
+        with AttachedArray(source) as samples, AttachedArray(target) as coefficients:
+            stripe_samples, top, bottom = layout.get_stripe_samples(samples, stripe)
+            quantized = quantize_stripe(stripe_samples, quantizer, layout, engine, top, bottom, instrumentation)
+            del stripe_samples
+            coefficients[first_mcu:last_mcu] = quantized
+            del samples, coefficients
+        result = code_stripe(quantized, layout, tables, instrumentation)
+    return result, instrumentation.events
+
+
+def _stripe_task(task):
+    stripe, samples, top, bottom, quantizer, layout, engine, tables, trace = task
+    instrumentation = _get_task_instrumentation(trace)
+    with instrumentation.stage("stripe", first_row=stripe[0], last_row=stripe[1]):
+        quantized = quantize_stripe(samples, quantizer, layout, engine, top, bottom, instrumentation)
+        result = code_stripe(quantized, layout, tables, instrumentation)
+    return result, instrumentation.events
+
+
+def _scan_task(task):
+    source, layout, scan, trace = task
+    instrumentation = _get_task_instrumentation(trace)
+    with instrumentation.stage("entropy_encode", scan=str(scan)) as span:
+        with AttachedArray(source) as coefficients:
+            data = encode_progressive_scan(layout.width, layout.height, layout.components, coefficients, scan,
+                                           layout.block_components)
+            del coefficients
+        span.count("output_bits", len(data) * 8)
+    return data, instrumentation.events
+
+
+def _encode_task(task):
+    source, stripe, layout, tables, trace = task
+    instrumentation = _get_task_instrumentation(trace)
+    first_mcu, last_mcu = layout.get_mcus(stripe)
+    with instrumentation.stage("stripe", first_row=stripe[0], last_row=stripe[1]):
+        with AttachedArray(source) as coefficients:
+            quantized = np.array(coefficients[first_mcu:last_mcu])
+            del coefficients
+        result = code_stripe(quantized, layout, tables, instrumentation)
+    return result, instrumentation.events
+
+
+# </editor-fold>
+
+
+class JPEGEncoder:
+    """
+    Encodes whole images into baseline (or progressive) JFIF files, working on numpy planes a stripe of MCU rows at a
+    time.
+
+    With workers > 1 the stripes are spread over a process pool: the samples and the quantized coefficients live in
+    shared memory and only stripe coordinates and the coded bytes are sent between processes. With pool="thread"
+    they are spread over a thread pool instead, working on the arrays themselves. The output only depends on the
+    encoder settings, never on the number of workers or the pool.
+
+    An encoder keeps no state between images and encoding keeps no global state, so one encoder can encode several
+    images at once from different threads.
+
+    With an instrumentation, every stripe records its stages (transform, quantize, entropy_encode) where it runs,
+    worker processes included, and sends the events back with its result.
+
+    With a cache (src.util.cache.DiskCache), encoded files are kept under a hash of the samples and of every setting
+    the output depends on, and encoding the same image again only reads the file. The DCT coefficients of in-memory
+    images (encode, encode_qualities) are kept as well, under the hash of the samples and the settings of the
+    transform, so encoding an image again at another quality or with other Huffman tables skips the colour
+    conversion, downsampling and DCT. Cached files are the same bytes as the files encoded without a cache.
+
+    With progressive=True the file is coded in the scans of a scan script (see src.domain.codec.progressive), each
+    with Huffman tables built for it, so decoders can show the image before all of it arrived. Every scan needs the
+    coefficients of the whole image: the stripes are quantized first, then the scans are coded, in parallel with
+    workers > 1. The streaming encoder keeps the quantized coefficients of the whole image (2 bytes per sample)
+    in progressive mode.
+    """
+
+    def __init__(self, engine=None, optimize_huffman=False, stripe_rows=DEFAULT_STRIPE_ROWS, workers=1, quality=None,
+                 quantizer=None, subsampling=DEFAULT_SUBSAMPLING, chroma_filter=DEFAULT_FILTER, pool=DEFAULT_POOL,
+                 instrumentation=None, cache=None, progressive=False, scan_script=None, restart_index=False):
+        """
+        :param engine: DCT engine name or instance (see src.domain.codec.dct)
+        :param optimize_huffman: Whether to build per-image Huffman tables instead of the standard ones
+        :param stripe_rows: MCU rows per stripe; each stripe is one restart interval. 0 codes the image as a single
+        stripe without restart markers (serial only).
+        :param workers: Number of worker processes, 1 to encode in this process, None for one per CPU
+        :param quality: IJG quality (1-100) of the standard quantization tables, None for the default tables
+        :param quantizer: Quantizer to use instead of Quantizer(quality)
+        :param subsampling: Chroma subsampling of colour images, "4:4:4", "4:2:2" or "4:2:0"
+        :param chroma_filter: Filter the chroma planes are downsampled with, "box" or "triangle"
+        :param pool: Pool the stripes are encoded in with workers > 1, "process" or "thread"
+        :param instrumentation: src.util.instrumentation.Instrumentation recording the stages of every encoded image
+        :param cache: src.util.cache.DiskCache keeping the encoded files and DCT coefficients, None to cache nothing
+        :param progressive: Whether to write progressive files instead of baseline ones; their Huffman tables are
+        always optimized and they have no restart markers
+        :param scan_script: list of progressive.Scan to code progressive files in, None for the default script
+        :param restart_index: Whether to write the offsets of the restart intervals (the stripes) in an APP9 segment,
+        so decoders can seek to any stripe (see jfif.restart_index_segments). Baseline files with several stripes
+        only; the streaming encoder then needs a seekable output, it fills the index in once the stripes are written.
+        :raise: KeyError for unknown engines, subsampling modes, filters or pools
+        """
+        self.engine = get_engine(engine)
+        self.optimize_huffman = optimize_huffman
+        self.stripe_rows = stripe_rows
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.quantizer = quantizer if quantizer is not None else Quantizer(quality)
+        get_sampling_factors(subsampling)
+        if chroma_filter not in FILTERS:
+            raise KeyError("Unknown filter {0}, expected one of {1}".format(chroma_filter, ", ".join(FILTERS)))
+        self.subsampling = subsampling
+        self.chroma_filter = chroma_filter
+        if pool not in POOLS:
+            raise KeyError("Unknown pool {0}, expected one of {1}".format(pool, ", ".join(POOLS)))
+        self.pool = pool
+        self.instrumentation = get_instrumentation(instrumentation)
+        self.cache = cache
+        self.progressive = progressive
+        self.scan_script = scan_script
+        self.restart_index = restart_index
+
+    def encode(self, image):
+        """
+        :param image: RGB or GRAY Image of any size
+        :return: bytes of the .jpg file
+        """
+        samples, layout = self.__get_layout(image)
+        if self.cache is not None:
+            return self.__encode_cached(samples, layout, [self.quantizer])[0]
+        _, height, width = samples.shape
+        shape = (layout.mcu_count, layout.blocks_per_mcu, 64)
+
+        with self.__stage("encode", layout) as span:
+            if self.progressive:
+                executor = self.__get_executor()
+                try:
+                    quantized = self.__quantize(lambda stripe: layout.get_stripe_samples(samples, stripe), layout,
+                                                self.quantizer)
+                    data = self.__encode_progressive(quantized, layout, self.quantizer, executor)
+                finally:
+                    if executor is not None:
+                        executor.shutdown()
+                span.count("output_bits", len(data) * 8)
+                return data
+
+            if self.workers > 1 and self.pool == "process":
+                source = SharedArray.from_array(samples)
+                target = SharedArray(shape, np.int16)
+                with source, target, ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    intervals, tables = self.__encode_stripes(executor.map, source.spec, target.spec, layout,
+                                                              self.quantizer)
+            elif self.workers > 1:
+                target = np.empty(shape, dtype=np.int16)
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    intervals, tables = self.__encode_stripes(executor.map, samples, target, layout, self.quantizer)
+            else:
+                target = np.empty(shape, dtype=np.int16)
+                intervals, tables = self.__encode_stripes(map, samples, target, layout, self.quantizer)
+
+            data = self.__assemble(width, height, layout, self.quantizer, tables, intervals, self.restart_index)
+            span.count("output_bits", len(data) * 8)
+            return data
+
+    def encode_qualities(self, image, qualities):
+        """
+        Encodes an image at several IJG qualities. The DCT runs once, its coefficients are kept and quantized again
+        for every quality, so only quantization and entropy coding are repeated.
+        :param qualities: Iterable of IJG qualities (1-100), None for the default tables
+        :return: list of bytes of the .jpg files, in the order of the qualities
+        """
+        samples, layout = self.__get_layout(image)
+        quantizers = [self.quantizer.with_quality(quality) for quality in qualities]
+        if self.cache is not None:
+            return self.__encode_cached(samples, layout, quantizers)
+
+        # The coefficients are kept as the transform gives them: rounding them to float32 changes some quantized
+        # values at high qualities, and the files would differ from those of encode
+        coefficients = self.__transform(samples, layout, np.int64 if self.engine.integer else np.float64)
+        return self.__encode_coefficients(coefficients, layout, quantizers)
+
+    def __encode_cached(self, samples, layout, quantizers):
+        """
+        Reads the files that are cached, then encodes the others from the cached DCT coefficients of the image,
+        transforming the image only if they are not cached either. The coefficients are kept as the transform gives
+        them (float64 or int64), so the files are the same as without a cache.
+        :return: list of bytes of the .jpg files, in the order of the quantizers
+        """
+        with self.instrumentation.stage("cache_lookup") as span:
+            image_key = hash_rows(samples.transpose(1, 2, 0))
+            keys = [self.__get_file_key(image_key, layout, quantizer) for quantizer in quantizers]
+            results = [self.cache.get(key) for key in keys]
+            missing = [index for index, data in enumerate(results) if data is None]
+            span.count("cached_files", len(results) - len(missing))
+            if not missing:
+                return results
+
+            coefficients_key = make_key(CACHE_VERSION, "dct", image_key, self.engine.name,
+                                        self.__get_subsampling(layout), self.chroma_filter)
+            coefficients = self.cache.get_array(coefficients_key)
+            span.count("cached_coefficients", int(coefficients is not None))
+
+        if coefficients is None:
+            coefficients = self.__transform(samples, layout, np.int64 if self.engine.integer else np.float64)
+            self.cache.put_array(coefficients_key, coefficients)
+
+        encoded = self.__encode_coefficients(coefficients, layout, [quantizers[index] for index in missing])
+        for index, data in zip(missing, encoded):
+            self.cache.put(keys[index], data)
+            results[index] = data
+        return results
+
+    def __transform(self, samples, layout, dtype):
+        """
+        :return: Array of shape (MCUs, blocks per MCU, 8, 8) with the DCT coefficients of the whole image
+        """
+        coefficients = np.empty((layout.mcu_count, layout.blocks_per_mcu, 8, 8), dtype=dtype)
+        with self.instrumentation.stage("transform") as span:
+            span.count("blocks", layout.mcu_count * layout.blocks_per_mcu)
+            for stripe in layout.stripes:
+                first_mcu, last_mcu = layout.get_mcus(stripe)
+                stripe_samples, top, bottom = layout.get_stripe_samples(samples, stripe)
+                coefficients[first_mcu:last_mcu] = transform_stripe(stripe_samples, self.engine, layout, top, bottom)
+        return coefficients
+
+    def __encode_coefficients(self, coefficients, layout, quantizers):
+        """
+        Quantizes and entropy codes the DCT coefficients of an image with every quantizer.
+        :return: list of bytes of the .jpg files, in the order of the quantizers
+        """
+        results = []
+        executor = self.__get_executor()
+        try:
+            for quantizer in quantizers:
+                with self.__stage("encode", layout, quality=quantizer.quality) as span:
+                    quantized = quantize_coefficients(coefficients, quantizer, layout,
+                                                      self.engine.scale if self.engine.integer else 1)
+                    if self.progressive:
+                        results.append(self.__encode_progressive(quantized, layout, quantizer, executor))
+                    elif isinstance(executor, ProcessPoolExecutor):
+                        with SharedArray.from_array(quantized) as target:
+                            intervals, tables = self.__code_stripes(executor.map, target.spec, layout)
+                    else:
+                        intervals, tables = self.__code_stripes(executor.map if executor is not None else map,
+                                                                quantized, layout)
+                    if not self.progressive:
+                        results.append(self.__assemble(layout.width, layout.height, layout, quantizer, tables,
+                                                       intervals, self.restart_index))
+                    span.count("output_bits", len(results[-1]) * 8)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return results
+
+    def encode_rows(self, rows, width, height, output, channels=3, max_stripes=DEFAULT_MAX_STRIPES):
+        """
+        Encodes an image a stripe at a time (colour conversion, DCT, quantization and entropy coding) and appends
+        every coded stripe to output as soon as it is ready, so memory is bounded by a few stripes whatever the size
+        of the image.
+        :param rows: uint8 array of shape (height, width, channels) (e.g. memory-mapped), or an iterator of lines,
+        see StripeReader
+        :param output: Binary file-like object the .jpg file is written to
+        :param channels: 3 for RGB, 1 for GRAY
+        :param max_stripes: Stripes read but not yet written at any time; with workers > 1, also the most stripes
+        being encoded at once
+        :return: The number of bytes written
+        :raise: ValueError if optimized Huffman tables are asked for with an iterator, which can only be read once
+        (progressive files are read once)
+        :raise: BadImageException if the rows do not match the size
+        """
+        if self.optimize_huffman and not self.progressive and not isinstance(rows, np.ndarray):
+            raise ValueError("Optimized Huffman tables need two passes over the image, pass an array or use "
+                             "encode_file")
+        if self.cache is not None and isinstance(rows, np.ndarray):
+            return self.__stream_cached(rows, width, height, channels, output, max_stripes)
+        return self.__stream(lambda layout: StripeReader(rows, layout), width, height, channels, output,
+                             max_stripes)
+
+    def encode_file(self, filename: str, output_filename: str, max_stripes=DEFAULT_MAX_STRIPES, use_mmap=False):
+        """
+        Encodes a PPM / PGM file into a .jpg file with encode_rows. Binary files are read a few lines at a time (or
+        memory-mapped with use_mmap, or with a cache, which hashes the samples first) and read again for optimized
+        Huffman tables; plain files are parsed whole.
+        :return: (width, height, number of bytes written)
+        :raise: FileNotFoundError if the file does not exist
+        """
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(filename)
+        use_mmap = use_mmap or self.cache is not None
+        if use_mmap or self.__is_plain(filename):
+            header, rows = read_netpbm(filename, use_mmap)
+        else:
+            header, rows = read_netpbm_rows(filename)
+
+        with open(output_filename, "wb") as output:
+            if isinstance(rows, np.ndarray):
+                written = self.encode_rows(rows, header.width, header.height, output, header.channels, max_stripes)
+            else:
+                # A new iterator for every pass, the first one is already open
+                iterators = [rows]
+
+                def open_reader(layout):
+                    return StripeReader(iterators.pop() if iterators else read_netpbm_rows(filename)[1], layout)
+
+                written = self.__stream(open_reader, header.width, header.height, header.channels, output,
+                                        max_stripes)
+        return header.width, header.height, written
+
+    @staticmethod
+    def __is_plain(filename):
+        with open(filename, "rb") as file:
+            return file.read(2) in (b"P2", b"P3")
+
+    def __stream(self, open_reader, width, height, channels, output, max_stripes):
+        """
+        :param open_reader: Called with the FrameLayout for every pass over the image, returns a StripeReader
+        :return: The number of bytes written
+        """
+        layout = FrameLayout(width, height, get_components(channels, self.subsampling), self.stripe_rows,
+                             self.chroma_filter)
+        executor = self.__get_executor()
+        try:
+            with self.__stage("encode", layout, max_stripes=max_stripes) as span:
+                if self.progressive:
+                    written = output.write(self.__encode_progressive(
+                        self.__quantize(open_reader(layout).read, layout, self.quantizer), layout, self.quantizer,
+                        executor))
+                    span.count("output_bits", written * 8)
+                    return written
+
+                tables = self.__get_standard_tables(layout.components)
+                if tables is None:
+                    tables = build_tables(self.__merge(self.__map_stripes(open_reader(layout), layout, None,
+                                                                          executor, max_stripes)))
+
+                quantization_tables = self.quantizer.tables[:get_table_count(layout.components)]
+                indexed = self.restart_index and layout.restart_interval
+                if indexed and not output.seekable():
+                    raise ValueError("Writing a restart index needs a seekable output")
+                # The index is written with zero offsets first, and again once the stripes are coded
+                start = output.tell() if indexed else None
+                restart_offsets = [0] * len(layout.stripes) if indexed else None
+                headers = get_headers(width, height, layout.components, quantization_tables, *tables,
+                                      layout.restart_interval, restart_offsets)
+                written = output.write(headers)
+                interval_lengths = []
+                intervals = self.__map_stripes(open_reader(layout), layout, tables, executor, max_stripes)
+                for index, interval in enumerate(intervals):
+                    if index > 0:
+                        written += output.write(marker(RST0 + (index - 1) % 8))
+                    written += output.write(interval)
+                    interval_lengths.append(len(interval))
+                written += output.write(marker(EOI))
+
+                if indexed:
+                    index = restart_index_segments(layout.restart_interval, get_restart_offsets(interval_lengths))
+                    end = output.tell()
+                    output.seek(start + len(headers) - len(sos_segment(layout.components)) - len(index))
+                    output.write(index)
+                    output.seek(end)
+                span.count("output_bits", written * 8)
+                return written
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def __stream_cached(self, rows, width, height, channels, output, max_stripes):
+        """
+        Writes the cached file of an image, or streams it into memory (the coded file is a fraction of the samples)
+        and caches it.
+        :return: The number of bytes written
+        """
+        layout = FrameLayout(width, height, get_components(channels, self.subsampling), self.stripe_rows,
+                             self.chroma_filter)
+        with self.instrumentation.stage("cache_lookup") as span:
+            key = self.__get_file_key(hash_rows(rows), layout, self.quantizer)
+            data = self.cache.get(key)
+            span.count("cached_files", int(data is not None))
+
+        if data is None:
+            buffer = io.BytesIO()
+            self.__stream(lambda stream_layout: StripeReader(rows, stream_layout), width, height, channels, buffer,
+                          max_stripes)
+            data = buffer.getvalue()
+            self.cache.put(key, data)
+        return output.write(data)
+
+    def __map_stripes(self, reader, layout, tables, executor, max_stripes):
+        """
+        Encodes the stripes of a reader in order, reading a stripe only once fewer than max_stripes are pending.
+        :param tables: (DC tables, AC tables), None to count the symbols instead
+        :return: Iterator of the coded bytes (or symbol statistics) of every stripe
+        """
+        trace = self.instrumentation.enabled
+        tasks = ((stripe, *reader.read(stripe), self.quantizer, layout, self.engine, tables, trace)
+                 for stripe in layout.stripes)
+        if executor is None:
+            yield from map(self.__unpack, map(_stripe_task, tasks))
+            return
+
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(_stripe_task, task))
+            if len(pending) >= max(max_stripes, 1):
+                yield self.__unpack(pending.popleft().result())
+        while pending:
+            yield self.__unpack(pending.popleft().result())
+
+    def __quantize(self, read, layout, quantizer):
+        """
+        :param read: Called with every stripe in order, returns (samples, context lines above, context lines below)
+        :return: int16 array of shape (MCUs, blocks per MCU, 64) with the quantized coefficients of the whole image in
+        zig-zag order
+        """
+        quantized = np.empty((layout.mcu_count, layout.blocks_per_mcu, 64), dtype=np.int16)
+        for stripe in layout.stripes:
+            first_mcu, last_mcu = layout.get_mcus(stripe)
+            samples, top, bottom = read(stripe)
+            with self.instrumentation.stage("stripe", first_row=stripe[0], last_row=stripe[1]):
+                quantized[first_mcu:last_mcu] = quantize_stripe(samples, quantizer, layout, self.engine, top, bottom,
+                                                                self.instrumentation)
+        return quantized
+
+    def __encode_progressive(self, quantized, layout, quantizer, executor):
+        """
+        Codes the scans of a progressive file, each one a task of the executor.
+        :param quantized: Array returned by __quantize
+        :param executor: Pool to code the scans in, None to code them in the calling thread
+        :return: bytes of the .jpg file
+        """
+        trace = self.instrumentation.enabled
+        scans = self.__get_scan_script(layout)
+        if isinstance(executor, ProcessPoolExecutor):
+            with SharedArray.from_array(quantized) as source:
+                tasks = [(source.spec, layout, scan, trace) for scan in scans]
+                coded_scans = list(map(self.__unpack, executor.map(_scan_task, tasks)))
+        else:
+            tasks = [(quantized, layout, scan, trace) for scan in scans]
+            coded_scans = list(map(self.__unpack, (executor.map if executor is not None else map)(_scan_task, tasks)))
+
+        quantization_tables = quantizer.tables[:get_table_count(layout.components)]
+        return b"".join((get_progressive_headers(layout.width, layout.height, layout.components, quantization_tables),
+                         *coded_scans,
+                         marker(EOI)))
+
+    def __get_scan_script(self, layout):
+        """
+        :return: The scans of the progressive files of the image, None for baseline files
+        :raise: ValueError if the scan script does not fit the components of the image
+        """
+        if not self.progressive:
+            return None
+        if self.scan_script is None:
+            return get_default_scan_script(len(layout.components))
+        validate_scan_script(self.scan_script, len(layout.components))
+        return self.scan_script
+
+    def __get_layout(self, image):
+        """
+        :return: (samples, FrameLayout)
+        """
+        samples = get_source_planes(image)
+        channels, height, width = samples.shape
+        if self.workers > 1 and not self.stripe_rows:
+            raise ValueError("Parallel encoding needs stripe_rows > 0")
+
+        layout = FrameLayout(width, height, get_components(channels, self.subsampling), self.stripe_rows,
+                             self.chroma_filter)
+        return samples, layout
+
+    @staticmethod
+    def __assemble(width, height, layout, quantizer, tables, intervals, restart_index=False):
+        quantization_tables = quantizer.tables[:get_table_count(layout.components)]
+        restart_offsets = get_restart_offsets(intervals) if restart_index and layout.restart_interval else None
+        return b"".join((get_headers(width, height, layout.components, quantization_tables, *tables,
+                                     layout.restart_interval, restart_offsets),
+                         join_intervals(intervals),
+                         marker(EOI)))
+
+    def __get_standard_tables(self, components):
+        """
+        :return: (DC tables, AC tables) to code with, None if they have to be built from the image statistics
+        """
+        if self.optimize_huffman:
+            return None
+        table_count = get_table_count(components)
+        return STD_DC_TABLES[:table_count], STD_AC_TABLES[:table_count]
+
+    def __encode_stripes(self, map_function, source, target, layout, quantizer):
+        """
+        :param map_function: map or the map of an executor, called with the tasks of every stripe
+        :param source: Samples array or the spec of a SharedArray holding it
+        :param target: Coefficients array or the spec of a SharedArray holding it
+        :return: (coded bytes of every stripe, (DC tables, AC tables))
+        """
+        tables = self.__get_standard_tables(layout.components)
+        trace = self.instrumentation.enabled
+        tasks = [(source, target, stripe, quantizer, layout, self.engine, tables, trace) for stripe in layout.stripes]
+        results = list(map(self.__unpack, map_function(_quantize_task, tasks)))
+        if tables is not None:
+            return results, tables
+
+        # Optimized tables need the statistics of every stripe before anything can be coded
+        tables = build_tables(self.__merge(results))
+        tasks = [(target, stripe, layout, tables, trace) for stripe in layout.stripes]
+        return list(map(self.__unpack, map_function(_encode_task, tasks))), tables
+
+    def __code_stripes(self, map_function, target, layout):
+        """
+        Entropy codes coefficients that are already quantized.
+        :param target: Coefficients array or the spec of a SharedArray holding it
+        :return: (coded bytes of every stripe, (DC tables, AC tables))
+        """
+        tables = self.__get_standard_tables(layout.components)
+        trace = self.instrumentation.enabled
+        if tables is None:
+            tasks = [(target, stripe, layout, None, trace) for stripe in layout.stripes]
+            tables = build_tables(self.__merge(map(self.__unpack, map_function(_encode_task, tasks))))
+
+        tasks = [(target, stripe, layout, tables, trace) for stripe in layout.stripes]
+        return list(map(self.__unpack, map_function(_encode_task, tasks))), tables
+
+    def __get_executor(self):
+        """
+        :return: A new pool of self.workers processes or threads, None to encode in the calling thread
+        """
+        if self.workers <= 1:
+            return None
+        if self.pool == "thread":
+            return ThreadPoolExecutor(max_workers=self.workers)
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def __unpack(self, task_result):
+        """
+        :param task_result: (result, events) returned by a stripe task
+        :return: The result, the events are added to the instrumentation
+        """
+        result, events = task_result
+        self.instrumentation.extend(events)
+        return result
+
+    def __stage(self, name, layout, **args):
+        """
+        :return: Stage of the instrumentation describing the image being encoded
+        """
+        return self.instrumentation.stage(name, width=layout.width, height=layout.height,
+                                          subsampling=self.__get_subsampling(layout), engine=self.engine.name,
+                                          workers=self.workers, **args)
+
+    def __get_subsampling(self, layout):
+        """
+        :return: The subsampling mode, None for GRAY images
+        """
+        return self.subsampling if len(layout.components) > 1 else None
+
+    def __get_file_key(self, image_key, layout, quantizer):
+        """
+        :param image_key: Hash of the samples of the image (src.util.cache.hash_rows of its lines)
+        :return: Cache key of the file encoded from the image with the settings of this encoder and a quantizer,
+        made of every setting the bytes of the file depend on (not the workers or the pool)
+        """
+        tables = tuple(table.tobytes() for table in quantizer.tables[:get_table_count(layout.components)])
+        scans = self.__get_scan_script(layout)
+        return make_key(CACHE_VERSION, "jpeg", image_key, self.engine.name, self.__get_subsampling(layout),
+                        self.chroma_filter, layout.restart_interval, self.optimize_huffman, tables, self.restart_index,
+                        None if scans is None else " ".join(str(scan) for scan in scans))
+
+    @staticmethod
+    def __merge(stripe_frequencies):
+        """
+        :return: The symbol statistics of every stripe added together
+        """
+        frequencies = None
+        for stripe in stripe_frequencies:
+            frequencies = stripe if frequencies is None else merge_frequencies(frequencies, stripe)
+        return frequencies
+
+    def save(self, image, filename: str):
+        """
+        Encodes an image and writes it to a file.
+        :return: The number of bytes written
+        """
+        data = self.encode(image)
+        with open(filename, "wb") as file:
+            file.write(data)
+        return len(data)
@@ -0,0 +1,349 @@
+import numpy as np
+
+from src.domain.exceptions.CorruptStreamException import CorruptStreamException
+
+
+class HuffmanTable:
+    """
+    A JPEG Huffman table given by its DHT representation: bits[i] is the number of codes of length i + 1 and values
+    lists the symbols in order of increasing code length.
+    """
+
+    def __init__(self, bits, values):
+        self.bits = list(bits)
+        self.values = list(values)
+
+        # Symbol -> (code, code length), generated as in Annex C of the standard
+        self.codes = {}
+        # Decoding tables of Annex F.2.2.3, indexed by code length
+        self.min_code = [0] * 17
+        self.max_code = [-1] * 17
+        self.value_pointer = [0] * 17
+
+        code = 0
+        k = 0
+        for length in range(1, 17):
+            self.value_pointer[length] = k
+            self.min_code[length] = code
+            for _ in range(0, self.bits[length - 1]):
+                self.codes[self.values[k]] = (code, length)
+                code += 1
+                k += 1
+            if self.bits[length - 1] > 0:
+                self.max_code[length] = code - 1
+            code <<= 1
+
+        # The codes as arrays indexed by symbol, for coding whole arrays of symbols. Length 0 marks a missing symbol.
+        self.code_array = np.zeros(256, dtype=np.int64)
+        self.length_array = np.zeros(256, dtype=np.int64)
+        for symbol, (code, length) in self.codes.items():
+            self.code_array[symbol] = code
+            self.length_array[symbol] = length
+
+    @staticmethod
+    def from_frequencies(frequencies):
+        """
+        Builds the optimal table for the given symbol frequencies, with code lengths limited to 16 bits
+        (Annex K.2 of the standard, as done by libjpeg).
+        :param frequencies: dict or list mapping symbol (0-255) -> number of occurrences
+        :return: HuffmanTable
+        """
+        freq = [0] * 257
+        for symbol in range(0, 256):
+            freq[symbol] = frequencies.get(symbol, 0) if isinstance(frequencies, dict) else frequencies[symbol]
+        # Reserve one code point so that no real code consists of only 1 bits
+        freq[256] = 1
+
+        code_size = [0] * 257
+        others = [-1] * 257
+
+        while True:
+            # Find the two least frequent symbols, preferring the largest symbol on ties
+            c1 = -1
+            v = None
+            for i in range(0, 257):
+                if freq[i] and (v is None or freq[i] <= v):
+                    v = freq[i]
+                    c1 = i
+            c2 = -1
+            v = None
+            for i in range(0, 257):
+                if freq[i] and i != c1 and (v is None or freq[i] <= v):
+                    v = freq[i]
+                    c2 = i
+            if c2 < 0:
+                break
+
+            freq[c1] += freq[c2]
+            freq[c2] = 0
+
+            code_size[c1] += 1
+            while others[c1] >= 0:
+                c1 = others[c1]
+                code_size[c1] += 1
+            others[c1] = c2
+
+            code_size[c2] += 1
+            while others[c2] >= 0:
+                c2 = others[c2]
+                code_size[c2] += 1
+
+        bits = [0] * 33
+        for i in range(0, 257):
+            if code_size[i]:
+                bits[code_size[i]] += 1
+
+        # Limit code lengths to 16 bits
+        for i in range(32, 16, -1):
+            while bits[i] > 0:
+                j = i - 2
+                while bits[j] == 0:
+                    j -= 1
+                bits[i] -= 2
+                bits[i - 1] += 1
+                bits[j + 1] += 2
+                bits[j] -= 1
+
+        # Remove the reserved code point
+        i = 16
+        while bits[i] == 0:
+            i -= 1
+        bits[i] -= 1
+
+        values = [symbol for length in range(1, 33) for symbol in range(0, 256) if code_size[symbol] == length]
+        return HuffmanTable(bits[1:17], values)
+
+    def decode(self, reader):
+        """
+        Reads one symbol.
+        :param reader: BitReader positioned on a code of this table
+        :return: The decoded symbol
+        :raise: CorruptStreamException if no code of up to 16 bits matches
+        """
+        code = reader.read_bit()
+        for length in range(1, 17):
+            if code <= self.max_code[length]:
+                return self.values[self.value_pointer[length] + code - self.min_code[length]]
+            code = (code << 1) | reader.read_bit()
+        raise CorruptStreamException("Invalid Huffman code")
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "HuffmanTable({0} symbols)".format(len(self.values))
+
+
+# Standard tables from Annex K.3 of the standard
+STD_DC_LUMINANCE = HuffmanTable(
+    [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0],
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11])
+
+STD_DC_CHROMINANCE = HuffmanTable(
+    [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0],
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11])
+
+STD_AC_LUMINANCE = HuffmanTable(
+    [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d],
+    [0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+     0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+     0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+     0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+     0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+     0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+     0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+     0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+     0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+     0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+     0xf9, 0xfa])
+
+STD_AC_CHROMINANCE = HuffmanTable(
+    [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77],
+    [0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+     0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91, 0xa1, 0xb1, 0xc1, 0x09, 0x23, 0x33, 0x52, 0xf0,
+     0x15, 0x62, 0x72, 0xd1, 0x0a, 0x16, 0x24, 0x34, 0xe1, 0x25, 0xf1, 0x17, 0x18, 0x19, 0x1a, 0x26,
+     0x27, 0x28, 0x29, 0x2a, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+     0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+     0x69, 0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+     0x88, 0x89, 0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5,
+     0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3,
+     0xc4, 0xc5, 0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda,
+     0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+     0xf9, 0xfa])
+
+# End of block and run of 16 zeros symbols of the AC tables
+EOB = 0x00
+ZRL = 0xF0
+
+
+def get_size(amplitude):
+    """
+    :return: The size category (number of magnitude bits) of a coefficient
+    """
+    return abs(amplitude).bit_length()
+
+
+def get_sizes(amplitudes):
+    """
+    :param amplitudes: int array
+    :return: int64 array with the size category of every amplitude, like get_size
+    """
+    # frexp gives |a| = m * 2 ** e with 0.5 <= m < 1, so e is the bit length (0 for 0), exact for |a| < 2 ** 53
+    return np.frexp(np.abs(np.asarray(amplitudes, dtype=np.float64)))[1].astype(np.int64)
+
+
+def get_magnitude_bits(amplitude, size):
+    """
+    :return: The magnitude bits of a coefficient; negative values are stored as their one's complement. Also works
+    element-wise on int arrays.
+    """
+    if np.ndim(amplitude):
+        return np.where(amplitude < 0, amplitude + (1 << size) - 1, amplitude)
+    if amplitude < 0:
+        return amplitude + (1 << size) - 1
+    return amplitude
+
+
+def get_symbols(coefficients, previous_dc):
+    """
+    Turns one block into its entropy coding symbols.
+    :param coefficients: The 64 quantized coefficients of a block, as ints in zig-zag order
+    :param previous_dc: The DC coefficient of the previous block of the same component
+    :return: (DC size, DC difference, [(AC symbol RRRRSSSS, amplitude), ...])
+    """
+    difference = coefficients[0] - previous_dc
+    ac_symbols = []
+
+    zero_count = 0
+    for i in range(1, 64):
+        amplitude = coefficients[i]
+        if amplitude == 0:
+            zero_count += 1
+            continue
+
+        while zero_count > 15:
+            ac_symbols.append((ZRL, 0))
+            zero_count -= 16
+        ac_symbols.append(((zero_count << 4) | get_size(amplitude), amplitude))
+        zero_count = 0
+
+    if zero_count > 0:
+        ac_symbols.append((EOB, 0))
+
+    return get_size(difference), difference, ac_symbols
+
+
+def get_scan_symbols(coefficients, block_components):
+    """
+    Turns a whole sequence of blocks into their entropy coding symbols at once, the array version of get_symbols.
+    The DC of the first block of every component is predicted from 0, as at the start of a scan or restart interval.
+    :param coefficients: int array of shape (blocks, 64), the quantized coefficients of every block in zig-zag order,
+    in coding order
+    :param block_components: int array of shape (blocks,) with the component index of every block
+    :return: (block number, is AC, symbol, size, amplitude), int arrays with one entry per symbol, in coding order
+    """
+    coefficients = np.asarray(coefficients, dtype=np.int64).reshape(-1, 64)
+    block_components = np.asarray(block_components)
+    count = len(coefficients)
+
+    # DC: difference with the previous block of the same component
+    differences = np.empty(count, dtype=np.int64)
+    for component in np.unique(block_components):
+        index = np.flatnonzero(block_components == component)
+        differences[index] = np.diff(coefficients[index, 0], prepend=0)
+
+    # AC: every non-zero coefficient, with the zeros since the previous one of its block
+    ac_blocks, positions = np.nonzero(coefficients[:, 1:])
+    positions = positions + 1
+    amplitudes = coefficients[ac_blocks, positions]
+    first = np.r_[True, ac_blocks[1:] != ac_blocks[:-1]][:len(positions)]
+    runs = positions - np.where(first, 0, np.roll(positions, 1)) - 1
+    sizes = get_sizes(amplitudes)
+
+    # Runs of more than 15 zeros start with one ZRL per 16 zeros
+    zrl_counts = runs >> 4
+    zrl_owners = np.repeat(np.arange(len(runs)), zrl_counts)
+    zrl_numbers = np.arange(len(zrl_owners)) - np.repeat(np.cumsum(zrl_counts) - zrl_counts, zrl_counts)
+
+    # A block ending with zeros ends with EOB
+    eob_blocks = np.flatnonzero(coefficients[:, 63] == 0)
+
+    # Sort key: block, position in the block, then the ZRLs before the coefficient they lead to
+    block_numbers = np.concatenate((np.arange(count), ac_blocks, ac_blocks[zrl_owners], eob_blocks))
+    keys = block_numbers * (65 * 17) + np.concatenate((
+        np.zeros(count, dtype=np.int64),
+        positions * 17 + 16,
+        positions[zrl_owners] * 17 + zrl_numbers,
+        np.full(len(eob_blocks), 64 * 17, dtype=np.int64)))
+    is_ac = np.concatenate((np.zeros(count, dtype=np.int64), np.ones(len(keys) - count, dtype=np.int64)))
+    dc_sizes = get_sizes(differences)
+    symbols = np.concatenate((dc_sizes, ((runs & 15) << 4) | sizes, np.full(len(zrl_owners), ZRL, dtype=np.int64),
+                              np.full(len(eob_blocks), EOB, dtype=np.int64)))
+    all_sizes = np.concatenate((dc_sizes, sizes, np.zeros(len(zrl_owners) + len(eob_blocks), dtype=np.int64)))
+    all_amplitudes = np.concatenate((differences, amplitudes,
+                                     np.zeros(len(zrl_owners) + len(eob_blocks), dtype=np.int64)))
+
+    order = np.argsort(keys, kind="stable")
+    return block_numbers[order], is_ac[order], symbols[order], all_sizes[order], all_amplitudes[order]
+
+
+def count_block(coefficients, previous_dc, dc_frequencies, ac_frequencies):
+    """
+    Adds the symbols of one block to the frequency tables used to build optimized Huffman tables.
+    :return: The DC coefficient of the block
+    """
+    dc_size, _, ac_symbols = get_symbols(coefficients, previous_dc)
+    dc_frequencies[dc_size] += 1
+    for symbol, _ in ac_symbols:
+        ac_frequencies[symbol] += 1
+    return coefficients[0]
+
+
+def encode_block(writer, coefficients, previous_dc, dc_table: HuffmanTable, ac_table: HuffmanTable):
+    """
+    Writes one block with the given Huffman tables.
+    :param writer: BitWriter receiving the codes
+    :return: The DC coefficient of the block
+    """
+    dc_size, difference, ac_symbols = get_symbols(coefficients, previous_dc)
+
+    writer.write(*dc_table.codes[dc_size])
+    writer.write(get_magnitude_bits(difference, dc_size), dc_size)
+
+    for symbol, amplitude in ac_symbols:
+        writer.write(*ac_table.codes[symbol])
+        size = symbol & 0x0F
+        writer.write(get_magnitude_bits(amplitude, size), size)
+
+    return coefficients[0]
+
+
+def decode_block(reader, previous_dc, dc_table: HuffmanTable, ac_table: HuffmanTable):
+    """
+    Reads one block, the inverse of encode_block.
+    :param reader: BitReader positioned at the start of the block
+    :return: (the 64 quantized coefficients in zig-zag order, the DC coefficient of the block)
+    :raise: CorruptStreamException if the coefficients run past the end of the block
+    """
+    coefficients = [0] * 64
+    coefficients[0] = previous_dc + reader.receive_extend(dc_table.decode(reader))
+
+    k = 1
+    while k < 64:
+        symbol = ac_table.decode(reader)
+        size = symbol & 0x0F
+        run = symbol >> 4
+        if size == 0:
+            if run != 15:
+                # EOB
+                break
+            k += 16
+            continue
+
+        k += run
+        if k > 63:
+            raise CorruptStreamException("Coefficient run past the end of the block")
+        coefficients[k] = reader.receive_extend(size)
+        k += 1
+
+    return coefficients, coefficients[0]
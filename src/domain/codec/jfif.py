@@ -0,0 +1,367 @@
+import struct
+
+import numpy as np
+
+from src.domain.codec.bit_io import pack_bits
+from src.domain.codec.huffman import HuffmanTable, STD_DC_LUMINANCE, STD_AC_LUMINANCE, STD_DC_CHROMINANCE, \
+    STD_AC_CHROMINANCE, get_scan_symbols, get_magnitude_bits
+
+# Markers
+SOI = 0xD8
+EOI = 0xD9
+SOF0 = 0xC0
+SOF2 = 0xC2
+DHT = 0xC4
+DQT = 0xDB
+SOS = 0xDA
+DRI = 0xDD
+RST0 = 0xD0
+APP0 = 0xE0
+APP9 = 0xE9
+
+# The APP9 segments of the restart index start with this identifier, then hold the restart interval, the number of
+# the first interval they list and the offset of every interval (see restart_index_segments)
+RESTART_INDEX_ID = b"RSTIDX\x00"
+RESTART_INDEX_HEADER = ">HI"
+# Offsets listed per segment, keeps segments under the 65535 byte limit
+OFFSETS_PER_SEGMENT = 16000
+
+# Natural (row-major) index of every coefficient, in zig-zag order
+ZIGZAG = [
+    0, 1, 8, 16, 9, 2, 3, 10,
+    17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34,
+    27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36,
+    29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46,
+    53, 60, 61, 54, 47, 55, 62, 63,
+]
+
+
+class Component:
+    """
+    One colour component of a frame: its id, sampling factors and the tables it uses.
+    """
+
+    def __init__(self, identifier, horizontal=1, vertical=1, quantization_table=0, dc_table=0, ac_table=0):
+        self.identifier = identifier
+        self.horizontal = horizontal
+        self.vertical = vertical
+        self.quantization_table = quantization_table
+        self.dc_table = dc_table
+        self.ac_table = ac_table
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "Component({0}, {1}x{2}, q{3})".format(self.identifier, self.horizontal, self.vertical,
+                                                       self.quantization_table)
+
+
+# Y uses the luminance tables, Cb and Cr the chrominance ones
+YCBCR_COMPONENTS = [Component(1, quantization_table=0, dc_table=0, ac_table=0),
+                    Component(2, quantization_table=1, dc_table=1, ac_table=1),
+                    Component(3, quantization_table=1, dc_table=1, ac_table=1)]
+
+STD_DC_TABLES = [STD_DC_LUMINANCE, STD_DC_CHROMINANCE]
+STD_AC_TABLES = [STD_AC_LUMINANCE, STD_AC_CHROMINANCE]
+
+
+def to_zig_zag(items):
+    """
+    :param items: 8x8 block items (list of rows)
+    :return: The 64 items as ints in zig-zag order
+    """
+    return [int(round(items[index >> 3][index & 7])) for index in ZIGZAG]
+
+
+def marker(code):
+    return bytes((0xFF, code))
+
+
+def segment(code, payload):
+    """
+    :return: A marker segment, the length field includes itself but not the marker
+    """
+    return marker(code) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def app0_segment():
+    # JFIF 1.01, no units, 1:1 aspect ratio, no thumbnail
+    return segment(APP0, b"JFIF\x00" + struct.pack(">BBBHHBB", 1, 1, 0, 1, 1, 0, 0))
+
+
+def dqt_segment(quantization_tables):
+    """
+    :param quantization_tables: list of 8x8 quantization matrices (list of rows), the index is the table id
+    """
+    payload = bytearray()
+    for table_id, table in enumerate(quantization_tables):
+        payload.append(table_id)
+        payload.extend(int(table[index >> 3][index & 7]) for index in ZIGZAG)
+    return segment(DQT, bytes(payload))
+
+
+def sof0_segment(width, height, components, code=SOF0):
+    """
+    :param code: Start of frame marker, SOF0 for baseline files or SOF2 for progressive ones
+    """
+    payload = struct.pack(">BHHB", 8, height, width, len(components))
+    for component in components:
+        payload += struct.pack(">BBB", component.identifier, (component.horizontal << 4) | component.vertical,
+                               component.quantization_table)
+    return segment(code, payload)
+
+
+def dht_segment(dc_tables, ac_tables):
+    payload = bytearray()
+    for table_class, tables in ((0, dc_tables), (1, ac_tables)):
+        for table_id, table in enumerate(tables):
+            payload.append((table_class << 4) | table_id)
+            payload.extend(table.bits)
+            payload.extend(table.values)
+    return segment(DHT, bytes(payload))
+
+
+def dri_segment(restart_interval):
+    return segment(DRI, struct.pack(">H", restart_interval))
+
+
+def restart_index_segments(restart_interval, offsets):
+    """
+    Index of the restart intervals, so decoders can seek to any of them without decoding the ones before.
+    :param offsets: Offset of the first byte of every restart interval from the first byte of the entropy-coded data
+    (which follows the SOS segment), see get_restart_offsets
+    :return: One APP9 segment per OFFSETS_PER_SEGMENT offsets
+    """
+    segments = []
+    for first in range(0, len(offsets), OFFSETS_PER_SEGMENT):
+        chunk = offsets[first:first + OFFSETS_PER_SEGMENT]
+        segments.append(segment(APP9, RESTART_INDEX_ID + struct.pack(RESTART_INDEX_HEADER, restart_interval, first) +
+                                struct.pack(">{0}I".format(len(chunk)), *chunk)))
+    return b"".join(segments)
+
+
+def read_restart_index(payload):
+    """
+    :param payload: Payload of an APP9 segment
+    :return: (restart interval, number of the first interval, list of offsets), None if the segment is not part of
+    a restart index
+    """
+    if not payload.startswith(RESTART_INDEX_ID):
+        return None
+    position = len(RESTART_INDEX_ID) + struct.calcsize(RESTART_INDEX_HEADER)
+    restart_interval, first = struct.unpack(RESTART_INDEX_HEADER, payload[len(RESTART_INDEX_ID):position])
+    count = (len(payload) - position) // 4
+    return restart_interval, first, list(struct.unpack(">{0}I".format(count), payload[position:position + 4 * count]))
+
+
+def get_restart_offsets(intervals):
+    """
+    :param intervals: Coded bytes of every restart interval, or their lengths
+    :return: Offset of every interval in the entropy-coded data, as join_intervals puts them together
+    """
+    offsets = []
+    position = 0
+    for interval in intervals:
+        offsets.append(position)
+        # The interval, then its RSTn marker
+        position += (interval if isinstance(interval, int) else len(interval)) + 2
+    return offsets
+
+
+def sos_segment(components, spectral_start=0, spectral_end=63, approximation_high=0, approximation_low=0):
+    payload = struct.pack(">B", len(components))
+    for component in components:
+        payload += struct.pack(">BB", component.identifier, (component.dc_table << 4) | component.ac_table)
+    payload += struct.pack(">BBB", spectral_start, spectral_end, (approximation_high << 4) | approximation_low)
+    return segment(SOS, payload)
+
+
+def get_table_count(components):
+    return max(max(c.dc_table for c in components), max(c.ac_table for c in components)) + 1
+
+
+def get_scan_blocks(mcus, block_components=None):
+    """
+    :param mcus: MCUs as a list, each a list of (component index, 64 zig-zag coefficients), or as an int array of
+    shape (MCUs, blocks per MCU, 64)
+    :param block_components: For arrays, the component index of every block of an MCU; defaults to block k being
+    component k
+    :return: (coefficients of shape (blocks, 64), component index of every block, blocks per MCU)
+    """
+    if isinstance(mcus, np.ndarray):
+        blocks_per_mcu = mcus.shape[1]
+        if block_components is None:
+            block_components = range(0, blocks_per_mcu)
+        return mcus.reshape(-1, 64), np.tile(np.asarray(block_components), len(mcus)), blocks_per_mcu
+
+    if not mcus:
+        return np.zeros((0, 64), dtype=np.int64), np.zeros(0, dtype=np.int64), 1
+    coefficients = np.array([block for mcu in mcus for _, block in mcu], dtype=np.int64)
+    components = np.array([component_index for mcu in mcus for component_index, _ in mcu])
+    return coefficients, components, len(mcus[0])
+
+
+def get_intervals(mcus, restart_interval=0, block_components=None):
+    """
+    :return: Generator yielding (coefficients, block components) for every restart interval of a scan
+    """
+    coefficients, components, blocks_per_mcu = get_scan_blocks(mcus, block_components)
+    step = restart_interval * blocks_per_mcu if restart_interval else max(1, len(coefficients))
+    for start in range(0, max(1, len(coefficients)), step):
+        yield coefficients[start:start + step], components[start:start + step]
+
+
+def count_symbols(components, mcus, restart_interval=0, frequencies=None, block_components=None):
+    """
+    Counts the Huffman symbols of a scan.
+    :param mcus: MCUs, see get_scan_blocks
+    :param frequencies: (DC frequencies, AC frequencies) to add to, as returned by a previous call
+    :return: (DC frequencies, AC frequencies), one list of 256 counts per table id
+    """
+    table_count = get_table_count(components)
+    counts = np.zeros((2, table_count, 256), dtype=np.int64)
+    for coefficients, scan_components in get_intervals(mcus, restart_interval, block_components):
+        block_numbers, is_ac, symbols, _, _ = get_scan_symbols(coefficients, scan_components)
+        table_ids = _get_table_ids(components, scan_components[block_numbers], is_ac)
+        np.add.at(counts, (is_ac, table_ids, symbols), 1)
+
+    if frequencies is not None:
+        counts += np.array(frequencies, dtype=np.int64)
+    return counts[0].tolist(), counts[1].tolist()
+
+
+def _get_table_ids(components, symbol_components, is_ac):
+    """
+    :return: The Huffman table id every symbol is coded with
+    """
+    dc_ids = np.array([component.dc_table for component in components])
+    ac_ids = np.array([component.ac_table for component in components])
+    return np.where(is_ac == 1, ac_ids[symbol_components], dc_ids[symbol_components])
+
+
+def merge_frequencies(first, second):
+    """
+    :return: The element-wise sum of two results of count_symbols
+    """
+    return tuple([[a + b for a, b in zip(table_a, table_b)] for table_a, table_b in zip(tables_a, tables_b)]
+                 for tables_a, tables_b in zip(first, second))
+
+
+def build_tables(frequencies):
+    """
+    :param frequencies: (DC frequencies, AC frequencies) as returned by count_symbols
+    :return: (DC tables, AC tables), indexed by table id
+    """
+    dc_frequencies, ac_frequencies = frequencies
+    return [HuffmanTable.from_frequencies(table) for table in dc_frequencies], \
+           [HuffmanTable.from_frequencies(table) for table in ac_frequencies]
+
+
+def optimize_tables(components, mcus, restart_interval=0, block_components=None):
+    """
+    Builds per-image Huffman tables from the symbol statistics of the image.
+    :return: (DC tables, AC tables), indexed by table id
+    """
+    return build_tables(count_symbols(components, mcus, restart_interval, block_components=block_components))
+
+
+def join_intervals(intervals):
+    """
+    Joins independently coded restart intervals, putting RST0, RST1, ... RST7, RST0, ... markers between them.
+    """
+    data = bytearray()
+    for i, interval in enumerate(intervals):
+        if i > 0:
+            data += marker(RST0 + (i - 1) % 8)
+        data += interval
+    return bytes(data)
+
+
+def encode_scan(components, mcus, dc_tables, ac_tables, restart_interval=0, block_components=None):
+    """
+    Entropy codes a sequential scan. The symbols of a whole restart interval are built and packed at once.
+    :param mcus: MCUs, see get_scan_blocks
+    :param restart_interval: Number of MCUs per restart interval, 0 for no restart markers
+    :return: The entropy-coded bytes (byte stuffed, padded)
+    :raise: KeyError if a symbol has no code in its table
+    """
+    return join_intervals(encode_intervals(components, mcus, dc_tables, ac_tables, restart_interval, block_components))
+
+
+def encode_intervals(components, mcus, dc_tables, ac_tables, restart_interval=0, block_components=None):
+    """
+    Entropy codes a sequential scan, one restart interval at a time.
+    :return: list of the entropy-coded bytes of every interval, see encode_scan
+    :raise: KeyError if a symbol has no code in its table
+    """
+    # Codes and code lengths by (DC / AC, table id, symbol)
+    code_arrays = np.array([[table.code_array for table in dc_tables], [table.code_array for table in ac_tables]])
+    length_arrays = np.array([[table.length_array for table in dc_tables],
+                              [table.length_array for table in ac_tables]])
+
+    intervals = []
+    for coefficients, scan_components in get_intervals(mcus, restart_interval, block_components):
+        block_numbers, is_ac, symbols, sizes, amplitudes = get_scan_symbols(coefficients, scan_components)
+        table_ids = _get_table_ids(components, scan_components[block_numbers], is_ac)
+        codes = code_arrays[is_ac, table_ids, symbols]
+        code_lengths = length_arrays[is_ac, table_ids, symbols]
+        if not code_lengths.all():
+            missing = np.flatnonzero(code_lengths == 0)[0]
+            raise KeyError("Symbol {0:#04x} has no Huffman code".format(int(symbols[missing])))
+
+        # Every symbol is its code followed by the magnitude bits
+        intervals.append(pack_bits((codes << sizes) | get_magnitude_bits(amplitudes, sizes), code_lengths + sizes))
+    return intervals
+
+
+def get_headers(width, height, components, quantization_tables, dc_tables, ac_tables, restart_interval=0,
+                restart_offsets=None):
+    """
+    :param restart_offsets: Offsets of the restart intervals to write a restart index of, None for no index
+    :return: Every segment of a baseline file that comes before the entropy-coded data
+    """
+    return b"".join((marker(SOI),
+                     app0_segment(),
+                     dqt_segment(quantization_tables),
+                     sof0_segment(width, height, components),
+                     dht_segment(dc_tables, ac_tables),
+                     dri_segment(restart_interval) if restart_interval else b"",
+                     restart_index_segments(restart_interval, restart_offsets) if restart_offsets else b"",
+                     sos_segment(components)))
+
+
+def encode_jpeg(width, height, components, quantization_tables, mcus, optimize_huffman=False, restart_interval=0,
+                restart_index=False, block_components=None):
+    """
+    Builds a baseline (sequential, Huffman coded) JFIF file.
+    :param width: Image width
+    :param height: Image height
+    :param components: list of Component
+    :param quantization_tables: list of 8x8 quantization matrices the coefficients were quantized with
+    :param mcus: list of MCUs in raster order, each a list of (component index, 64 zig-zag coefficients), or an array
+    of them (see get_scan_blocks)
+    :param optimize_huffman: Whether to build per-image Huffman tables instead of the standard ones
+    :param restart_interval: Number of MCUs per restart interval, 0 for no restart markers
+    :param restart_index: Whether to write the offsets of the restart intervals (see restart_index_segments)
+    :param block_components: For arrays of MCUs, the component index of every block of an MCU
+    :return: bytes of the .jpg file
+    """
+    if optimize_huffman:
+        dc_tables, ac_tables = optimize_tables(components, mcus, restart_interval, block_components)
+    else:
+        dc_tables, ac_tables = STD_DC_TABLES, STD_AC_TABLES
+
+    table_count = get_table_count(components)
+    dc_tables = dc_tables[:table_count]
+    ac_tables = ac_tables[:table_count]
+
+    intervals = encode_intervals(components, mcus, dc_tables, ac_tables, restart_interval, block_components)
+    restart_offsets = get_restart_offsets(intervals) if restart_index and restart_interval else None
+    return b"".join((get_headers(width, height, components, quantization_tables, dc_tables, ac_tables,
+                                 restart_interval, restart_offsets),
+                     join_intervals(intervals),
+                     marker(EOI)))
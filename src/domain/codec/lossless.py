@@ -0,0 +1,170 @@
+import numpy as np
+
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.jfif import ZIGZAG, Component, encode_jpeg
+
+# Lossless transforms as (transpose, flip horizontally, flip vertically), applied in that order
+TRANSFORMS = {
+    "flip_horizontal": (False, True, False),
+    "flip_vertical": (False, False, True),
+    "transpose": (True, False, False),
+    "transverse": (True, True, True),
+    "rotate_90": (True, True, False),
+    "rotate_180": (False, True, True),
+    "rotate_270": (True, False, True),
+}
+
+# Mirroring a block negates its coefficients of odd horizontal (columns) / vertical (rows) frequency
+HORIZONTAL_SIGNS = np.tile([1, -1], (8, 4))
+VERTICAL_SIGNS = HORIZONTAL_SIGNS.T
+
+
+def get_transform(name):
+    """
+    :return: (transpose, flip horizontally, flip vertically) of a transform
+    :raise: KeyError if the name is not one of TRANSFORMS
+    """
+    if name not in TRANSFORMS:
+        raise KeyError("Unknown transform '{0}', expected one of {1}".format(name, sorted(TRANSFORMS)))
+    return TRANSFORMS[name]
+
+
+def is_transposing(name):
+    """
+    :return: Whether a transform swaps the lines and columns, and so the sampling factors and quantization tables
+    """
+    return get_transform(name)[0]
+
+
+def get_trimmed_size(width, height, mcu_width, mcu_height, name):
+    """
+    The partial MCUs at the right and bottom edges are padded; mirroring an edge would move the padding into the
+    image, so like jpegtran -trim the transforms drop the partial MCUs of the edges they mirror.
+    :param mcu_width: MCU width in samples
+    :param mcu_height: MCU height in samples
+    :return: (width, height) of the part of the image the transform keeps
+    :raise: ValueError if nothing is left
+    """
+    transpose, flip_horizontal, flip_vertical = get_transform(name)
+    # The flips come after the transposition, so mirror the other axis of the source
+    if (flip_vertical if transpose else flip_horizontal):
+        width -= width % mcu_width
+    if (flip_horizontal if transpose else flip_vertical):
+        height -= height % mcu_height
+    if width == 0 or height == 0:
+        raise ValueError("The image is smaller than a {0}x{1} MCU, nothing is left to {2}".format(
+            mcu_width, mcu_height, name))
+    return width, height
+
+
+def get_transformed_size(width, height, name):
+    """
+    :return: (width, height) of the image after a transform
+    """
+    return (height, width) if is_transposing(name) else (width, height)
+
+
+def get_crop_mcus(region, width, height, mcu_width, mcu_height):
+    """
+    :param region: (left, top, width, height), left and top on MCU boundaries
+    :return: ((first, last) MCU columns, (first, last) MCU lines) the region covers
+    :raise: ValueError if the region is not inside the image or does not start on an MCU boundary
+    """
+    left, top, region_width, region_height = region
+    if region_width <= 0 or region_height <= 0 or left < 0 or top < 0 or left + region_width > width or \
+            top + region_height > height:
+        raise ValueError("Region {0}x{1}+{2}+{3} is not inside the {4}x{5} image".format(
+            region_width, region_height, left, top, width, height))
+    if left % mcu_width or top % mcu_height:
+        raise ValueError("Region {0}x{1}+{2}+{3} does not start on a {4}x{5} MCU boundary".format(
+            region_width, region_height, left, top, mcu_width, mcu_height))
+    return (left // mcu_width, -(-(left + region_width) // mcu_width)), \
+           (top // mcu_height, -(-(top + region_height) // mcu_height))
+
+
+def transform_blocks(blocks, name):
+    """
+    Transforms quantized (or dequantized) DCT coefficients without the inverse DCT: the blocks are reordered, their
+    coefficients transposed for transposing transforms, and the signs of their odd frequencies flipped for mirrored
+    axes. The quantization tables have to be transposed with the coefficients.
+    :param blocks: Array of shape (block lines, blocks per line, 8, 8) with the coefficients in natural order,
+    trimmed to whole MCUs along the mirrored edges (see get_trimmed_size)
+    :return: New array of the transformed blocks
+    """
+    transpose, flip_horizontal, flip_vertical = get_transform(name)
+    if transpose:
+        blocks = blocks.transpose(1, 0, 3, 2)
+    if flip_horizontal:
+        blocks = blocks[:, ::-1] * HORIZONTAL_SIGNS.astype(blocks.dtype)
+    if flip_vertical:
+        blocks = blocks[::-1] * VERTICAL_SIGNS.astype(blocks.dtype)
+    return np.ascontiguousarray(blocks)
+
+
+def get_mcus(planes, factors):
+    """
+    :param planes: Blocks of every component, arrays of shape (block lines, blocks per line, 8, 8) in natural order
+    covering the same MCUs
+    :param factors: (horizontal, vertical) sampling factors of every component
+    :return: (array of shape (MCUs, blocks per MCU, 64) in zig-zag order, component index of every block of an
+    MCU), for jfif.encode_jpeg
+    """
+    mcus = []
+    for plane, (horizontal, vertical) in zip(planes, factors):
+        lines, blocks = plane.shape[0] // vertical, plane.shape[1] // horizontal
+        mcus.append(plane.reshape(lines, vertical, blocks, horizontal, 64)[..., ZIGZAG]
+                    .transpose(0, 2, 1, 3, 4).reshape(lines * blocks, vertical * horizontal, 64))
+    block_components = [index for index, (horizontal, vertical) in enumerate(factors)
+                        for _ in range(0, horizontal * vertical)]
+    return np.concatenate(mcus, axis=1), block_components
+
+
+def transform_jpeg(file, transform=None, region=None, optimize_huffman=False, restart_interval=0, workers=1):
+    """
+    Rotates, flips and / or crops a JPEG file losslessly, like jpegtran: the quantized coefficients are read and
+    coded again, without the inverse DCT, colour conversion, DCT and quantization of a transcode, so the image
+    loses nothing. Only the MCUs of the region are entropy decoded from sequential files.
+    :param file: Binary file object of the JPEG file (baseline or progressive)
+    :param transform: Name from TRANSFORMS, None to only crop
+    :param region: (left, top, width, height) to crop the image to before the transform, left and top on MCU
+    boundaries (8 or 16 samples), None for the whole image
+    :param optimize_huffman: Whether to build per-image Huffman tables instead of the standard ones
+    :param restart_interval: Number of MCUs per restart interval, 0 for no restart markers
+    :param workers: Processes entropy decoding the file, see JPEGDecoder
+    :return: bytes of the transformed baseline JPEG file
+    :raise: KeyError if the transform is unknown; ValueError if the region is not inside the image or does not
+    start on an MCU boundary
+    """
+    decoder = JPEGDecoder(file, workers=workers)
+    # A single component scan codes every block on its own, see JPEGDecoder.max_horizontal
+    factors = [(1, 1)] if len(decoder.components) == 1 else \
+        [(component.horizontal, component.vertical) for component in decoder.components]
+    mcu_width, mcu_height = 8 * decoder.max_horizontal, 8 * decoder.max_vertical
+
+    width, height = decoder.width, decoder.height
+    columns, lines = (0, decoder.mcus_per_line), (0, decoder.mcu_lines)
+    if region is not None:
+        columns, lines = get_crop_mcus(region, width, height, mcu_width, mcu_height)
+        _, _, width, height = region
+    if transform is not None:
+        width, height = get_trimmed_size(width, height, mcu_width, mcu_height, transform)
+        columns = (columns[0], columns[0] + -(-width // mcu_width))
+        lines = (lines[0], lines[0] + -(-height // mcu_height))
+
+    planes = decoder.read_coefficients(columns, lines)
+    table_ids = sorted({component.quantization_table for component in decoder.components})
+    quantization_tables = [decoder.quantization_tables[table_id] for table_id in table_ids]
+    if transform is not None:
+        planes = [transform_blocks(plane, transform) for plane in planes]
+        width, height = get_transformed_size(width, height, transform)
+        if is_transposing(transform):
+            factors = [(vertical, horizontal) for horizontal, vertical in factors]
+            quantization_tables = [table.T for table in quantization_tables]
+
+    # The first component uses the luminance Huffman tables, the others the chrominance ones
+    components = [Component(component.identifier, horizontal, vertical,
+                            table_ids.index(component.quantization_table), min(index, 1), min(index, 1))
+                  for index, (component, (horizontal, vertical)) in enumerate(zip(decoder.components, factors))]
+    mcus, block_components = get_mcus(planes, factors)
+    return encode_jpeg(width, height, components, quantization_tables, mcus, optimize_huffman, restart_interval,
+                       block_components=block_components)
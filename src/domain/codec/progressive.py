@@ -0,0 +1,507 @@
+import re
+
+import numpy as np
+
+from src.domain.codec.bit_io import pack_bits
+from src.domain.codec.huffman import HuffmanTable, ZRL, get_sizes, get_magnitude_bits
+from src.domain.codec.jfif import SOI, SOF2, DHT, marker, segment, app0_segment, dqt_segment, sof0_segment, \
+    sos_segment, get_table_count
+from src.domain.exceptions.CorruptStreamException import CorruptStreamException
+
+# Longest run of blocks a single EOBn symbol ends (EOB14 with 14 extra bits)
+MAX_EOB_RUN = 0x7FFF
+
+# Correction bits of an EOB run held back before the run is written anyway, as libjpeg does
+MAX_CORRECTION_BITS = 1000 - 64 + 1
+
+# Highest successive approximation bit position for 8 bit samples
+MAX_APPROXIMATION = 13
+
+# Entries of a scan that are raw bits, not Huffman coded (DC refinement bits, AC correction bits)
+RAW = -1
+
+_SCAN = re.compile(r"^([\d\s,]+):\s*(\d+)\s*-\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)$")
+
+
+class Scan:
+    """
+    One scan of a progressive file: the components it codes, the band of zig-zag coefficients (spectral selection)
+    and the bits of them (successive approximation). Only DC scans (band 0-0) may code several components.
+
+    A first scan of a coefficient (approximation_high 0) codes the value divided by 2 ** approximation_low; every
+    refinement scan then adds one bit, approximation_high being the approximation_low of the previous scan.
+    """
+
+    def __init__(self, components, spectral_start, spectral_end, approximation_high=0, approximation_low=0):
+        """
+        :param components: Indices of the components (in frame order)
+        """
+        self.components = tuple(components)
+        self.spectral_start = spectral_start
+        self.spectral_end = spectral_end
+        self.approximation_high = approximation_high
+        self.approximation_low = approximation_low
+
+    @property
+    def is_dc(self):
+        return self.spectral_start == 0
+
+    @property
+    def is_refinement(self):
+        return self.approximation_high > 0
+
+    def __eq__(self, other):
+        return isinstance(other, Scan) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "{0}: {1}-{2}, {3}, {4};".format(" ".join(str(component) for component in self.components),
+                                                self.spectral_start, self.spectral_end, self.approximation_high,
+                                                self.approximation_low)
+
+
+# <editor-fold desc="Scan scripts">
+def get_default_scan_script(component_count):
+    """
+    :return: The scans of libjpeg's jpeg_simple_progression: DC first, then the lowest luma frequencies and the
+    chroma at reduced precision, the rest of the luma, and the refinement bits last
+    """
+    if component_count == 1:
+        return [Scan((0,), 0, 0, 0, 1),
+                Scan((0,), 1, 5, 0, 2),
+                Scan((0,), 6, 63, 0, 2),
+                Scan((0,), 1, 63, 2, 1),
+                Scan((0,), 0, 0, 1, 0),
+                Scan((0,), 1, 63, 1, 0)]
+
+    every = tuple(range(0, component_count))
+    return [Scan(every, 0, 0, 0, 1),
+            Scan((0,), 1, 5, 0, 2),
+            *(Scan((component,), 1, 63, 0, 1) for component in reversed(every[1:])),
+            Scan((0,), 6, 63, 0, 2),
+            Scan((0,), 1, 63, 2, 1),
+            Scan(every, 0, 0, 1, 0),
+            *(Scan((component,), 1, 63, 1, 0) for component in reversed(every[1:])),
+            Scan((0,), 1, 63, 1, 0)]
+
+
+def parse_scan_script(text):
+    """
+    Parses a scan script in the format of jpegtran's -scans option: scans separated by ";", each
+    "components: Ss-Se, Ah, Al", e.g. "0 1 2: 0-0, 0, 1;", with # comments up to the end of the line.
+    :return: list of Scan
+    :raise: ValueError if a scan is malformed
+    """
+    text = re.sub(r"#[^\n]*", "", text)
+    scans = []
+    for item in text.split(";"):
+        item = item.strip()
+        if not item:
+            continue
+        match = _SCAN.match(item)
+        if match is None:
+            raise ValueError("Invalid scan {0!r}, expected \"components: Ss-Se, Ah, Al\"".format(item))
+        components = [int(component) for component in re.split(r"[\s,]+", match.group(1).strip())]
+        scans.append(Scan(components, *(int(value) for value in match.groups()[1:])))
+    return scans
+
+
+def validate_scan_script(scans, component_count):
+    """
+    Checks that the scans make a valid progression (as in Annex G of the standard) coding every coefficient of
+    every component to full precision.
+    :raise: ValueError naming the first scan that breaks a rule
+    """
+    if not scans:
+        raise ValueError("The scan script is empty")
+
+    # Approximation_low every coefficient of every component is known at, None until its first scan
+    precision = [[None] * 64 for _ in range(0, component_count)]
+    for number, scan in enumerate(scans):
+        def fail(reason):
+            raise ValueError("Scan {0} ({1}): {2}".format(number, scan, reason))
+
+        components = scan.components
+        if not components or len(components) > 4:
+            fail("a scan codes 1 to 4 components")
+        if list(components) != sorted(set(components)) or components[0] < 0 or components[-1] >= component_count:
+            fail("components must be distinct, in frame order and below {0}".format(component_count))
+        if not 0 <= scan.spectral_start <= scan.spectral_end <= 63:
+            fail("the band must be within 0-63")
+        if scan.is_dc and scan.spectral_end != 0:
+            fail("DC scans code the DC coefficient only")
+        if not scan.is_dc and len(components) > 1:
+            fail("AC scans code a single component")
+        if not 0 <= scan.approximation_low <= MAX_APPROXIMATION or \
+                scan.is_refinement and scan.approximation_low != scan.approximation_high - 1:
+            fail("refinement scans code one more bit, Al = Ah - 1")
+
+        for component in components:
+            if not scan.is_dc and precision[component][0] is None:
+                fail("the DC coefficient of component {0} has to be coded first".format(component))
+            for k in range(scan.spectral_start, scan.spectral_end + 1):
+                expected = scan.approximation_high if scan.is_refinement else None
+                if precision[component][k] != expected:
+                    fail("coefficient {0} of component {1} is coded {2}".format(
+                        k, component, "twice" if expected is None else "out of order"))
+                precision[component][k] = scan.approximation_low
+
+    for component, coefficients in enumerate(precision):
+        missing = [k for k, low in enumerate(coefficients) if low != 0]
+        if missing:
+            raise ValueError("Coefficient {0} of component {1} is never coded to full precision".format(
+                missing[0], component))
+
+
+# </editor-fold>
+
+# <editor-fold desc="Scan symbols">
+def get_scan_blocks(mcus, width, height, components, scan, block_components=None):
+    """
+    :param mcus: int array of shape (MCUs, blocks per MCU, 64), the quantized coefficients in zig-zag order
+    :param block_components: Component index of every block of an MCU; defaults to block k being component k
+    :return: (coefficients of shape (blocks, 64), component index of every block), in the coding order of the scan:
+    MCU order for scans of several components, otherwise the raster order of the blocks of the component that
+    cover the image (a single component scan leaves out the blocks that only pad MCUs)
+    """
+    block_components = np.arange(mcus.shape[1]) if block_components is None else np.asarray(block_components)
+    if len(scan.components) > 1:
+        indices = np.flatnonzero(np.isin(block_components, scan.components))
+        return mcus[:, indices].reshape(-1, 64), np.tile(block_components[indices], len(mcus))
+
+    component_index = scan.components[0]
+    component = components[component_index]
+    max_horizontal = max(c.horizontal for c in components)
+    max_vertical = max(c.vertical for c in components)
+    mcus_per_line = -(-width // (8 * max_horizontal))
+    horizontal, vertical = component.horizontal, component.vertical
+
+    # (MCUs, vertical * horizontal, 64) -> (block lines, blocks per line, 64)
+    blocks = mcus[:, np.flatnonzero(block_components == component_index)]
+    blocks = blocks.reshape(-1, mcus_per_line, vertical, horizontal, 64).transpose(0, 2, 1, 3, 4)
+    blocks = blocks.reshape(-1, mcus_per_line * horizontal, 64)
+    blocks = blocks[:get_component_blocks(height, vertical, max_vertical),
+                    :get_component_blocks(width, horizontal, max_horizontal)].reshape(-1, 64)
+    return blocks, np.full(len(blocks), component_index)
+
+
+def get_component_blocks(size, sampling, max_sampling):
+    """
+    :param size: Width (or height) of the image
+    :return: Blocks per line (or block lines) of a component with the given sampling factor that cover the image,
+    without the blocks that only pad MCUs
+    """
+    samples = -(-size * sampling // max_sampling)
+    return -(-samples // 8)
+
+
+def get_progressive_symbols(coefficients, block_components, scan):
+    """
+    Turns the blocks of a scan into its entropy coding entries, like huffman.get_scan_symbols for sequential scans.
+    :param coefficients: int array of shape (blocks, 64) in zig-zag order, in coding order
+    :param block_components: int array with the component index of every block
+    :return: (is AC, component, symbol, extra bits, extra bit count), int arrays with one entry per symbol in coding
+    order; is AC is RAW for bits written as they are
+    """
+    coefficients = np.asarray(coefficients, dtype=np.int64)
+    block_components = np.asarray(block_components)
+    if scan.is_dc:
+        if scan.is_refinement:
+            bits = (coefficients[:, 0] >> scan.approximation_low) & 1
+            return np.full(len(bits), RAW), block_components, np.zeros(len(bits), dtype=np.int64), bits, \
+                np.ones(len(bits), dtype=np.int64)
+        return _get_dc_symbols(coefficients[:, 0] >> scan.approximation_low, block_components)
+
+    band = coefficients[:, scan.spectral_start:scan.spectral_end + 1]
+    if scan.is_refinement:
+        symbols = _get_ac_refinement_symbols(band, scan.approximation_low)
+    else:
+        symbols = _get_ac_first_symbols(band, scan.approximation_low)
+    is_ac, symbols, extra, extra_sizes = symbols
+    return is_ac, np.full(len(symbols), block_components[0] if len(block_components) else 0), symbols, extra, \
+        extra_sizes
+
+
+def _get_dc_symbols(values, block_components):
+    # Difference with the previous block of the same component
+    differences = np.empty(len(values), dtype=np.int64)
+    for component in np.unique(block_components):
+        index = np.flatnonzero(block_components == component)
+        differences[index] = np.diff(values[index], prepend=0)
+    sizes = get_sizes(differences)
+    return np.zeros(len(values), dtype=np.int64), block_components, sizes, get_magnitude_bits(differences, sizes), sizes
+
+
+def _get_ac_first_symbols(band, approximation_low):
+    """
+    :param band: int array of shape (blocks, band width), the coefficients of the band of every block
+    :return: (is AC, symbol, extra bits, extra bit count) of a first AC scan, in coding order
+    """
+    # The point transform of AC coefficients divides them rounding towards zero
+    values = np.where(band < 0, -(-band >> approximation_low), band >> approximation_low)
+    count, width = values.shape
+
+    blocks, positions = np.nonzero(values)
+    amplitudes = values[blocks, positions]
+    first = np.r_[True, blocks[1:] != blocks[:-1]][:len(positions)]
+    runs = positions - np.where(first, -1, np.roll(positions, 1)) - 1
+    sizes = get_sizes(amplitudes)
+
+    # Runs of more than 15 zeros start with one ZRL per 16 zeros
+    zrl_counts = runs >> 4
+    zrl_owners = np.repeat(np.arange(len(runs)), zrl_counts)
+    zrl_numbers = np.arange(len(zrl_owners)) - np.repeat(np.cumsum(zrl_counts) - zrl_counts, zrl_counts)
+
+    # Blocks ending with zeros (all zero blocks included) end with EOB. EOBs of consecutive blocks are coded as one
+    # EOB run, written before the next coefficient (so it takes in the EOB of the block of the coefficient, not
+    # the ones after) or once it is MAX_EOB_RUN long.
+    last = np.full(count, -1, dtype=np.int64)
+    np.maximum.at(last, blocks, positions)
+    eob_blocks = np.flatnonzero(last < width - 1)
+    groups = np.cumsum(last >= 0)[eob_blocks]
+    group_starts = np.r_[True, groups[1:] != groups[:-1]] if len(groups) else np.zeros(0, dtype=bool)
+    ranks = np.arange(len(eob_blocks)) - np.maximum.accumulate(np.where(group_starts, np.arange(len(eob_blocks)), 0))
+    run_starts = np.flatnonzero(ranks % MAX_EOB_RUN == 0)
+    run_ends = np.r_[run_starts[1:], len(eob_blocks)][:len(run_starts)].astype(np.int64) - 1
+    eob_runs = run_ends - run_starts + 1
+    eob_bits = get_sizes(eob_runs) - 1
+
+    block_numbers = np.concatenate((blocks, blocks[zrl_owners], eob_blocks[run_ends]))
+    keys = block_numbers * (65 * 17) + np.concatenate((
+        positions * 17 + 16,
+        positions[zrl_owners] * 17 + zrl_numbers,
+        np.full(len(run_ends), 64 * 17, dtype=np.int64)))
+    symbols = np.concatenate((((runs & 15) << 4) | sizes, np.full(len(zrl_owners), ZRL, dtype=np.int64),
+                              eob_bits << 4))
+    extra = np.concatenate((get_magnitude_bits(amplitudes, sizes), np.zeros(len(zrl_owners), dtype=np.int64),
+                            eob_runs - (1 << eob_bits)))
+    extra_sizes = np.concatenate((sizes, np.zeros(len(zrl_owners), dtype=np.int64), eob_bits))
+
+    order = np.argsort(keys, kind="stable")
+    return np.ones(len(keys), dtype=np.int64), symbols[order], extra[order], extra_sizes[order]
+
+
+def _get_ac_refinement_symbols(band, approximation_low):
+    """
+    :return: (is AC, symbol, extra bits, extra bit count) of an AC refinement scan, in coding order. Follows
+    encode_mcu_AC_refine of libjpeg: coefficients becoming non-zero are coded as run / size 1 symbols with their
+    sign, coefficients already non-zero get a correction bit, sent after the next symbol.
+    """
+    magnitudes = np.abs(band) >> approximation_low
+    count, width = magnitudes.shape
+    blocks, positions = np.nonzero(magnitudes)
+    values = magnitudes[blocks, positions]
+    signs = band[blocks, positions] >= 0
+    bounds = np.searchsorted(blocks, np.arange(0, count + 1)).tolist()
+    positions, values, signs = positions.tolist(), values.tolist(), signs.tolist()
+
+    entries = []
+    eob_run = 0
+    # Correction bits of the blocks of the pending EOB run
+    eob_corrections = []
+
+    def write_eob_run():
+        nonlocal eob_run, eob_corrections
+        if eob_run:
+            bits = eob_run.bit_length() - 1
+            entries.append((1, bits << 4, eob_run - (1 << bits), bits))
+            entries.extend((RAW, 0, bit, 1) for bit in eob_corrections)
+            eob_run = 0
+            eob_corrections = []
+
+    for block in range(0, count):
+        start, stop = bounds[block], bounds[block + 1]
+        # Position of the last coefficient becoming non-zero, ZRLs are only written before it
+        end = max((positions[k] for k in range(start, stop) if values[k] == 1), default=-1)
+
+        zeros = 0
+        previous = -1
+        corrections = []
+        for k in range(start, stop):
+            position = positions[k]
+            zeros += position - previous - 1
+            previous = position
+            while zeros > 15 and position <= end:
+                write_eob_run()
+                entries.append((1, ZRL, 0, 0))
+                entries.extend((RAW, 0, bit, 1) for bit in corrections)
+                corrections = []
+                zeros -= 16
+            if values[k] > 1:
+                corrections.append(values[k] & 1)
+                continue
+            write_eob_run()
+            entries.append((1, (zeros << 4) | 1, int(signs[k]), 1))
+            entries.extend((RAW, 0, bit, 1) for bit in corrections)
+            corrections = []
+            zeros = 0
+
+        zeros += width - 1 - previous
+        if zeros > 0 or corrections:
+            eob_run += 1
+            eob_corrections.extend(corrections)
+            if eob_run == MAX_EOB_RUN or len(eob_corrections) > MAX_CORRECTION_BITS:
+                write_eob_run()
+    write_eob_run()
+
+    entries = np.array(entries, dtype=np.int64).reshape(-1, 4)
+    return entries[:, 0], entries[:, 1], entries[:, 2], entries[:, 3]
+
+
+# </editor-fold>
+
+# <editor-fold desc="Scans">
+def encode_progressive_scan(width, height, components, mcus, scan, block_components=None):
+    """
+    Codes one scan with Huffman tables built for it, as libjpeg does in progressive mode (the standard tables have
+    no EOB run symbols). Scans are independent of each other, so they can be coded in parallel.
+    :param mcus: int array of shape (MCUs, blocks per MCU, 64) with the quantized coefficients in zig-zag order
+    :return: The DHT segment of the tables of the scan (if it has Huffman coded symbols), its SOS segment and its
+    entropy-coded bytes
+    """
+    coefficients, scan_components = get_scan_blocks(mcus, width, height, components, scan, block_components)
+    is_ac, symbol_components, symbols, extra, extra_sizes = get_progressive_symbols(coefficients, scan_components,
+                                                                                    scan)
+
+    # Table ids of every Huffman coded symbol, then one table per (class, id) used
+    coded = is_ac != RAW
+    table_ids = np.array([[c.dc_table, c.ac_table] for c in components])[symbol_components, np.maximum(is_ac, 0)]
+    table_count = get_table_count(components)
+    counts = np.zeros((2, table_count, 256), dtype=np.int64)
+    np.add.at(counts, (is_ac[coded], table_ids[coded], symbols[coded]), 1)
+    tables = {(table_class, table_id): HuffmanTable.from_frequencies(counts[table_class, table_id].tolist())
+              for table_class, table_id in zip(*np.nonzero(counts.any(axis=2)))}
+
+    code_arrays = np.zeros((2, table_count, 256), dtype=np.int64)
+    length_arrays = np.zeros((2, table_count, 256), dtype=np.int64)
+    for (table_class, table_id), table in tables.items():
+        code_arrays[table_class, table_id] = table.code_array
+        length_arrays[table_class, table_id] = table.length_array
+    codes = np.where(coded, code_arrays[np.maximum(is_ac, 0), table_ids, symbols], 0)
+    code_lengths = np.where(coded, length_arrays[np.maximum(is_ac, 0), table_ids, symbols], 0)
+    data = pack_bits((codes << extra_sizes) | extra, code_lengths + extra_sizes)
+
+    payload = bytearray()
+    for (table_class, table_id), table in sorted(tables.items()):
+        payload.append((table_class << 4) | table_id)
+        payload.extend(table.bits)
+        payload.extend(table.values)
+    return b"".join((segment(DHT, bytes(payload)) if tables else b"",
+                     sos_segment([components[index] for index in scan.components], scan.spectral_start,
+                                 scan.spectral_end, scan.approximation_high, scan.approximation_low),
+                     data))
+
+
+def get_progressive_headers(width, height, components, quantization_tables):
+    """
+    :return: Every segment of a progressive file that comes before its first scan
+    """
+    return b"".join((marker(SOI),
+                     app0_segment(),
+                     dqt_segment(quantization_tables),
+                     sof0_segment(width, height, components, SOF2)))
+
+# </editor-fold>
+
+# <editor-fold desc="Decoding">
+def decode_dc_first(reader, block, predictor, table, approximation_low):
+    """
+    Reads the DC coefficient of a block in a first DC scan.
+    :param block: The 64 coefficients of the block in zig-zag order (e.g. a numpy row), updated in place
+    :return: The new predictor of the component
+    """
+    predictor += reader.receive_extend(table.decode(reader))
+    block[0] = predictor << approximation_low
+    return predictor
+
+
+def decode_dc_refinement(reader, block, approximation_low):
+    if reader.read_bit():
+        block[0] |= 1 << approximation_low
+
+
+def decode_ac_first(reader, block, eob_run, table, scan):
+    """
+    Reads the band of a block in a first AC scan.
+    :param eob_run: Blocks left in the current EOB run, which have nothing coded in this scan
+    :return: The blocks left in the EOB run after this one
+    :raise: CorruptStreamException if the coefficients run past the end of the band
+    """
+    if eob_run > 0:
+        return eob_run - 1
+
+    k = scan.spectral_start
+    while k <= scan.spectral_end:
+        symbol = table.decode(reader)
+        run, size = symbol >> 4, symbol & 0x0F
+        if size:
+            k += run
+            if k > scan.spectral_end:
+                raise CorruptStreamException("Coefficient run past the end of the band")
+            block[k] = reader.receive_extend(size) * (1 << scan.approximation_low)
+            k += 1
+        elif run == 15:
+            k += 16
+        else:
+            # EOBn: this block and the next 2 ** n + extra bits - 1 blocks end here
+            return (1 << run) + (reader.read_bits(run) if run else 0) - 1
+    return 0
+
+
+def decode_ac_refinement(reader, block, eob_run, table, scan):
+    """
+    Reads the refinement bits of the band of a block in an AC refinement scan, as decode_mcu_AC_refine of libjpeg:
+    coefficients already non-zero get a correction bit, zero ones may become +-1 << approximation_low.
+    :return: The blocks left in the EOB run after this one
+    """
+    positive = 1 << scan.approximation_low
+    negative = -1 << scan.approximation_low
+    k = scan.spectral_start
+    end = scan.spectral_end
+
+    if eob_run == 0:
+        while k <= end:
+            symbol = table.decode(reader)
+            run, size = symbol >> 4, symbol & 0x0F
+            value = 0
+            if size:
+                value = positive if reader.read_bit() else negative
+            elif run != 15:
+                eob_run = (1 << run) + (reader.read_bits(run) if run else 0)
+                break
+
+            # Skip run zero coefficients (refining the non-zero ones on the way), up to the one the value goes to
+            while k <= end:
+                coefficient = block[k]
+                if coefficient != 0:
+                    _refine(reader, block, k, coefficient, positive, negative)
+                else:
+                    if run == 0:
+                        break
+                    run -= 1
+                k += 1
+            if value and k <= end:
+                block[k] = value
+            k += 1
+
+    if eob_run > 0:
+        # The rest of the band only has correction bits
+        while k <= end:
+            coefficient = block[k]
+            if coefficient != 0:
+                _refine(reader, block, k, coefficient, positive, negative)
+            k += 1
+        eob_run -= 1
+    return eob_run
+
+
+def _refine(reader, block, k, coefficient, positive, negative):
+    if reader.read_bit() and coefficient & positive == 0:
+        block[k] = coefficient + (positive if coefficient >= 0 else negative)
+
+# </editor-fold>
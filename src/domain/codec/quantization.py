@@ -0,0 +1,185 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Quantization matrix used for every component when no quality is given
+DEFAULT_QUANTIZATION_MATRIX = [
+    [6, 4, 4, 6, 10, 16, 20, 24],
+    [5, 5, 6, 8, 10, 23, 24, 22],
+    [6, 5, 6, 10, 16, 23, 28, 22],
+    [6, 7, 9, 12, 20, 35, 32, 25],
+    [7, 9, 15, 22, 27, 44, 41, 31],
+    [10, 14, 22, 26, 32, 42, 45, 37],
+    [20, 26, 31, 35, 41, 48, 48, 40],
+    [29, 37, 38, 39, 45, 40, 41, 40]
+]
+
+# Tables K.1 and K.2 of the standard, the tables the IJG quality setting scales
+STD_LUMINANCE_QUANTIZATION = [
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99]
+]
+
+STD_CHROMINANCE_QUANTIZATION = [
+    [17, 18, 24, 47, 99, 99, 99, 99],
+    [18, 21, 26, 66, 99, 99, 99, 99],
+    [24, 26, 56, 99, 99, 99, 99, 99],
+    [47, 66, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99]
+]
+
+LUMINANCE = 0
+CHROMINANCE = 1
+
+
+def get_scale_factor(quality):
+    """
+    :param quality: IJG quality, 1 (worst) to 100 (best); out of range values are clamped
+    :return: Percentage the standard tables are scaled by, 100 at quality 50
+    """
+    quality = min(max(int(quality), 1), 100)
+    if quality < 50:
+        return 5000 // quality
+    return 200 - 2 * quality
+
+
+@lru_cache(maxsize=None)
+def get_scaled_table(table, quality):
+    """
+    Scales a quantization table the way the IJG library does, clamping the entries to 1..255 so they fit the 8 bit
+    tables of a baseline file. Results are cached per (table, quality).
+    :param table: 8x8 table as a tuple of row tuples
+    :param quality: IJG quality, None to keep the table as it is
+    :return: Read-only float64 array of shape (8, 8)
+    """
+    scaled = np.array(table, dtype=np.float64)
+    if quality is not None:
+        scaled = np.clip(np.floor((scaled * get_scale_factor(quality) + 50) / 100), 1, 255)
+    scaled.setflags(write=False)
+    return scaled
+
+
+@lru_cache(maxsize=None)
+def get_reciprocal_table(table, quality):
+    """
+    :return: Read-only array with 1 / every entry of get_scaled_table(table, quality)
+    """
+    reciprocal = 1 / get_scaled_table(table, quality)
+    reciprocal.setflags(write=False)
+    return reciprocal
+
+
+class Quantizer:
+    """
+    Quantizes and dequantizes whole arrays of 8x8 coefficient blocks, with one table for luminance (id 0) and one for
+    chrominance (id 1).
+
+    Without a quality, both tables default to DEFAULT_QUANTIZATION_MATRIX, used as is. With an IJG quality (1-100),
+    they default to the standard luminance / chrominance tables, scaled for that quality. Scaled tables and their
+    reciprocals are cached per quality and shared by every quantizer, so building one is cheap.
+    """
+
+    def __init__(self, quality=None, luminance_table=None, chrominance_table=None):
+        """
+        :param quality: IJG quality, 1 (worst) to 100 (best), None for unscaled tables
+        :param luminance_table: 8x8 table (list of rows) for Y
+        :param chrominance_table: 8x8 table (list of rows) for Cb and Cr
+        """
+        self.quality = quality
+        self.luminance_table = luminance_table
+        self.chrominance_table = chrominance_table
+
+        default_luminance = DEFAULT_QUANTIZATION_MATRIX if quality is None else STD_LUMINANCE_QUANTIZATION
+        default_chrominance = DEFAULT_QUANTIZATION_MATRIX if quality is None else STD_CHROMINANCE_QUANTIZATION
+        self.base_tables = [tuple(tuple(line) for line in table) for table in (
+            luminance_table if luminance_table is not None else default_luminance,
+            chrominance_table if chrominance_table is not None else default_chrominance)]
+
+    @property
+    def tables(self):
+        """
+        :return: [luminance table, chrominance table], as float64 arrays of shape (8, 8)
+        """
+        return [get_scaled_table(table, self.quality) for table in self.base_tables]
+
+    @property
+    def reciprocals(self):
+        return [get_reciprocal_table(table, self.quality) for table in self.base_tables]
+
+    def with_quality(self, quality):
+        """
+        :return: A quantizer with the same tables (if any were given) and another quality
+        """
+        return Quantizer(quality, self.luminance_table, self.chrominance_table)
+
+    def transposed(self):
+        """
+        :return: A quantizer with the tables transposed, for coefficients transposed by a lossless transform (see
+        src.domain.codec.lossless.transform_blocks)
+        """
+        luminance, chrominance = (np.transpose(table).tolist() for table in self.base_tables)
+        return Quantizer(self.quality, luminance, chrominance)
+
+    def quantize(self, coefficients, table_id=LUMINANCE):
+        """
+        :param coefficients: Array of shape (..., 8, 8)
+        :param table_id: Table id, or an array of shape (components, 8, 8) from get_reciprocals() to quantize the
+        blocks of several components at once
+        :return: int16 array of the same shape with every coefficient divided by its table entry and rounded
+        """
+        reciprocal = self.reciprocals[table_id] if np.isscalar(table_id) else table_id
+        return np.round(coefficients * reciprocal).astype(np.int16)
+
+    def get_reciprocals(self, table_ids):
+        """
+        :param table_ids: Table id of every component
+        :return: Array of shape (components, 8, 8) with the reciprocal table of every component, for quantize()
+        """
+        reciprocals = self.reciprocals
+        return np.stack([reciprocals[table_id] for table_id in table_ids])
+
+    def get_integer_tables(self, table_ids):
+        """
+        :param table_ids: Table id of every component
+        :return: int32 array of shape (components, 8, 8) with the table of every component, for quantize_integers()
+        """
+        tables = self.tables
+        return np.stack([tables[table_id] for table_id in table_ids]).astype(np.int32)
+
+    def quantize_integers(self, coefficients, table_id=LUMINANCE, scale=1):
+        """
+        Integer only quantization for the coefficients of an integer DCT (see src.domain.codec.dct.IntegerDCTEngine):
+        every coefficient is divided by scale * its table entry and rounded half away from zero, like libjpeg does,
+        so the result is the same on every platform.
+        :param coefficients: int array of shape (..., 8, 8)
+        :param table_id: Table id, or an array of shape (components, 8, 8) from get_integer_tables()
+        :param scale: Factor the coefficients are scaled by
+        :return: int16 array of the same shape
+        """
+        table = self.tables[table_id] if np.isscalar(table_id) else table_id
+        divisors = np.asarray(table, dtype=np.int64) * scale
+        magnitudes = (np.abs(coefficients).astype(np.int64) + divisors // 2) // divisors
+        return np.where(coefficients < 0, -magnitudes, magnitudes).astype(np.int16)
+
+    def dequantize(self, coefficients, table_id=LUMINANCE, size=8):
+        """
+        :param coefficients: Array of shape (..., 8, 8)
+        :param size: Only the lowest size x size frequencies are dequantized (and returned), for scaled decoding
+        :return: float32 array of shape (..., size, size) with every coefficient multiplied by its table entry
+        """
+        return (coefficients[..., :size, :size] * self.tables[table_id][:size, :size]).astype(np.float32)
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "Quantizer(quality {0})".format(self.quality)
@@ -0,0 +1,118 @@
+from functools import lru_cache
+
+import numpy as np
+
+from src.domain.codec.huffman import get_sizes
+
+
+@lru_cache(maxsize=None)
+def get_zigzag_order(block_size=8):
+    """
+    :return: Read-only array with the natural (row-major) index of every coefficient of a block, in zig-zag order.
+    Cached per block size.
+    """
+    # Zig-zag visits the anti-diagonals in order, going up (decreasing line) on even ones and down on odd ones
+    cells = [(line, col) for line in range(0, block_size) for col in range(0, block_size)]
+    cells.sort(key=lambda cell: (cell[0] + cell[1], cell[1] if (cell[0] + cell[1]) % 2 == 0 else cell[0]))
+    order = np.array([line * block_size + col for line, col in cells])
+    order.setflags(write=False)
+    return order
+
+
+@lru_cache(maxsize=None)
+def get_natural_order(block_size=8):
+    """
+    :return: Read-only array with the zig-zag position of every natural (row-major) coefficient index
+    """
+    order = np.argsort(get_zigzag_order(block_size))
+    order.setflags(write=False)
+    return order
+
+
+def encode_run_lengths(blocks):
+    """
+    Run-length codes whole arrays of blocks.
+    Every block becomes [(DC size, DC), (zeros before, size, amplitude), ..., (0, 0)], the last tuple (end of block)
+    only being there when the block ends with zeros.
+    :param blocks: Array of shape (blocks, block size, block size), in natural order
+    :return: list with the run-length code of every block
+    """
+    blocks = np.asarray(blocks)
+    block_size = blocks.shape[-1]
+    coefficients = np.rint(blocks.reshape(len(blocks), -1)[:, get_zigzag_order(block_size)]).astype(np.int64)
+
+    # Every non-zero AC coefficient, with the zeros since the previous one of its block
+    block_numbers, positions = np.nonzero(coefficients[:, 1:])
+    positions = positions + 1
+    amplitudes = coefficients[block_numbers, positions]
+    first = np.r_[True, block_numbers[1:] != block_numbers[:-1]][:len(positions)]
+    previous = np.where(first, 0, np.roll(positions, 1))
+    runs = positions - previous - 1
+
+    symbols = list(zip(runs.tolist(), get_sizes(amplitudes).tolist(), amplitudes.tolist()))
+    ends = np.searchsorted(block_numbers, np.arange(1, len(blocks) + 1)).tolist()
+    dcs = coefficients[:, 0].tolist()
+    dc_sizes = get_sizes(coefficients[:, 0]).tolist()
+    has_end_of_block = (coefficients[:, -1] == 0).tolist()
+
+    entropies = []
+    start = 0
+    for number, end in enumerate(ends):
+        entropy = [(dc_sizes[number], dcs[number])]
+        entropy += symbols[start:end]
+        if has_end_of_block[number]:
+            entropy.append((0, 0))
+        entropies.append(entropy)
+        start = end
+    return entropies
+
+
+def decode_run_lengths(entropies, block_size=8):
+    """
+    The inverse of encode_run_lengths.
+    :return: int array of shape (blocks, block size, block size), in natural order
+    """
+    coefficients = np.zeros((len(entropies), block_size * block_size), dtype=np.int64)
+    coefficients[:, 0] = [entropy[0][1] for entropy in entropies]
+
+    symbols = [(number, symbol[0], symbol[2]) for number, entropy in enumerate(entropies)
+               for symbol in entropy[1:] if len(symbol) == 3]
+    if symbols:
+        block_numbers, runs, amplitudes = (np.array(values, dtype=np.int64) for values in zip(*symbols))
+        # Position of every coefficient: one past the previous one of its block, plus the zeros before it
+        steps = np.cumsum(runs + 1)
+        first = np.r_[True, block_numbers[1:] != block_numbers[:-1]]
+        block_starts = np.maximum.accumulate(np.where(first, np.arange(len(steps)), 0))
+        positions = steps - (steps - runs - 1)[block_starts]
+        coefficients[block_numbers, positions] = amplitudes
+
+    return coefficients[:, get_natural_order(block_size)].reshape(len(entropies), block_size, block_size)
+
+
+def get_zero_run_statistics(coefficients):
+    """
+    Statistics of the runs of zeros the entropy coder sees, for instrumentation.
+    :param coefficients: Integer array of shape (..., 64) in zig-zag order, or of shape (..., block size, block size)
+    in natural order
+    :return: dict of counts, which add up over stripes and components: blocks, zero coefficients, non-zero AC
+    coefficients, runs of zeros before them (count and total length), ZRL (16 zeros) symbols and blocks ending with
+    an end of block symbol
+    """
+    coefficients = np.asarray(coefficients)
+    if coefficients.shape[-1] != 64:
+        block_size = coefficients.shape[-1]
+        coefficients = coefficients.reshape(-1, block_size * block_size)[:, get_zigzag_order(block_size)]
+    coefficients = coefficients.reshape(-1, coefficients.shape[-1])
+
+    block_numbers, positions = np.nonzero(coefficients[:, 1:])
+    first = np.r_[True, block_numbers[1:] != block_numbers[:-1]][:len(positions)]
+    runs = positions - np.where(first, -1, np.roll(positions, 1)) - 1
+    return {
+        "blocks": len(coefficients),
+        "zero_coefficients": int(coefficients.size - np.count_nonzero(coefficients)),
+        "nonzero_ac": len(positions),
+        "zero_runs": int(np.count_nonzero(runs)),
+        "zero_run_length": int(runs.sum()),
+        "zrl_symbols": int((runs // 16).sum()),
+        "end_of_blocks": int(np.count_nonzero(coefficients[:, -1] == 0)),
+    }
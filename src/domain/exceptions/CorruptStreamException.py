@@ -0,0 +1,6 @@
+from src.domain.exceptions.BadImageException import BadImageException
+
+
+class CorruptStreamException(BadImageException):
+    def __init__(self, message):
+        super().__init__(message)
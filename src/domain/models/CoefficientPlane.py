@@ -0,0 +1,122 @@
+import numpy as np
+
+from src.domain.codec.dct import inverse_reduced_blocks
+from src.domain.models.Block import Block
+
+
+class CoefficientPlane:
+    """
+    Every block of one component of an image in a single contiguous array of shape
+    (blocks per column, blocks per line, block size, block size), in raster order.
+
+    Samples and DCT coefficients are stored as float32, quantized coefficients as int16. Blocks returned by block()
+    and blocks() are views: they share the memory of the plane, so changing their items changes the plane.
+    """
+
+    def __init__(self, array):
+        """
+        :param array: Array of shape (blocks per column, blocks per line, block size, block size), kept as is
+        """
+        self.array = array
+
+    @staticmethod
+    def empty(blocks_y, blocks_x, dtype=np.float32, block_size=8):
+        return CoefficientPlane(np.zeros((blocks_y, blocks_x, block_size, block_size), dtype=dtype))
+
+    @staticmethod
+    def from_blocks(items, blocks_per_line=None, dtype=np.float32):
+        """
+        :param items: Items of every block (lists of lines or arrays), in raster order
+        :param blocks_per_line: Blocks per line of the image, None to keep all blocks on a single line
+        """
+        array = np.array(items, dtype=dtype)
+        blocks_per_line = blocks_per_line or len(array)
+        return CoefficientPlane(array.reshape((len(array) // blocks_per_line, blocks_per_line) + array.shape[1:]))
+
+    @staticmethod
+    def from_samples(plane, dtype=np.float32, block_size=8):
+        """
+        :param plane: Array of shape (height, width), height and width multiples of the block size
+        """
+        height, width = plane.shape
+        array = plane.reshape(height // block_size, block_size, width // block_size, block_size).transpose(0, 2, 1, 3)
+        return CoefficientPlane(np.ascontiguousarray(array, dtype=dtype))
+
+    def to_samples(self):
+        """
+        :return: Array of shape (height, width) with the blocks put back in place
+        """
+        blocks_y, blocks_x, block_size, _ = self.array.shape
+        return self.array.transpose(0, 2, 1, 3).reshape(blocks_y * block_size, blocks_x * block_size)
+
+    @property
+    def blocks_y(self):
+        return self.array.shape[0]
+
+    @property
+    def blocks_x(self):
+        return self.array.shape[1]
+
+    @property
+    def block_size(self):
+        return self.array.shape[2]
+
+    def __len__(self):
+        return self.blocks_y * self.blocks_x
+
+    def block(self, index):
+        """
+        :return: Block viewing the items of the block at a raster index
+        """
+        return Block(self.array[index // self.blocks_x, index % self.blocks_x], index, shared=False)
+
+    def blocks(self):
+        """
+        :return: list of Block views, in raster order
+        """
+        return [self.block(index) for index in range(0, len(self))]
+
+    def set_block(self, index, items):
+        self.array[index // self.blocks_x, index % self.blocks_x] = items
+
+    # <editor-fold desc="Whole plane operations">
+    def forward_dct(self, engine):
+        """
+        :return: New plane with the DCT of every level shifted block
+        """
+        return CoefficientPlane(engine.forward_blocks(self.array - 128).astype(np.float32))
+
+    def inverse_dct(self, engine):
+        """
+        :return: New plane with the inverse DCT of every block, level shifted back
+        """
+        return CoefficientPlane((engine.inverse_blocks(self.array) + 128).astype(np.float32))
+
+    def inverse_dct_reduced(self, size):
+        """
+        :param size: Samples a side of the new blocks, see src.domain.codec.dct.inverse_reduced_blocks
+        :return: New plane of size x size blocks with the scaled inverse DCT of every block, level shifted back
+        """
+        return CoefficientPlane((inverse_reduced_blocks(self.array, size) + 128).astype(np.float32))
+
+    def quantize(self, quantizer, table_id):
+        """
+        :param quantizer: src.domain.codec.quantization.Quantizer
+        :return: New int16 plane with the quantized coefficients
+        """
+        return CoefficientPlane(quantizer.quantize(self.array, table_id))
+
+    def dequantize(self, quantizer, table_id, size=8):
+        """
+        :param size: Only the lowest size x size frequencies of every block are dequantized and kept
+        :return: New float32 plane with the dequantized coefficients
+        """
+        return CoefficientPlane(quantizer.dequantize(self.array, table_id, size))
+
+    # </editor-fold>
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "CoefficientPlane({0} x {1} blocks, {2})".format(self.blocks_y, self.blocks_x, self.array.dtype)
@@ -1,161 +1,312 @@
-import math
-from copy import deepcopy
+import os
 from enum import Enum
-from math import sqrt
 
+import numpy as np
+
+from src.domain.codec.dct import SCALE_DENOMINATORS, get_engine
+from src.domain.codec.decoder import read_jpeg
+from src.domain.codec.jfif import YCBCR_COMPONENTS, ZIGZAG, encode_jpeg
+from src.domain.codec.lossless import get_trimmed_size, get_transformed_size, get_crop_mcus, is_transposing, \
+    transform_blocks
+from src.domain.codec.quantization import Quantizer, LUMINANCE, CHROMINANCE
+from src.domain.codec.run_length import encode_run_lengths, decode_run_lengths, get_zero_run_statistics
 from src.domain.exceptions.FormatNotSupportedException import FormatNotSupportedException
 from src.domain.exceptions.InvalidSizeException import InvalidSizeException
 from src.domain.exceptions.PixelFormatException import PixelFormatException
 from src.domain.models import Block
 from src.domain.models.Block import Block
+from src.domain.models.CoefficientPlane import CoefficientPlane
 from src.domain.models.Pixels import PixelRGB, PixelYUV
-from src.util import Global
-from src.util.file_handler import write_lines_to_file, read_lines_from_file
+from src.util.color_space import rgb_to_yuv, yuv_to_rgb
+from src.util.file_handler import add_extension
+from src.util.instrumentation import get_instrumentation
+from src.util.netpbm import read_netpbm, write_netpbm
+from src.util.padding import get_padded_size, pad_edges
 
 
 class PixelType(Enum):
     RGB = 1
     YUV = 2
+    GRAY = 3
 
 
 class ImageType(Enum):
     PPM = "P3"
+    PPM_BINARY = "P6"
+    PGM = "P2"
+    PGM_BINARY = "P5"
+
+
+class StorageMode(Enum):
+    OBJECTS = 1  # One PixelRGB / PixelYUV object per pixel
+    PLANAR = 2  # One contiguous numpy plane per channel
 
 
 class Image:
-    def __init__(self, im_type, description, width, height, depth=255, pixels=None, pixel_type=None):
-        if im_type == "P3":
-            self.im_type = ImageType.PPM
+    def __init__(self, im_type, description, width, height, depth=255, pixels=None, pixel_type=None, planes=None,
+                 instrumentation=None):
+        """
+        :param pixels: Pixel objects, either as a list of lines or as a flat list (object storage)
+        :param planes: Array of shape (channels, height, width) with one plane per channel (planar storage). RGB and
+        GRAY planes are kept as uint8, YUV planes as float32. The planes may be a view into a larger buffer (e.g. a
+        memory-mapped file), they are not copied. Takes precedence over pixels.
+        :param instrumentation: src.util.instrumentation.Instrumentation recording the stages run on the image
+        """
+        self.im_type = im_type if isinstance(im_type, ImageType) else ImageType(im_type)
+        self.instrumentation = get_instrumentation(instrumentation)
 
         self.description = description
         self.width = width
         self.height = height
         self.depth = depth
+        self.pixel_type = pixel_type
+
+        if planes is not None:
+            self.storage = StorageMode.PLANAR
+            self.planes = np.asarray(planes)
+            self.__pixels = None
+            return
+
+        self.storage = StorageMode.OBJECTS
+        self.planes = None
 
         if pixels is None:
             pixels = [[] for _ in range(0, width) for _ in range(0, height)]
 
         try:
             _ = pixels[0][0]
-            self.pixels = deepcopy(pixels)
+            # Pixel objects are never changed in place, so the image can share them with the caller
+            self.__pixels = [list(line) for line in pixels]
         except Exception as e:
-            self.pixels = [[pixels[i + j * self.width] for i in range(0, width)] for j in range(0, height)]
-        self.pixel_type = pixel_type
+            self.__pixels = [[pixels[i + j * self.width] for i in range(0, width)] for j in range(0, height)]
+
+    @property
+    def pixels(self):
+        """
+        Pixel objects of the image as a list of lines. For planar images the objects are built on demand from the
+        planes, so changing them does not change the image.
+        """
+        if self.storage == StorageMode.PLANAR:
+            pixel_class = PixelRGB if self.pixel_type != PixelType.YUV else PixelYUV
+            first, second, third = (self.planes[k % len(self.planes)].tolist() for k in range(0, 3))
+            return [[pixel_class(*values) for values in zip(first[i], second[i], third[i])]
+                    for i in range(0, self.height)]
+        return self.__pixels
+
+    @pixels.setter
+    def pixels(self, pixels):
+        self.storage = StorageMode.OBJECTS
+        self.planes = None
+        self.__pixels = pixels
+
+    def get_pixel(self, line, col):
+        """
+        :return: The PixelRGB / PixelYUV at the given position, independent of the storage mode
+        """
+        if self.storage == StorageMode.PLANAR:
+            pixel_class = PixelRGB if self.pixel_type != PixelType.YUV else PixelYUV
+            values = self.planes[:, line, col].tolist()
+            return pixel_class(*(values * 3 if len(values) == 1 else values))
+        return self.__pixels[line][col]
+
+    def to_planar(self):
+        """
+        Switches the image to planar storage. Does nothing if the image is already planar.
+        """
+        if self.storage == StorageMode.PLANAR:
+            return
+
+        if self.pixel_type == PixelType.RGB:
+            planes = np.array([[[pixel.r, pixel.g, pixel.b] for pixel in line] for line in self.__pixels],
+                              dtype=np.uint8)
+        else:
+            planes = np.array([[[pixel.y, pixel.u, pixel.v] for pixel in line] for line in self.__pixels],
+                              dtype=np.float32)
+
+        self.planes = np.ascontiguousarray(planes.transpose(2, 0, 1))
+        self.storage = StorageMode.PLANAR
+        self.__pixels = None
+
+    def to_objects(self):
+        """
+        Switches the image to per-pixel object storage. Does nothing if the image already uses objects.
+        :raise: PixelFormatException for GRAY images, which only have planar storage
+        """
+        if self.storage == StorageMode.OBJECTS:
+            return
+        if self.pixel_type == PixelType.GRAY:
+            raise PixelFormatException("GRAY images can only be stored as planes")
+        self.pixels = self.pixels
 
     @staticmethod
-    def load(filename: str):
+    def load(filename: str, planar=False, use_mmap=True, instrumentation=None, scale_denominator=1, region=None):
         """
-        Reads an image from a file. The type is set by the file extension.
+        Reads an image from a file. PPM (P3 / P6) and PGM (P2 / P5) images are supported, the actual format is read
+        from the magic number. Baseline JPEG files are decoded and kept as binary PPM / PGM images.
+        Gray images are always stored as planes.
         :param filename: The file where the image should be read from
+        :param planar: Whether the image should be stored as numpy planes instead of pixel objects
+        :param use_mmap: Whether binary images should be memory-mapped. Planar images then keep a view into the
+        mapping instead of a copy of the pixel data.
+        :param instrumentation: src.util.instrumentation.Instrumentation recording this and later stages
+        :param scale_denominator: 1, 2, 4 or 8, JPEG files are decoded at 1 / scale_denominator of their size (see
+        JPEGDecoder), for thumbnails
+        :param region: (left, top, width, height) of the part of the image to load, None for all of it. Only the
+        blocks of JPEG files the region overlaps are decoded (see JPEGDecoder.decode_region), in the coordinates of
+        the scaled image; binary PPM / PGM files are only read there when memory-mapped.
         :return: None if file does not exist / Image with a type
+        :raise: ValueError if the region is not inside the image
         """
+        instrumentation = get_instrumentation(instrumentation)
+        with instrumentation.stage("load", file=os.path.basename(filename)) as span:
+            image = Image.__load(filename, planar, use_mmap, instrumentation, scale_denominator, region)
+            if image is not None:
+                image.instrumentation = instrumentation
+                span.count("pixels", image.width * image.height)
+        return image
+
+    @staticmethod
+    def __load(filename: str, planar, use_mmap, instrumentation, scale_denominator, region):
+        if filename.lower().endswith((".jpg", ".jpeg")):
+            return Image.__load_jpeg(filename, planar, instrumentation, scale_denominator, region)
+
+        if not filename.lower().endswith((".ppm", ".pgm", ".pnm")):
+            raise FormatNotSupportedException("Format .{0} is not yet supported :(".format(filename.split(".")[-1]))
 
-        # Get generator form file
-        file_generator = read_lines_from_file(filename)
+        netpbm = read_netpbm(filename, use_mmap)
 
-        # Check if file generator was created
-        if file_generator is None:
+        # Check if file was read
+        if netpbm is None:
             return None
 
-        if filename.lower().endswith(".ppm"):
-            # Get image type
-            image_type = next(file_generator)
+        header, samples = netpbm
+        image_type = header.magic.decode("ascii")
+        description = header.comments[0] if header.comments else "# Description"
+        if region is not None:
+            samples = _crop(samples, region)
+        height, width = samples.shape[:2]
 
-            # Get image description
-            image_description = next(file_generator)
+        if header.channels == 1:
+            return Image(image_type, description, width, height, header.depth,
+                         pixel_type=PixelType.GRAY, planes=samples.transpose(2, 0, 1))
 
-            # Get image size
-            width, height = tuple(map(int, next(file_generator).split(' ')))
+        if planar:
+            return Image(image_type, description, width, height, header.depth,
+                         pixel_type=PixelType.RGB, planes=samples.transpose(2, 0, 1))
 
-            # Get image depth
-            depth = int(next(file_generator))
+        # Construct rgb pixel list
+        pixels = [[PixelRGB(r, g, b) for r, g, b in line] for line in samples.tolist()]
 
-            # Construct rgb pixel list
-            pixels = []
-            for r_value in file_generator:
-                g_value = next(file_generator)
-                b_value = next(file_generator)
-                pixels.append(PixelRGB(int(r_value), int(g_value), int(b_value)))
+        # Construct and return image
+        return Image(image_type, description, width, height, header.depth, pixels, PixelType.RGB)
 
-            # Construct and return image
-            return Image(image_type, image_description, width, height, depth, pixels, PixelType.RGB)
-        else:
-            raise FormatNotSupportedException("Format .{0} is not yet supported :(".format(filename.split(".")[-1]))
+    @staticmethod
+    def __load_jpeg(filename: str, planar, instrumentation, scale_denominator, region):
+        if not os.path.isfile(filename):
+            return None
 
-    def save(self, filename: str):
+        planes = read_jpeg(filename, instrumentation=instrumentation, scale_denominator=scale_denominator,
+                           region=region)
+        if len(planes) == 1:
+            return Image(ImageType.PGM_BINARY, "# Description", planes.shape[2], planes.shape[1],
+                         pixel_type=PixelType.GRAY, planes=planes)
+
+        image = Image(ImageType.PPM_BINARY, "# Description", planes.shape[2], planes.shape[1],
+                      pixel_type=PixelType.RGB, planes=planes)
+        if not planar:
+            image.to_objects()
+        return image
+
+    def save(self, filename: str, im_type=None):
         """
-        Saves an image to the disk based on the image type.
+        Saves an image to the disk based on the image type. The samples are written straight from the pixel planes.
         :param filename: The filename for the image to be saved.
+        :param im_type: Optional ImageType to save as, defaults to the type of the image
         :return: None
         :raise: InvalidSizeException if actual pixels are less than the specified size
         :raise: PixelFormatException if pixel type is not suitable to image type
         """
+        with self.instrumentation.stage("save") as span:
+            span.count("pixels", self.width * self.height)
 
-        if len(self.pixels) * len(self.pixels[0]) != self.width * self.height:
-            raise InvalidSizeException("Actual pixels are less than the specified size")
-
-        if self.im_type == ImageType.PPM:
-            # Specify PPM file format
-            ppm_file_format = "{0}\n{1}\n{2}\n{3}\n{4}"
+            if self.__get_pixel_count() != self.width * self.height:
+                raise InvalidSizeException("Actual pixels are less than the specified size")
 
-            if self.pixel_type != PixelType.RGB:
-                raise PixelFormatException("Pixel type must be RGB")
+            im_type = self.im_type if im_type is None else im_type
 
-            image_string = ""
-            for line in self.pixels:
-                for pixel in line:
-                    image_string += "{0}\n{1}\n{2}\n".format(pixel.r, pixel.g, pixel.b)
+            if im_type in (ImageType.PPM, ImageType.PPM_BINARY):
+                if self.pixel_type != PixelType.RGB:
+                    raise PixelFormatException("Pixel type must be RGB")
+                file_format = ".ppm"
+            else:
+                if self.pixel_type != PixelType.GRAY:
+                    raise PixelFormatException("Pixel type must be GRAY")
+                file_format = ".pgm"
 
-            # Construct data string
-            ppm_image = ppm_file_format.format(self.im_type.value,
-                                               self.description,
-                                               "{0} {1}".format(self.width, self.height),
-                                               self.depth,
-                                               image_string)
+            if self.storage == StorageMode.PLANAR:
+                samples = self.planes.transpose(1, 2, 0)
+            else:
+                samples = np.array([[[pixel.r, pixel.g, pixel.b] for pixel in line] for line in self.pixels],
+                                   dtype=np.uint8)
 
-            write_lines_to_file(ppm_image, filename, ".ppm")
+            write_netpbm(add_extension(filename, file_format), im_type.value.encode("ascii"), samples, self.depth,
+                         self.description)
 
     def convert_color_space(self, pixel_type):
-        if pixel_type != self.pixel_type:
-            self.pixel_type = pixel_type
-
-            if self.pixel_type == PixelType.RGB:
-                self.pixels = [[pixel.get_pixel_rgb() for pixel in line] for line in self.pixels]
-            elif self.pixel_type == PixelType.YUV:
-                self.pixels = [[pixel.get_pixel_yuv() for pixel in line] for line in self.pixels]
+        with self.instrumentation.stage("convert_color_space", target=pixel_type.name) as span:
+            span.count("pixels", self.width * self.height)
+            if pixel_type != self.pixel_type:
+                if pixel_type == PixelType.GRAY:
+                    raise PixelFormatException("Can't convert colour images to GRAY")
+
+                if self.storage == StorageMode.PLANAR:
+                    if self.pixel_type == PixelType.GRAY:
+                        # GRAY -> RGB replicates the single plane
+                        self.planes = np.repeat(self.planes, 3, axis=0)
+                        if pixel_type == PixelType.YUV:
+                            self.planes = rgb_to_yuv(self.planes)
+                    elif pixel_type == PixelType.RGB:
+                        self.planes = yuv_to_rgb(self.planes)
+                    elif pixel_type == PixelType.YUV:
+                        self.planes = rgb_to_yuv(self.planes)
+                elif pixel_type == PixelType.RGB:
+                    self.pixels = [[pixel.get_pixel_rgb() for pixel in line] for line in self.pixels]
+                elif pixel_type == PixelType.YUV:
+                    self.pixels = [[pixel.get_pixel_yuv() for pixel in line] for line in self.pixels]
+
+                self.pixel_type = pixel_type
+
+    @property
+    def blocks_per_line(self):
+        """
+        :return: Number of 8x8 blocks on a line of split_into_blocks(), counting the partial block at the end
+        """
+        return get_padded_size(self.width, 8) // 8
 
     def split_into_blocks(self):
+        """
+        Splits a YUV image into 8x8 Y blocks and 4x4 (shrunk) U and V blocks, in raster order. Sizes that are not a
+        multiple of 8 are padded by repeating the last line and column of the planes.
+        """
+        with self.instrumentation.stage("split_into_blocks") as span:
+            blocks = self.__split_into_blocks()
+            span.count("blocks", sum(len(component_blocks) for component_blocks in blocks))
+            return blocks
+
+    def __split_into_blocks(self):
         if self.pixel_type == PixelType.YUV:
-            # Construct Y blocks
-            y_blocks = []
-            Global.position = 0
-            for line in range(0, self.height, 8):
-                for col in range(0, self.width, 8):
-                    y_blocks.append(
-                        Block([[self.pixels[i][j].y for i in range(line, line + 8)] for j in
-                               range(col, col + 8)], Global.position))
-
-            # Construct U blocks
-            u_blocks = []
-            Global.position = 0
-            for line in range(0, self.height, 8):
-                for col in range(0, self.width, 8):
-                    u_blocks.append(
-                        Block([[self.pixels[i][j].u for i in range(line, line + 8)] for j in
-                               range(col, col + 8)], Global.position))
+            if self.storage == StorageMode.PLANAR:
+                planes = self.planes
+            else:
+                planes = np.array([[[pixel.y for pixel in line] for line in self.pixels],
+                                   [[pixel.u for pixel in line] for line in self.pixels],
+                                   [[pixel.v for pixel in line] for line in self.pixels]])
+            planes = pad_edges(planes, get_padded_size(self.height, 8), get_padded_size(self.width, 8))
+            y_blocks, u_blocks, v_blocks = (Image.__cut_blocks(plane.tolist()) for plane in planes)
 
             for i in range(0, len(u_blocks)):
                 u_blocks[i].shrink()
 
-            # Construct V blocks
-            v_blocks = []
-            Global.position = 0
-            for line in range(0, self.height, 8):
-                for col in range(0, self.width, 8):
-                    v_blocks.append(
-                        Block([[self.pixels[i][j].v for i in range(line, line + 8)] for j in
-                               range(col, col + 8)], Global.position))
-
             for i in range(0, len(v_blocks)):
                 v_blocks[i].shrink()
 
@@ -164,232 +315,369 @@ class Image:
             raise FormatNotSupportedException("Can't yet split into RGB blocks")
 
     @staticmethod
-    def construct_from_blocks(blocks, width=800, height=600, depth=255):
-        y_blocks = deepcopy(blocks[0])
-        u_blocks = deepcopy(blocks[1])
-        v_blocks = deepcopy(blocks[2])
-
-        # Grow U blocks
-        for i in range(0, len(u_blocks)):
-            if u_blocks[i].block_size != 8:
-                u_blocks[i].grow()
-
-        # Grow Y blocks
-        for i in range(0, len(v_blocks)):
-            if v_blocks[i].block_size != 8:
-                v_blocks[i].grow()
-
-        # Build pixels
+    def __cut_blocks(plane, block_size=8):
+        """
+        :param plane: list of lines, both sides multiples of block_size
+        :return: list of the blocks of the plane in raster order, each block knowing its raster index
+        """
+        blocks_per_line = len(plane[0]) // block_size
+        return [Block([plane[i][col:col + block_size] for i in range(line, line + block_size)],
+                      (line // block_size) * blocks_per_line + col // block_size)
+                for line in range(0, len(plane), block_size)
+                for col in range(0, len(plane[0]), block_size)]
+
+    @staticmethod
+    def construct_from_blocks(blocks, width, height, depth=255, planar=False, instrumentation=None):
+        """
+        The inverse of split_into_blocks: puts the blocks back into a YUV image of the given size, the padding of the
+        blocks on the right and bottom edges is cropped.
+        :param instrumentation: src.util.instrumentation.Instrumentation, also given to the new image
+        """
+        instrumentation = get_instrumentation(instrumentation)
+        with instrumentation.stage("construct_from_blocks") as span:
+            span.count("blocks", sum(len(component_blocks) for component_blocks in blocks))
+            image = Image.__construct_from_blocks(blocks, width, height, depth, planar)
+            image.instrumentation = instrumentation
+            return image
+
+    @staticmethod
+    def __construct_from_blocks(blocks, width, height, depth, planar):
+        # The blocks are only read, shrunk U / V blocks are grown into new items
+        y_blocks, u_blocks, v_blocks = blocks
+        block_size = y_blocks[0].block_size
+        component_items = [[block.items for block in y_blocks]]
+        for component_blocks in (u_blocks, v_blocks):
+            component_items.append([block.items if block.block_size == block_size else block.get_grown_items()
+                                    for block in component_blocks])
+
+        # Build planes, block items are lists of lines
         total_blocks = len(y_blocks)
-        block_size = v_blocks[0].block_size
-        pixels = [[0 for _ in range(0, width)] for _ in range(0, height)]
-        step = width // block_size
+        planes = np.zeros((3, height, width), dtype=np.float32 if planar else np.float64)
+        blocks_per_line = get_padded_size(width, block_size) // block_size
         for block_no in range(0, total_blocks):
-            starting_j = (y_blocks[block_no].position_in_image // step) * block_size
-            starting_i = (y_blocks[block_no].position_in_image % step) * block_size
-
-            for i in range(0, block_size):
-                for j in range(0, block_size):
-                    pixel = PixelYUV(y_blocks[block_no].items[i][j],
-                                     u_blocks[block_no].items[i][j],
-                                     v_blocks[block_no].items[i][j])
-                    pixel_i = starting_i + i
-                    pixel_j = starting_j + j
-
-                    pixels[pixel_j][pixel_i] = pixel
-                    # for block_i in range(0, len(y_blocks), step):  # For the blocks forming a 800x8
-        #     for block_j in range(block_i, block_i + step):  # For the blocks in that line
-        #         for i in range(0, block_size):  # For going through the current block_no
-        #             for j in range(0, block_size):
-        #                 pixel = PixelYUV(y_blocks[block_j].items[i][j],
-        #                                  u_blocks[block_j].items[i][j],
-        #                                  v_blocks[block_j].items[i][j])
-        #                 pixels[block_i + i][block_j + block_size * j] = pixel
+            block_line, block_col = y_blocks[block_no].get_coordinates(blocks_per_line)
+            starting_line = block_line * block_size
+            starting_col = block_col * block_size
+            lines = min(block_size, height - starting_line)
+            cols = min(block_size, width - starting_col)
+
+            for k, items in enumerate(component_items):
+                block_items = items[block_no]
+                if lines < block_size or cols < block_size:
+                    # Only the blocks on the edges are cropped
+                    block_items = np.asarray(block_items)[:lines, :cols]
+                planes[k, starting_line:starting_line + lines, starting_col:starting_col + cols] = block_items
+
+        # Clamp like PixelYUV does
+        np.clip(planes, 0, 255, out=planes)
+        image = Image("P3", "# Description", width, height, depth, pixel_type=PixelType.YUV, planes=planes)
+        if not planar:
+            image.to_objects()
 
         # Return image
-        return Image("P3", "# Description", width, height, depth, pixels, PixelType.YUV)
+        return image
+
+    def __get_pixel_count(self):
+        if self.storage == StorageMode.PLANAR:
+            return self.planes.shape[1] * self.planes.shape[2]
+        return len(self.pixels) * len(self.pixels[0])
 
     def __repr__(self):
         return str(self)
 
     def __str__(self):
         return "{0} image, {1} x {2}, {3} actual pixels".format(self.im_type, self.width, self.height,
-                                                                len(self.pixels) * len(self.pixels[0]))
+                                                                self.__get_pixel_count())
 
 
 class DCTImage:
-    sqrt2 = sqrt(2)
-
-    def __init__(self, y_blocks, u_blocks, v_blocks, must_build=True):
-        Global.position = 0
+    def __init__(self, y_blocks, u_blocks, v_blocks, must_build=True, engine=None, blocks_per_line=None,
+                 instrumentation=None):
+        """
+        :param engine: DCT engine used for the transform, either a name from src.domain.codec.dct.ENGINES
+        ("naive", "matrix", "aan", "islow") or a DCTEngine instance. Defaults to the fast AAN engine.
+        :param blocks_per_line: Blocks per line of the image, None to store the blocks as a single line
+        :param instrumentation: src.util.instrumentation.Instrumentation, passed on to the quantized images
+        """
+        self.engine = get_engine(engine)
+        self.instrumentation = get_instrumentation(instrumentation)
+        # One CoefficientPlane per component (y/cb/cr), shrunk blocks are grown back to full size
+        self.planes = [CoefficientPlane.from_blocks([block.items if block.block_size == 8 else block.get_grown_items()
+                                                     for block in blocks], blocks_per_line)
+                       for blocks in (y_blocks, u_blocks, v_blocks)]
         if must_build:
-            # Blocks are tuples of (y/cb/cr)
-            self.dct_blocks = [DCTImage.block_to_dct(y_blocks[i], u_blocks[i], v_blocks[i]) for i in
-                               range(len(y_blocks))]
-        else:
-            self.dct_blocks = [(y_blocks[i], u_blocks[i], v_blocks[i]) for i in range(0, len(y_blocks))]
+            with self.instrumentation.stage("dct", engine=self.engine.name) as span:
+                span.count("blocks", _count_blocks(self.planes))
+                self.planes = [plane.forward_dct(self.engine) for plane in self.planes]
 
-    @staticmethod
-    def a(u):
-        if u > 0:
-            return 1
-        return 1 / DCTImage.sqrt2
+    def quantize(self, quantizer=None):
+        """
+        Quantizes the DCT coefficients, which are left unchanged: call it again with other quantizers (e.g. other
+        qualities) to re-encode without running the DCT again.
+        :return: QuantizationImage
+        """
+        return QuantizationImage(self, quantizer)
+
+    @property
+    def dct_blocks(self):
+        """
+        :return: list of (y, cb, cr) tuples of Block views onto the planes
+        """
+        return list(zip(*(plane.blocks() for plane in self.planes)))
 
     # <editor-fold desc="Block to dct">
     @staticmethod
-    def block_to_dct(y_block: Block, u_block: Block, v_block: Block):
-        y_block = deepcopy(y_block)
-        u_block = deepcopy(u_block)
-        v_block = deepcopy(v_block)
-
-        y_block.subtract_from_values(128)
+    def block_to_dct(y_block: Block, u_block: Block, v_block: Block, engine=None):
+        engine = get_engine(engine)
 
-        u_block.grow()
-        u_block.subtract_from_values(128)
+        # The input blocks are left unchanged: the level shift goes into new items, which the DCT blocks own
+        y_items = DCTImage.level_shift(y_block.items)
+        u_items = DCTImage.level_shift(u_block.get_grown_items())
+        v_items = DCTImage.level_shift(v_block.get_grown_items())
 
-        v_block.grow()
-        v_block.subtract_from_values(128)
-
-        block_size = y_block.block_size
-
-        y_dct_block = Block([[0 for _ in range(0, block_size)] for _ in range(0, block_size)], Global.position)
-        u_dct_block = Block([[0 for _ in range(0, block_size)] for _ in range(0, block_size)], Global.position)
-        v_dct_block = Block([[0 for _ in range(0, block_size)] for _ in range(0, block_size)], Global.position)
-
-        for u in range(0, block_size):
-            for v in range(0, block_size):
-                base_value = 1 / 4 * DCTImage.a(u) * DCTImage.a(v)
-                y_dct_block.items[u][v] = base_value * DCTImage.outer_sum_to_dct(y_block, u, v, block_size)
-                u_dct_block.items[u][v] = base_value * DCTImage.outer_sum_to_dct(u_block, u, v, block_size)
-                v_dct_block.items[u][v] = base_value * DCTImage.outer_sum_to_dct(v_block, u, v, block_size)
+        y_dct_block = Block(engine.forward(y_items), y_block.position_in_image, shared=False)
+        u_dct_block = Block(engine.forward(u_items), u_block.position_in_image, shared=False)
+        v_dct_block = Block(engine.forward(v_items), v_block.position_in_image, shared=False)
         return y_dct_block, u_dct_block, v_dct_block
 
     @staticmethod
-    def outer_sum_to_dct(block: Block, u, v, block_size=8):
-        total = 0.0
-        for x in range(0, block_size):
-            total += DCTImage.inner_sum_to_dct(block, u, v, x, block_size)
-        return total
-
-    @staticmethod
-    def inner_sum_to_dct(block: Block, u, v, x, block_size=8):
-        total = 0.0
-        for y in range(0, block_size):
-            total += DCTImage.product_dct(block.items[x][y], x, y, u, v)
-        return total
-
-    @staticmethod
-    def product_dct(block_value, x, y, u, v):
-        u_val = ((2 * x + 1) * u * math.pi) / 16
-        v_val = ((2 * y + 1) * v * math.pi) / 16
-        return block_value * math.cos(u_val) * math.cos(v_val)
+    def level_shift(items, shift=-128):
+        """
+        :return: New items with shift added to every item
+        """
+        return [[item + shift for item in line] for line in items]
 
     # </editor-fold>
 
     @staticmethod
-    def inverse_dct(quantization_image):
-        y_blocks = []
-        u_blocks = []
-        v_blocks = []
-
-        y_q_blocks = [block[0] for block in quantization_image.blocks]
-        u_q_blocks = [block[1] for block in quantization_image.blocks]
-        v_q_blocks = [block[2] for block in quantization_image.blocks]
-
-        for block_no in range(0, len(y_q_blocks)):
-            result = DCTImage.inverse_dct_per_block(y_q_blocks[block_no], u_q_blocks[block_no], v_q_blocks[block_no])
+    def inverse_dct(quantization_image, engine=None):
+        engine = get_engine(engine)
 
-            y_blocks.append(result[0])
-            u_blocks.append(result[1])
-            v_blocks.append(result[2])
-
-        for i in range(0, len(y_q_blocks)):
-            y_blocks[i].add_to_values()
-            y_blocks[i].position_in_image = i
-            u_blocks[i].add_to_values()
-            u_blocks[i].position_in_image = i
-            v_blocks[i].add_to_values()
-            v_blocks[i].position_in_image = i
-
-        return y_blocks, u_blocks, v_blocks
+        with quantization_image.instrumentation.stage("idct", engine=engine.name) as span:
+            span.count("blocks", _count_blocks(quantization_image.planes))
+            # Blocks are views onto the planes, in raster order
+            y_plane, u_plane, v_plane = (plane.inverse_dct(engine) for plane in quantization_image.planes)
+            return y_plane.blocks(), u_plane.blocks(), v_plane.blocks()
 
     @staticmethod
-    def inverse_dct_per_block(y_q_block: Block, u_q_block: Block, v_q_block: Block):
-        block_size = y_q_block.block_size
-
-        y_dct_block = Block([[0 for _ in range(0, block_size)] for _ in range(0, block_size)], Global.position)
-        u_dct_block = Block([[0 for _ in range(0, block_size)] for _ in range(0, block_size)], Global.position)
-        v_dct_block = Block([[0 for _ in range(0, block_size)] for _ in range(0, block_size)], Global.position)
+    def inverse_dct_per_block(y_q_block: Block, u_q_block: Block, v_q_block: Block, engine=None):
+        engine = get_engine(engine)
 
-        for x in range(0, block_size):
-            for y in range(0, block_size):
-                base_value = 1 / 4
-                y_dct_block.items[x][y] = base_value * DCTImage.outer_sum_from_dct(y_q_block, x, y, block_size)
-                u_dct_block.items[x][y] = base_value * DCTImage.outer_sum_from_dct(u_q_block, x, y, block_size)
-                v_dct_block.items[x][y] = base_value * DCTImage.outer_sum_from_dct(v_q_block, x, y, block_size)
+        y_dct_block = Block(engine.inverse(y_q_block.items), y_q_block.position_in_image, shared=False)
+        u_dct_block = Block(engine.inverse(u_q_block.items), u_q_block.position_in_image, shared=False)
+        v_dct_block = Block(engine.inverse(v_q_block.items), v_q_block.position_in_image, shared=False)
 
         return y_dct_block, u_dct_block, v_dct_block
 
-    @staticmethod
-    def outer_sum_from_dct(block: Block, x, y, block_size=8):
-        total = 0.0
-        for u in range(0, block_size):
-            total += DCTImage.inner_sum_from_dct(block, x, y, u, block_size)
-        return total
-
-    @staticmethod
-    def inner_sum_from_dct(block: Block, x, y, u, block_size=8):
-        total = 0.0
-        for v in range(0, block_size):
-            total += DCTImage.a(u) * DCTImage.a(v) * DCTImage.product_dct(block.items[u][v], x, y, u, v)
-        return total
-
 
 class QuantizationImage:
-    def __init__(self, dct_image: DCTImage):
-        self.blocks = deepcopy(dct_image.dct_blocks)  # Blocks are tuples of (y/cb/cr)
+    # Quantization table id of every component (y/cb/cr)
+    TABLE_IDS = (LUMINANCE, CHROMINANCE, CHROMINANCE)
+
+    def __init__(self, dct_image: DCTImage, quantizer=None, instrumentation=None):
+        """
+        :param quantizer: Quantizer with the luminance / chrominance tables, defaults to Quantizer() which uses
+        DEFAULT_QUANTIZATION_MATRIX for every component
+        :param instrumentation: src.util.instrumentation.Instrumentation, defaults to the one of the DCT image
+        """
+        self.instrumentation = dct_image.instrumentation if instrumentation is None else instrumentation
+        # One CoefficientPlane per component (y/cb/cr). quantize() replaces the DCT planes with new int16 planes, so
+        # the DCT image is left unchanged and can be quantized again with other settings.
+        self.planes = dct_image.planes
+        self.quantizer = quantizer if quantizer is not None else Quantizer()
         self.quantize()
         self.entropy_blocks = None
 
+    @staticmethod
+    def from_planes(planes, quantizer, instrumentation=None):
+        """
+        :param planes: One CoefficientPlane of quantized coefficients per component (y/cb/cr), kept as they are
+        :param quantizer: Quantizer the coefficients were quantized with
+        :return: QuantizationImage of the planes
+        """
+        image = QuantizationImage.__new__(QuantizationImage)
+        image.instrumentation = get_instrumentation(instrumentation)
+        image.planes = planes
+        image.quantizer = quantizer
+        image.entropy_blocks = None
+        return image
+
+    @property
+    def blocks(self):
+        """
+        :return: list of (y, cb, cr) tuples of Block views onto the planes
+        """
+        return list(zip(*(plane.blocks() for plane in self.planes)))
+
     def quantize(self):
-        for i in range(0, len(self.blocks)):
-            for m in range(0, 8):
-                for n in range(0, 8):
-                    for k in range(0, 3):
-                        self.blocks[i][k].items[m][n] //= self.get_quantization_matrix()[m][n]
+        with self.instrumentation.stage("quantize") as span:
+            self.planes = [plane.quantize(self.quantizer, table_id)
+                           for plane, table_id in zip(self.planes, QuantizationImage.TABLE_IDS)]
+            if self.instrumentation.enabled:
+                span.count("blocks", _count_blocks(self.planes))
+                span.count("zero_coefficients", sum(int(np.count_nonzero(plane.array == 0)) for plane in self.planes))
 
     def entropy_encoding(self):
-        self.entropy_blocks = []
-        for i in range(0, len(self.blocks)):
-            self.entropy_blocks.append((self.blocks[i][0].get_entropy(),
-                                        self.blocks[i][1].get_entropy(),
-                                        self.blocks[i][2].get_entropy()))
+        with self.instrumentation.stage("entropy_encode") as span:
+            # Every plane is run-length coded at once, entropy blocks are tuples of (y/cb/cr) codes
+            entropies = [encode_run_lengths(plane.array.reshape((-1,) + plane.array.shape[2:]))
+                         for plane in self.planes]
+            self.entropy_blocks = list(zip(*entropies))
+            if self.instrumentation.enabled:
+                for plane in self.planes:
+                    span.update(get_zero_run_statistics(plane.array))
 
     def entropy_decoding(self):
         if self.entropy_blocks is None:
             raise KeyError('Entropy hasn\'t ran yet')
 
-        for i in range(0, len(self.entropy_blocks)):
-            self.blocks[i] = (Block.get_from_entropy(self.entropy_blocks[i][0]),
-                              Block.get_from_entropy(self.entropy_blocks[i][1]),
-                              Block.get_from_entropy(self.entropy_blocks[i][2]))
+        with self.instrumentation.stage("entropy_decode") as span:
+            span.count("blocks", len(self.entropy_blocks) * len(self.planes))
+            for k, plane in enumerate(self.planes):
+                items = decode_run_lengths([blocks[k] for blocks in self.entropy_blocks], plane.block_size)
+                plane.array[...] = items.reshape(plane.array.shape)
+
+    def to_jpeg(self, width, height, optimize_huffman=False, restart_interval=0, restart_index=False):
+        """
+        Huffman codes the quantized blocks into a baseline JFIF file (one Y, Cb and Cr block per MCU).
+        :param width: Image width, the blocks are expected in raster order
+        :param height: Image height
+        :param optimize_huffman: Whether to build per-image Huffman tables instead of the standard Annex K ones
+        :param restart_interval: MCUs (blocks) per restart interval, 0 for no restart markers
+        :param restart_index: Whether to write the offsets of the restart intervals in an APP9 segment, so decoders
+        can seek to any of them
+        :return: bytes of the .jpg file
+        """
+        # (MCUs, components, 64) in zig-zag order
+        with self.instrumentation.stage("huffman_encode", optimize_huffman=optimize_huffman) as span:
+            coefficients = np.stack([plane.array.reshape(-1, 64)[:, ZIGZAG] for plane in self.planes], axis=1)
+            mcus = [list(enumerate(mcu)) for mcu in coefficients.tolist()]
+            data = encode_jpeg(width, height, YCBCR_COMPONENTS, self.quantizer.tables, mcus, optimize_huffman,
+                               restart_interval, restart_index)
+            span.count("mcus", len(mcus))
+            span.count("output_bits", len(data) * 8)
+            return data
+
+    def save_jpeg(self, filename: str, width, height, optimize_huffman=False, restart_interval=0,
+                  restart_index=False):
+        """
+        Saves the quantized blocks as a baseline JFIF file, see to_jpeg.
+        :return: The number of bytes written
+        """
+        data = self.to_jpeg(width, height, optimize_huffman, restart_interval, restart_index)
+        with open(add_extension(filename, ".jpg"), "wb") as file:
+            file.write(data)
+        return len(data)
 
     def dequantize(self):
-        for i in range(0, len(self.blocks)):
-            for m in range(0, 8):
-                for n in range(0, 8):
-                    for k in range(0, 3):
-                        self.blocks[i][k].items[m][n] *= self.get_quantization_matrix()[m][n]
+        with self.instrumentation.stage("dequantize") as span:
+            span.count("blocks", _count_blocks(self.planes))
+            self.planes = [plane.dequantize(self.quantizer, table_id)
+                           for plane, table_id in zip(self.planes, QuantizationImage.TABLE_IDS)]
+
+    def decode_scaled(self, width, height, scale_denominator=8, planar=False):
+        """
+        Decodes the quantized blocks at 1 / scale_denominator of the image size, for thumbnails: only the lowest
+        8 / scale_denominator x 8 / scale_denominator frequencies of every block are dequantized and inverse
+        transformed (the DC coefficient alone at 1/8), into that many samples. The quantized planes are left
+        unchanged, so dequantize can still run after it.
+        :param width: Image width, the blocks are expected in raster order
+        :param height: Image height
+        :param scale_denominator: 1, 2, 4 or 8
+        :param planar: Whether the image should be stored as numpy planes instead of pixel objects
+        :return: YUV Image of ceil(width / scale_denominator) x ceil(height / scale_denominator), like
+        Image.construct_from_blocks
+        :raise: KeyError if the scale is not one of SCALE_DENOMINATORS
+        """
+        if scale_denominator not in SCALE_DENOMINATORS:
+            raise KeyError("Unknown scale 1/{0}, expected one of {1}".format(
+                scale_denominator, ", ".join("1/{0}".format(d) for d in SCALE_DENOMINATORS)))
+        size = 8 // scale_denominator
+        scaled_width, scaled_height = -(-width // scale_denominator), -(-height // scale_denominator)
+
+        with self.instrumentation.stage("decode_scaled", scale_denominator=scale_denominator) as span:
+            span.count("blocks", _count_blocks(self.planes))
+            planes = [plane.dequantize(self.quantizer, table_id, size).inverse_dct_reduced(size).to_samples()
+                      for plane, table_id in zip(self.planes, QuantizationImage.TABLE_IDS)]
+            planes = np.stack(planes)[:, :scaled_height, :scaled_width]
+            np.clip(planes, 0, 255, out=planes)
+            span.count("pixels", scaled_width * scaled_height)
+
+        image = Image("P3", "# Description", scaled_width, scaled_height, pixel_type=PixelType.YUV,
+                      planes=planes if planar else planes.astype(np.float64), instrumentation=self.instrumentation)
+        if not planar:
+            image.to_objects()
+        return image
+
+    # <editor-fold desc="Lossless transforms">
+    def transform(self, transform, width, height):
+        """
+        Rotates or flips the quantized blocks losslessly, like jpegtran (see src.domain.codec.lossless): the blocks
+        are reordered and their coefficients transposed or negated, with no inverse DCT, DCT or quantization, so
+        to_jpeg gives the transformed image without generation loss. Partial blocks at the mirrored edges are
+        dropped.
+        :param transform: Name from src.domain.codec.lossless.TRANSFORMS, e.g. "rotate_90"
+        :param width: Image width, the blocks are expected in raster order
+        :param height: Image height
+        :return: (new QuantizationImage, its width, its height); the tables of its quantizer are transposed for
+        transposing transforms
+        :raise: KeyError if the transform is unknown
+        """
+        trimmed_width, trimmed_height = get_trimmed_size(width, height, 8, 8, transform)
+        with self.instrumentation.stage("lossless_transform", transform=transform) as span:
+            span.count("blocks", _count_blocks(self.planes))
+            planes = [CoefficientPlane(transform_blocks(
+                self.__get_blocks(plane, width)[:-(-trimmed_height // 8), :-(-trimmed_width // 8)], transform))
+                for plane in self.planes]
+        quantizer = self.quantizer.transposed() if is_transposing(transform) else self.quantizer
+        return (QuantizationImage.from_planes(planes, quantizer, self.instrumentation),
+                *get_transformed_size(trimmed_width, trimmed_height, transform))
+
+    def crop(self, region, width, height):
+        """
+        Crops the quantized blocks losslessly.
+        :param region: (left, top, width, height), left and top multiples of 8
+        :param width: Image width, the blocks are expected in raster order
+        :param height: Image height
+        :return: New QuantizationImage of the blocks of the region, region width x region height
+        :raise: ValueError if the region is not inside the image or does not start on a block boundary
+        """
+        (first_column, last_column), (first_line, last_line) = get_crop_mcus(region, width, height, 8, 8)
+        planes = [CoefficientPlane(np.ascontiguousarray(
+            self.__get_blocks(plane, width)[first_line:last_line, first_column:last_column]))
+            for plane in self.planes]
+        return QuantizationImage.from_planes(planes, self.quantizer, self.instrumentation)
+
+    @staticmethod
+    def __get_blocks(plane, width):
+        """
+        :return: The blocks of a plane as lines of blocks of the image, the planes may hold them as a single line
+        """
+        return plane.array.reshape((-1, -(-width // 8)) + plane.array.shape[2:])
+
+    # </editor-fold>
 
     def get_quantization_matrix(self):
-        return \
-            [
-                [6, 4, 4, 6, 10, 16, 20, 24],
-                [5, 5, 6, 8, 10, 23, 24, 22],
-                [6, 5, 6, 10, 16, 23, 28, 22],
-                [6, 7, 9, 12, 20, 35, 32, 25],
-                [7, 9, 15, 22, 27, 44, 41, 31],
-                [10, 14, 22, 26, 32, 42, 45, 37],
-                [20, 26, 31, 35, 41, 48, 48, 40],
-                [29, 37, 38, 39, 45, 40, 41, 40]
-            ]
+        """
+        :return: The luminance quantization table, as a list of rows
+        """
+        return self.quantizer.tables[LUMINANCE].astype(int).tolist()
+
+
+def _crop(samples, region):
+    """
+    :param samples: Array of shape (height, width, channels)
+    :param region: (left, top, width, height)
+    :return: View of the samples of the region
+    :raise: ValueError if the region is empty or not inside the image
+    """
+    left, top, width, height = region
+    if width <= 0 or height <= 0 or left < 0 or top < 0 or left + width > samples.shape[1] or \
+            top + height > samples.shape[0]:
+        raise ValueError("Region {0}x{1}+{2}+{3} is not inside the {4}x{5} image".format(
+            width, height, left, top, samples.shape[1], samples.shape[0]))
+    return samples[top:top + height, left:left + width]
+
+
+def _count_blocks(planes):
+    return sum(len(plane) for plane in planes)
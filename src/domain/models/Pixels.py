@@ -31,7 +31,7 @@ class PixelYUV:
     def get_pixel_rgb(self):
         r = self.y + 1.402 * (self.v - 128)
         g = self.y - 0.344136 * (self.u - 128) - 0.714136 * (self.v - 128)
-        b = self.y + 0.1772 * (self.u - 128)
+        b = self.y + 1.772 * (self.u - 128)
         return PixelRGB(math.trunc(r), math.trunc(g), math.trunc(b))
 
     def __repr__(self):
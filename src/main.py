@@ -1,9 +1,12 @@
+import time
+
 from src.domain.models.Image import Image, PixelType, DCTImage, QuantizationImage
 
 if __name__ == '__main__':
     ppm_filename = "../data/in.ppm"
     ppm_save_filename = "../data/out."
     ppm_blocks_save_filename = "../data/out_b."
+    jpeg_save_filename = "../data/out.jpg"
 
     # Encoder
     print("Loading image...")
@@ -19,7 +22,7 @@ if __name__ == '__main__':
     yb[0].get_entropy()
 
     print("fDCT")
-    dct_image = DCTImage(yb, ub, vb)
+    dct_image = DCTImage(yb, ub, vb, blocks_per_line=image.blocks_per_line)
 
     print("Quantization")
     quantization_image = QuantizationImage(dct_image)
@@ -27,6 +30,14 @@ if __name__ == '__main__':
     print("Running entropy encoding")
     quantization_image.entropy_encoding()
 
+    print("Saving JPEG...")
+    start = time.time()
+    jpeg_size = quantization_image.save_jpeg(jpeg_save_filename, image.width, image.height, optimize_huffman=True)
+    elapsed = time.time() - start
+    raw_size = image.width * image.height * 3
+    print("{0} bytes, compression ratio {1:.2f}, {2:.0f} bytes/s".format(jpeg_size, raw_size / jpeg_size,
+                                                                         raw_size / elapsed))
+
     # Decoder
     print("Running entropy decoding")
     quantization_image.entropy_decoding()
@@ -0,0 +1,516 @@
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qsl
+
+from src.cli import percentile
+from src.domain.codec.dct import DEFAULT_ENGINE, SCALE_DENOMINATORS, get_engine
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.encoder import JPEGEncoder
+from src.domain.exceptions.BadImageException import BadImageException
+from src.domain.exceptions.FormatNotSupportedException import FormatNotSupportedException
+from src.domain.exceptions.PixelFormatException import PixelFormatException
+from src.util.cache import DEFAULT_MAX_BYTES, get_cache
+from src.util.netpbm import parse_netpbm, write_netpbm_stream
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+# Requests waiting for a worker; once full, new requests are answered 503 right away (backpressure)
+DEFAULT_QUEUE_SIZE = 64
+
+# Requests sent to a worker at once, and how long a batch waits for more requests once it has one
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_BATCH_DELAY = 0.005
+
+DEFAULT_MAX_UPLOAD = 256 * 2 ** 20
+MAX_HEADERS = 100
+
+# Latencies kept for the percentiles of /metrics
+LATENCY_WINDOW = 1024
+
+
+def _parse_flag(value):
+    return value.lower() in ("1", "true", "yes")
+
+
+# Query parameters of /encode -> (JPEGEncoder argument, parser)
+ENCODE_PARAMETERS = {
+    "quality": ("quality", int),
+    "subsampling": ("subsampling", str),
+    "chroma_filter": ("chroma_filter", str),
+    "engine": ("engine", str),
+    "optimize": ("optimize_huffman", _parse_flag),
+    "stripe_rows": ("stripe_rows", int),
+    "progressive": ("progressive", _parse_flag),
+    "restart_index": ("restart_index", _parse_flag),
+}
+
+# Errors of a bad upload, answered with 400 (ValueError: a crop region outside of the image)
+IMAGE_ERRORS = (BadImageException, FormatNotSupportedException, PixelFormatException, ValueError)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+# <editor-fold desc="Worker side">
+def encode_upload(data, settings):
+    """
+    :param data: bytes of a PPM / PGM file
+    :param settings: JPEGEncoder arguments
+    :return: bytes of the .jpg file
+    """
+    header, rows = parse_netpbm(data)
+    output = io.BytesIO()
+    JPEGEncoder(**settings).encode_rows(rows, header.width, header.height, output, header.channels)
+    return output.getvalue()
+
+
+def decode_upload(data, settings):
+    """
+    :param data: bytes of a baseline .jpg file
+    :param settings: {"engine": DCT engine name, "scale_denominator": 1, 2, 4 or 8, "region": (left, top, width,
+    height) or None}
+    :return: bytes of a binary PPM (colour) or PGM (gray) file
+    """
+    decoder = JPEGDecoder(io.BytesIO(data), settings.get("engine"),
+                          scale_denominator=settings.get("scale_denominator", 1))
+    region = settings.get("region")
+    planes = decoder.decode() if region is None else decoder.decode_region(*region)
+    output = io.BytesIO()
+    write_netpbm_stream(output, b"P5" if len(planes) == 1 else b"P6", planes.transpose(1, 2, 0))
+    return output.getvalue()
+
+
+HANDLERS = {
+    "encode": encode_upload,
+    "decode": decode_upload,
+}
+
+
+def run_batch(batch, cache=None):
+    """
+    Runs a batch of requests, in a worker process. One bad image only fails its own request.
+    :param batch: list of (command, data, settings)
+    :param cache: (directory, max bytes) of the src.util.cache.DiskCache encoded files are kept in, None for none
+    :return: list of (HTTP status, output bytes or error message), in the order of the batch
+    """
+    results = []
+    for command, data, settings in batch:
+        if command == "encode" and cache is not None:
+            settings = dict(settings, cache=get_cache(*cache))
+        try:
+            results.append((HTTPStatus.OK, HANDLERS[command](data, settings)))
+        except IMAGE_ERRORS as e:
+            results.append((HTTPStatus.BAD_REQUEST, "{0}: {1}".format(type(e).__name__, e)))
+        except Exception as e:
+            results.append((HTTPStatus.INTERNAL_SERVER_ERROR, "{0}: {1}".format(type(e).__name__, e)))
+    return results
+
+
+def warm_up():
+    """
+    Runs in a new worker process, which imports the codec on the way.
+    """
+    return os.getpid()
+
+
+# </editor-fold>
+
+
+class Request:
+    __slots__ = ("command", "data", "settings", "future", "start")
+
+    def __init__(self, command, data, settings, future):
+        self.command = command
+        self.data = data
+        self.settings = settings
+        self.future = future
+        self.start = time.perf_counter()
+
+
+class JPEGServer:
+    """
+    Encodes and decodes images over HTTP, so a long-running process pays the interpreter start and the imports once.
+
+    The asyncio front end only parses requests; the images go through a bounded queue to a batcher that hands them
+    to a process pool, up to batch_size requests per task and one batch per worker at a time. When the queue is
+    full new requests are rejected with 503 instead of piling up.
+
+    Endpoints:
+        POST /encode?quality=&subsampling=&chroma_filter=&engine=&optimize=&stripe_rows=&progressive=&restart_index=
+            PPM / PGM -> JPEG
+        POST /decode?engine=&scale=&crop=  JPEG -> PPM / PGM, at 1/scale of the size, only the crop=l,t,w,h
+        rectangle of it
+        GET /metrics  queue depth, batches and latency percentiles, as JSON
+
+    Usage:
+        server = JPEGServer(workers=4)
+        await server.start(port=0)  # or path="/tmp/jpeg.sock" for a Unix socket
+        ...
+        await server.close()
+    """
+
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_delay=DEFAULT_BATCH_DELAY, max_upload=DEFAULT_MAX_UPLOAD, cache_directory=None,
+                 cache_size=DEFAULT_MAX_BYTES):
+        """
+        :param workers: Worker processes, None for one per CPU
+        :param queue_size: Requests waiting for a worker before new ones are rejected
+        :param batch_size: Most requests sent to a worker at once
+        :param batch_delay: Seconds a batch waits for more requests once it has one
+        :param max_upload: Largest accepted request body in bytes, larger ones are answered 413
+        :param cache_directory: Directory the workers cache encoded files and DCT coefficients in (see
+        src.util.cache.DiskCache), None to cache nothing
+        :param cache_size: Bytes the cache takes at most
+        """
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_upload = max_upload
+        self.cache = (cache_directory, cache_size) if cache_directory is not None else None
+
+        self.address = None
+        self.__server = None
+        self.__executor = None
+        self.__queue = None
+        self.__slots = None
+        self.__batcher = None
+        self.__batches = set()
+        self.__connections = set()
+
+        self.__started = None
+        self.__statuses = {}
+        self.__batch_count = 0
+        self.__batched_requests = 0
+        self.__latencies = deque(maxlen=LATENCY_WINDOW)
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+        """
+        Starts listening on a TCP port (0 picks a free one) or, with path, on a Unix socket.
+        :return: The address listened on: (host, port) or the socket path
+        """
+        # Forked workers would inherit the sockets of the connections open at the time and keep them open after the
+        # server closes them, so the workers are spawned, and started before anything is accepted
+        self.__executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.__executor, warm_up) for _ in range(0, self.workers)))
+        self.__queue = asyncio.Queue(maxsize=self.queue_size)
+        self.__slots = asyncio.Semaphore(self.workers)
+        self.__batcher = asyncio.create_task(self.__run_batcher())
+        self.__started = time.perf_counter()
+
+        if path is not None:
+            self.__server = await asyncio.start_unix_server(self.__handle_connection, path)
+            self.address = path
+        else:
+            self.__server = await asyncio.start_server(self.__handle_connection, host, port)
+            self.address = self.__server.sockets[0].getsockname()[:2]
+        return self.address
+
+    async def serve_forever(self):
+        await self.__server.serve_forever()
+
+    async def close(self):
+        """
+        Stops listening, closes idle connections, fails the requests still queued and shuts the process pool down.
+        """
+        self.__server.close()
+        for writer in list(self.__connections):
+            writer.close()
+        await self.__server.wait_closed()
+        self.__batcher.cancel()
+        await asyncio.gather(self.__batcher, *self.__batches, return_exceptions=True)
+        while not self.__queue.empty():
+            request = self.__queue.get_nowait()
+            if not request.future.done():
+                request.future.set_exception(HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Server is shutting down"))
+        self.__executor.shutdown()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def metrics(self):
+        """
+        :return: dict with the queue depth, the batches in flight, the requests per status and the latency
+        percentiles of the last LATENCY_WINDOW requests
+        """
+        latencies = list(self.__latencies)
+        return {
+            "uptime_seconds": time.perf_counter() - self.__started,
+            "workers": self.workers,
+            "queue_depth": self.__queue.qsize(),
+            "queue_size": self.queue_size,
+            "batches_in_flight": len(self.__batches),
+            "batches": self.__batch_count,
+            "mean_batch_size": self.__batched_requests / self.__batch_count if self.__batch_count else 0.0,
+            "requests": dict(self.__statuses),
+            "latency_seconds": {
+                "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+            },
+        }
+
+    # <editor-fold desc="Batching">
+    async def __run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Only take requests off the queue once a worker is free, so the queue depth is the real backlog
+            await self.__slots.acquire()
+            batch = [await self.__queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.__queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self.__run_batch(batch))
+            self.__batches.add(task)
+            task.add_done_callback(self.__batches.discard)
+
+    async def __run_batch(self, batch):
+        try:
+            self.__batch_count += 1
+            self.__batched_requests += len(batch)
+            work = [(request.command, request.data, request.settings) for request in batch]
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(self.__executor, run_batch, work,
+                                                                          self.cache)
+            except Exception as e:
+                # The worker itself failed (e.g. a broken pool), every request of the batch fails with it
+                results = [(HTTPStatus.INTERNAL_SERVER_ERROR, "{0}: {1}".format(type(e).__name__, e))] * len(batch)
+
+            for request, result in zip(batch, results):
+                # The client may be gone already
+                if not request.future.done():
+                    request.future.set_result(result)
+        finally:
+            self.__slots.release()
+
+    async def __submit(self, command, data, settings):
+        """
+        :return: The output bytes of the request
+        :raise: HTTPError 503 if the queue is full, 400 if the image is bad, 500 if encoding failed otherwise
+        """
+        request = Request(command, data, settings, asyncio.get_running_loop().create_future())
+        try:
+            self.__queue.put_nowait(request)
+        except asyncio.QueueFull:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Queue is full, retry later")
+
+        status, output = await request.future
+        if status != HTTPStatus.OK:
+            raise HTTPError(status, output)
+        return output
+
+    # </editor-fold>
+
+    # <editor-fold desc="HTTP">
+    async def __handle_connection(self, reader, writer):
+        self.__connections.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                start = time.perf_counter()
+                try:
+                    method, target, version, headers = await self.__read_head(request_line, reader)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    body = await self.__read_body(method, headers, reader)
+                    content_type, payload = await self.__route(method, target, body)
+                    status = HTTPStatus.OK
+                except HTTPError as e:
+                    status, content_type, payload = e.status, "text/plain", (str(e) + "\n").encode("utf-8")
+                    # The body of a rejected upload may not have been read
+                    keep_alive = keep_alive and status not in (HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                                               HTTPStatus.LENGTH_REQUIRED, HTTPStatus.BAD_REQUEST)
+
+                self.__statuses[status.value] = self.__statuses.get(status.value, 0) + 1
+                self.__latencies.append(time.perf_counter() - start)
+                headers = ["HTTP/1.1 {0} {1}".format(status.value, status.phrase),
+                           "Content-Type: " + content_type,
+                           "Content-Length: {0}".format(len(payload)),
+                           "Connection: " + ("keep-alive" if keep_alive else "close")]
+                if status == HTTPStatus.SERVICE_UNAVAILABLE:
+                    headers.append("Retry-After: 1")
+                writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+                writer.write(payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.__connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def __read_head(request_line, reader):
+        """
+        :return: (method, target, version, headers with lower case names)
+        :raise: HTTPError 400 for malformed requests
+        """
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return method, target, version, headers
+            if len(headers) >= MAX_HEADERS:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Too many headers")
+            name, separator, value = line.decode("latin-1").partition(":")
+            if not separator:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed header")
+            headers[name.strip().lower()] = value.strip()
+
+    async def __read_body(self, method, headers, reader):
+        if method != "POST":
+            return b""
+        if "transfer-encoding" in headers:
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED, "Uploads need a Content-Length")
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed Content-Length")
+        if length > self.max_upload:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            "Uploads are limited to {0} bytes".format(self.max_upload))
+        return await reader.readexactly(length)
+
+    async def __route(self, method, target, body):
+        """
+        :return: (content type, payload)
+        :raise: HTTPError
+        """
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        if url.path == "/metrics":
+            if method != "GET":
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            return "application/json", json.dumps(self.metrics()).encode("utf-8")
+        if url.path not in ("/encode", "/decode"):
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+        if method != "POST":
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+
+        if url.path == "/encode":
+            output = await self.__submit("encode", body, self.__get_encode_settings(query))
+            return "image/jpeg", output
+        output = await self.__submit("decode", body, self.__get_decode_settings(query))
+        return "image/x-portable-anymap", output
+
+    @staticmethod
+    def __get_encode_settings(query):
+        """
+        :return: JPEGEncoder arguments from the query parameters, checked before the upload is queued
+        :raise: HTTPError 400 for unknown or invalid parameters
+        """
+        settings = {}
+        for name, value in query.items():
+            if name not in ENCODE_PARAMETERS:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Unknown parameter {0}".format(name))
+            argument, parse = ENCODE_PARAMETERS[name]
+            try:
+                settings[argument] = parse(value)
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid {0}: {1}".format(name, value))
+        if "quality" in settings and not 1 <= settings["quality"] <= 100:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "quality must be between 1 and 100")
+        try:
+            JPEGEncoder(**settings)
+        except KeyError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, e.args[0])
+        return settings
+
+    @staticmethod
+    def __get_decode_settings(query):
+        """
+        :return: decode_upload settings from the query parameters
+        :raise: HTTPError 400 for invalid parameters
+        """
+        engine = query.get("engine", DEFAULT_ENGINE)
+        try:
+            get_engine(engine)
+        except KeyError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, e.args[0])
+        try:
+            scale_denominator = int(query.get("scale", 1))
+        except ValueError:
+            scale_denominator = None
+        if scale_denominator not in SCALE_DENOMINATORS:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "scale must be one of {0}".format(
+                ", ".join(str(d) for d in SCALE_DENOMINATORS)))
+        region = None
+        if "crop" in query:
+            try:
+                region = tuple(int(part) for part in query["crop"].split(","))
+            except ValueError:
+                region = ()
+            if len(region) != 4:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "crop must be LEFT,TOP,WIDTH,HEIGHT")
+        return {"engine": engine, "scale_denominator": scale_denominator, "region": region}
+
+    # </editor-fold>
+
+
+async def serve(server: JPEGServer, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+    address = await server.start(host, port, path)
+    print("listening on {0}".format(address if path is not None else "http://{0}:{1}".format(*address)),
+          file=sys.stderr)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m src.server",
+                                     description="Serves JPEG encoding and decoding over HTTP")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port, 0 for any free port")
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of a TCP port")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="requests waiting for a worker before new ones are rejected with 503")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="most requests sent to a worker at once")
+    parser.add_argument("--batch-delay", type=float, default=DEFAULT_BATCH_DELAY,
+                        help="seconds a batch waits for more requests")
+    parser.add_argument("--max-upload", type=int, default=DEFAULT_MAX_UPLOAD, help="largest request body in bytes")
+    parser.add_argument("--cache", metavar="DIR", help="directory encoded files are cached in")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES,
+                        help="bytes the cache takes at most, least recently used files are evicted first")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    server = JPEGServer(args.jobs, args.queue_size, args.batch_size, args.batch_delay, args.max_upload, args.cache,
+                        args.cache_size)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
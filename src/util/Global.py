@@ -1,6 +1,3 @@
-position = 0
-
-
 def normalize(pixel_value):
     if pixel_value > 255:
         pixel_value = 255
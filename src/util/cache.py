@@ -0,0 +1,217 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 2 ** 30
+
+# Lines hashed at once by hash_rows, bounds the copy made of arrays that are not contiguous
+ROWS_PER_CHUNK = 64
+
+# Temporary files older than this were left by a process that died while writing them, eviction removes them
+STALE_SECONDS = 3600
+
+_TEMPORARY_PREFIX = ".tmp-"
+
+
+def make_key(*parts):
+    """
+    :param parts: Values with a stable repr (numbers, strings, bytes, None and tuples of them)
+    :return: Hex digest identifying the parts
+    """
+    return hashlib.blake2b(repr(parts).encode(), digest_size=20).hexdigest()
+
+
+def hash_rows(rows):
+    """
+    :param rows: Array of shape (height, ...), e.g. a memory-mapped image, read a few lines at a time
+    :return: Hex digest of the shape, type and contents of the array
+    """
+    digest = hashlib.blake2b(repr((rows.shape, rows.dtype.str)).encode(), digest_size=20)
+    for line in range(0, len(rows), ROWS_PER_CHUNK):
+        digest.update(np.ascontiguousarray(rows[line:line + ROWS_PER_CHUNK]))
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed store of bytes and numpy arrays in a directory, keyed by hex digests (see make_key), with
+    least recently used entries evicted once the entries take more than max_bytes.
+
+    Entries are written to a temporary file that is renamed over the entry, so readers (other threads or processes
+    sharing the directory) only ever see whole entries. Reading an entry updates its modification time, which is
+    what eviction orders entries by.
+
+    Every instance keeps an estimate of the size of the directory, scanned on the first write and updated with its
+    own writes; the directory is scanned again and evicted from whenever the estimate goes over max_bytes, so the
+    writes of other processes are accounted for at the next scan.
+
+    Usage:
+        cache = DiskCache("~/.cache/jpeg", max_bytes=2 ** 30)
+        JPEGEncoder(quality=75, cache=cache).encode(image)
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__size = None
+        self.__lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    # <editor-fold desc="Entries">
+    def get(self, key):
+        """
+        :return: The bytes kept under the key, None if there are none
+        """
+        path = self.__get_path(key, ".bin")
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return self.__miss()
+        return self.__hit(path, data)
+
+    def put(self, key, data):
+        """
+        :return: Whether the entry was written; a cache that cannot be written to only misses
+        """
+        return self.__write(self.__get_path(key, ".bin"), lambda file: file.write(data))
+
+    def get_array(self, key):
+        """
+        :return: The array kept under the key, None if there is none
+        """
+        path = self.__get_path(key, ".npy")
+        try:
+            array = np.load(path, allow_pickle=False)
+        except FileNotFoundError:
+            return self.__miss()
+        except (ValueError, EOFError):
+            # Not written by put_array, writes are atomic
+            _remove(path)
+            return self.__miss()
+        return self.__hit(path, array)
+
+    def put_array(self, key, array):
+        """
+        :return: Whether the entry was written
+        """
+        return self.__write(self.__get_path(key, ".npy"), lambda file: np.save(file, array, allow_pickle=False))
+
+    def __get_path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def __hit(self, path, value):
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted since it was read
+            pass
+        self.hits += 1
+        return value
+
+    def __miss(self):
+        self.misses += 1
+        return None
+
+    def __write(self, path, write):
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(prefix=_TEMPORARY_PREFIX, dir=directory)
+            try:
+                with os.fdopen(descriptor, "wb") as file:
+                    write(file)
+                os.replace(temporary, path)
+            except BaseException:
+                _remove(temporary)
+                raise
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+
+        with self.__lock:
+            if self.__size is None or self.__size + size > self.max_bytes:
+                self.__size = self.__evict()
+            else:
+                self.__size += size
+        return True
+
+    # </editor-fold>
+
+    # <editor-fold desc="Eviction">
+    def size(self):
+        """
+        :return: Bytes taken by the entries of the directory
+        """
+        return sum(size for _, size, _ in self.__scan())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the entries take at most max_bytes, and the temporary files
+        left by dead writers.
+        :return: Bytes taken by the remaining entries
+        """
+        with self.__lock:
+            self.__size = self.__evict()
+            return self.__size
+
+    def __evict(self):
+        entries = sorted(self.__scan(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+        return total
+
+    def __scan(self):
+        """
+        :return: list of (path, size, last use in ns) of the entries; stale temporary files are removed on the way
+        """
+        entries = []
+        stale = time.time_ns() - STALE_SECONDS * 10 ** 9
+        for directory in os.scandir(self.directory):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if not entry.name.startswith(_TEMPORARY_PREFIX):
+                    entries.append((entry.path, stat.st_size, stat.st_mtime_ns))
+                elif stat.st_mtime_ns < stale:
+                    _remove(entry.path)
+        return entries
+
+    # </editor-fold>
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "DiskCache({0}, {1} bytes at most)".format(self.directory, self.max_bytes)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def get_cache(directory, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    :return: The DiskCache of a directory shared by the whole process, so workers running many jobs scan the
+    directory once
+    """
+    return DiskCache(directory, max_bytes)
@@ -0,0 +1,71 @@
+import numpy as np
+
+
+def rgb_to_yuv(planes):
+    """
+    Vectorized equivalent of PixelRGB.get_pixel_yuv for whole planes.
+    :param planes: Array of shape (3, height, width) holding the R, G and B planes
+    :return: float32 array of shape (3, height, width) holding the Y, U (Cb) and V (Cr) planes, clamped to [0, 255]
+    """
+    r, g, b = planes.astype(np.float64, copy=False)
+    yuv = np.empty(planes.shape, dtype=np.float32)
+    yuv[0] = 0.299 * r + 0.587 * g + 0.114 * b
+    yuv[1] = 128 - 0.1687 * r - 0.3312 * g + 0.5 * b
+    yuv[2] = 128 + 0.5 * r - 0.4186 * g - 0.0813 * b
+    return np.clip(yuv, 0, 255, out=yuv)
+
+
+def yuv_to_rgb(planes):
+    """
+    Vectorized equivalent of PixelYUV.get_pixel_rgb for whole planes.
+    :param planes: Array of shape (3, height, width) holding the Y, U (Cb) and V (Cr) planes
+    :return: uint8 array of shape (3, height, width) holding the R, G and B planes
+    """
+    y, u, v = planes.astype(np.float64, copy=False)
+    rgb = np.empty(planes.shape, dtype=np.float64)
+    rgb[0] = y + 1.402 * (v - 128)
+    rgb[1] = y - 0.344136 * (u - 128) - 0.714136 * (v - 128)
+    rgb[2] = y + 1.772 * (u - 128)
+    return np.clip(np.trunc(rgb), 0, 255).astype(np.uint8)
+
+
+# Fixed-point colour conversion of libjpeg's jccolor / jdcolor: constants scaled by 2^SCALE_BITS
+SCALE_BITS = 16
+ONE_HALF = 1 << (SCALE_BITS - 1)
+CBCR_OFFSET = 128 << SCALE_BITS
+
+
+def _fix(x):
+    return int(x * (1 << SCALE_BITS) + 0.5)
+
+
+def rgb_to_ycc_integers(planes):
+    """
+    Integer equivalent of rgb_to_yuv: only integer multiplications, additions and shifts, so the result is exact and
+    the same on every platform.
+    :param planes: Integer array of shape (3, height, width) holding the R, G and B planes
+    :return: uint8 array of shape (3, height, width) holding the Y, Cb and Cr planes
+    """
+    r, g, b = planes.astype(np.int32)
+    ycc = np.empty(planes.shape, dtype=np.uint8)
+    ycc[0] = (_fix(0.29900) * r + _fix(0.58700) * g + _fix(0.11400) * b + ONE_HALF) >> SCALE_BITS
+    # ONE_HALF - 1 keeps the maximum below 256
+    ycc[1] = (-_fix(0.16874) * r - _fix(0.33126) * g + _fix(0.5) * b + CBCR_OFFSET + ONE_HALF - 1) >> SCALE_BITS
+    ycc[2] = (_fix(0.5) * r - _fix(0.41869) * g - _fix(0.08131) * b + CBCR_OFFSET + ONE_HALF - 1) >> SCALE_BITS
+    return ycc
+
+
+def ycc_to_rgb_integers(planes):
+    """
+    Integer equivalent of yuv_to_rgb, rounding instead of truncating.
+    :param planes: Integer array of shape (3, height, width) holding the Y, Cb and Cr planes, in [0, 255]
+    :return: uint8 array of shape (3, height, width) holding the R, G and B planes
+    """
+    y, cb, cr = planes.astype(np.int32)
+    cb = cb - 128
+    cr = cr - 128
+    rgb = np.empty(planes.shape, dtype=np.int32)
+    rgb[0] = y + ((_fix(1.40200) * cr + ONE_HALF) >> SCALE_BITS)
+    rgb[1] = y + ((-_fix(0.34414) * cb - _fix(0.71414) * cr + ONE_HALF) >> SCALE_BITS)
+    rgb[2] = y + ((_fix(1.77200) * cb + ONE_HALF) >> SCALE_BITS)
+    return np.clip(rgb, 0, 255).astype(np.uint8)
@@ -0,0 +1,203 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+class Span:
+    """
+    One stage being recorded. Counters added with count() end up in the event of the stage.
+    """
+    __slots__ = ("name", "args", "counters")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.counters = {}
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def update(self, counters):
+        for name, value in counters.items():
+            self.count(name, value)
+
+
+class Instrumentation:
+    """
+    Observer passed through the pipeline (Image, DCTImage, QuantizationImage, JPEGEncoder, JPEGDecoder) that records
+    every stage as an event: wall and CPU time, the bytes allocated during the stage (only when memory is traced,
+    see trace_memory) and the counters of the stage (blocks, zero runs, output bits...).
+
+    Events can be exported as a structured log (one JSON object per line) or as a Chrome trace (chrome://tracing,
+    Perfetto). Stages run in worker processes are recorded there and merged with extend().
+
+    Usage:
+        instrumentation = Instrumentation()
+        JPEGEncoder(instrumentation=instrumentation).encode(image)
+        instrumentation.write_chrome_trace("trace.json")
+    """
+    enabled = True
+
+    def __init__(self, trace_memory=False):
+        """
+        :param trace_memory: Whether to record allocated bytes, which starts tracemalloc and slows allocations down
+        """
+        self.trace_memory = trace_memory
+        self.events = []
+        self.__lock = threading.Lock()
+        self.__started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.__started_tracing:
+            tracemalloc.start()
+
+    def stage(self, name, **args):
+        """
+        :param args: Values describing this run of the stage (e.g. the stripe), kept in the event
+        :return: Context manager recording the stage, yielding its Span
+        """
+        return _Stage(self, Span(name, args))
+
+    def add(self, event):
+        with self.__lock:
+            self.events.append(event)
+
+    def extend(self, events):
+        with self.__lock:
+            self.events.extend(events)
+
+    def close(self):
+        """
+        Stops memory tracing if this instance started it.
+        """
+        if self.__started_tracing:
+            tracemalloc.stop()
+            self.__started_tracing = False
+
+    # <editor-fold desc="Export">
+    def summary(self):
+        """
+        :return: dict with the totals of every stage: {name: {"count", "wall_seconds", "cpu_seconds",
+        "allocated_bytes", "counters"}}
+        """
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event["name"], {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                      "allocated_bytes": None, "counters": {}})
+            stage["count"] += 1
+            stage["wall_seconds"] += event["wall_ns"] / 1e9
+            stage["cpu_seconds"] += event["cpu_ns"] / 1e9
+            if event["allocated_bytes"] is not None:
+                stage["allocated_bytes"] = (stage["allocated_bytes"] or 0) + event["allocated_bytes"]
+            for counter, value in event["counters"].items():
+                stage["counters"][counter] = stage["counters"].get(counter, 0) + value
+        return stages
+
+    def write_log(self, filename: str):
+        """
+        Writes the events as a structured log, one JSON object per line.
+        """
+        with open(filename, "w") as file:
+            for event in self.events:
+                file.write(json.dumps(event) + "\n")
+
+    def to_chrome_trace(self):
+        """
+        :return: The events in the Chrome trace event format (complete "X" events, times in microseconds)
+        """
+        events = []
+        for event in self.events:
+            args = dict(event["args"])
+            args.update(event["counters"])
+            args["cpu_ms"] = event["cpu_ns"] / 1e6
+            if event["allocated_bytes"] is not None:
+                args["allocated_bytes"] = event["allocated_bytes"]
+            events.append({"name": event["name"], "cat": "codec", "ph": "X", "ts": event["start_ns"] / 1e3,
+                           "dur": event["wall_ns"] / 1e3, "pid": event["pid"], "tid": event["tid"], "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, filename: str):
+        with open(filename, "w") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+    # </editor-fold>
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "Instrumentation({0} events)".format(len(self.events))
+
+
+class _Stage:
+    __slots__ = ("instrumentation", "span", "start_ns", "cpu_ns", "allocated")
+
+    def __init__(self, instrumentation, span):
+        self.instrumentation = instrumentation
+        self.span = span
+
+    def __enter__(self):
+        self.allocated = tracemalloc.get_traced_memory()[0] if self.instrumentation.trace_memory else None
+        self.cpu_ns = time.thread_time_ns()
+        # perf_counter is system wide on the supported platforms, so events of worker processes line up
+        self.start_ns = time.perf_counter_ns()
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_ns = time.perf_counter_ns() - self.start_ns
+        cpu_ns = time.thread_time_ns() - self.cpu_ns
+        allocated = tracemalloc.get_traced_memory()[0] - self.allocated if self.allocated is not None else None
+        self.instrumentation.add({"name": self.span.name, "pid": os.getpid(), "tid": threading.get_ident(),
+                                  "start_ns": self.start_ns, "wall_ns": wall_ns, "cpu_ns": cpu_ns,
+                                  "allocated_bytes": allocated, "args": self.span.args,
+                                  "counters": self.span.counters})
+        return False
+
+
+class NullInstrumentation:
+    """
+    Instrumentation that records nothing, used when none is given. Stages cost one call and a no-op context
+    manager; code computing counters checks `enabled` first.
+    """
+    enabled = False
+    events = ()
+
+    def stage(self, name, **args):
+        return _NULL_STAGE
+
+    def add(self, event):
+        pass
+
+    def extend(self, events):
+        pass
+
+    def close(self):
+        pass
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, name, value=1):
+        pass
+
+    def update(self, counters):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+def get_instrumentation(instrumentation=None):
+    """
+    :return: The instrumentation itself, or NULL_INSTRUMENTATION for None
+    """
+    return NULL_INSTRUMENTATION if instrumentation is None else instrumentation
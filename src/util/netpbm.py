@@ -0,0 +1,241 @@
+import mmap
+import os
+import re
+
+import numpy as np
+
+from src.domain.exceptions.BadImageException import BadImageException
+from src.domain.exceptions.FormatNotSupportedException import FormatNotSupportedException
+
+# Magic number -> (channels, binary)
+FORMATS = {
+    b"P2": (1, False),
+    b"P3": (3, False),
+    b"P5": (1, True),
+    b"P6": (3, True),
+}
+
+# Longest header we are willing to scan for; comments can make it arbitrarily long in theory
+MAX_HEADER_SIZE = 64 * 1024
+
+# Lines written at once by the writers, bounds the temporary buffer used for interleaving
+ROWS_PER_CHUNK = 64
+
+_COMMENT = re.compile(rb"#[^\r\n]*")
+_WHITESPACE = b" \t\r\n\v\f"
+
+
+class NetpbmHeader:
+    def __init__(self, magic, width, height, depth, comments, data_offset):
+        self.magic = magic
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.comments = comments
+        self.data_offset = data_offset
+        self.channels, self.binary = FORMATS[magic]
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "{0} {1} x {2}, depth {3}".format(self.magic.decode(), self.width, self.height, self.depth)
+
+
+def parse_header(buffer):
+    """
+    Parses the header of a PPM / PGM image. Tokens may be separated by any whitespace and comments may appear
+    between any of them.
+    :param buffer: bytes-like object holding (at least) the start of the file
+    :return: NetpbmHeader, with data_offset pointing to the first byte of the pixel data
+    :raise: FormatNotSupportedException if the magic number is not P2, P3, P5 or P6 or the depth is not 255
+    :raise: BadImageException if the header is malformed
+    """
+    magic = bytes(buffer[0:2])
+    if magic not in FORMATS:
+        raise FormatNotSupportedException("Magic number {0} is not supported :(".format(magic))
+
+    tokens = []
+    comments = []
+    position = 2
+    while len(tokens) < 3:
+        if position >= len(buffer):
+            raise BadImageException("Image header is truncated")
+
+        char = buffer[position:position + 1]
+        if char in _WHITESPACE:
+            position += 1
+        elif char == b"#":
+            end = position
+            while end < len(buffer) and buffer[end:end + 1] not in b"\r\n":
+                end += 1
+            comments.append(bytes(buffer[position:end]).decode("latin-1"))
+            position = end
+        else:
+            end = position
+            while end < len(buffer) and buffer[end:end + 1] not in _WHITESPACE + b"#":
+                end += 1
+            tokens.append(bytes(buffer[position:end]))
+            position = end
+
+    try:
+        width, height, depth = map(int, tokens)
+    except ValueError:
+        raise BadImageException("Image header is malformed: {0}".format(tokens))
+
+    if width <= 0 or height <= 0 or not 0 < depth < 65536:
+        raise BadImageException("Image header is malformed: {0}".format(tokens))
+    # The samples are used as they are, 0..255: other depths would need rescaling, and above 255 two bytes a sample
+    if depth != 255:
+        raise FormatNotSupportedException("Only 8 bit images of depth 255 are supported, depth is {0}".format(depth))
+
+    # Exactly one whitespace character separates the header from binary data
+    return NetpbmHeader(magic, width, height, depth, comments, position + 1)
+
+
+def parse_ascii_samples(data, count):
+    """
+    Bulk parses the samples of a plain (P2 / P3) image.
+    :param data: bytes holding the sample part of the file
+    :param count: The number of samples expected
+    :return: uint8 array with count samples
+    :raise: BadImageException if there are fewer samples than expected or a sample is not a number
+    """
+    tokens = _COMMENT.sub(b" ", data).split()
+    if len(tokens) < count:
+        raise BadImageException("Expected {0} samples, found {1}".format(count, len(tokens)))
+
+    try:
+        samples = np.array(tokens[:count]).astype(np.int32)
+    except ValueError:
+        raise BadImageException("Image data contains non numeric samples")
+    return np.clip(samples, 0, 255).astype(np.uint8)
+
+
+def parse_netpbm(buffer):
+    """
+    Parses a whole PPM / PGM image held in memory (e.g. an upload).
+    :param buffer: bytes-like object holding the file
+    :return: (NetpbmHeader, uint8 array of shape (height, width, channels)); for binary images a read-only view into
+    the buffer
+    :raise: FormatNotSupportedException / BadImageException like parse_header, BadImageException if the data is
+    truncated
+    """
+    header = parse_header(buffer[:MAX_HEADER_SIZE])
+    count = header.width * header.height * header.channels
+    if not header.binary:
+        samples = parse_ascii_samples(bytes(buffer[header.data_offset:]), count)
+    else:
+        if len(buffer) < header.data_offset + count:
+            raise BadImageException("Image data is truncated")
+        samples = np.frombuffer(buffer, dtype=np.uint8, count=count, offset=header.data_offset)
+    return header, samples.reshape(header.height, header.width, header.channels)
+
+
+def read_netpbm(filename: str, use_mmap=True):
+    """
+    Reads a PPM / PGM image.
+    Binary images are memory-mapped and the returned array is a read-only view into the mapping, so no pixel data
+    is copied; the mapping stays alive as long as the array does.
+    :param filename: Path to the file
+    :param use_mmap: Whether binary images should be memory-mapped instead of read into memory
+    :return: None if file was not found / (NetpbmHeader, uint8 array of shape (height, width, channels))
+    """
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename, "rb") as file:
+        head = file.read(MAX_HEADER_SIZE)
+        header = parse_header(head)
+        count = header.width * header.height * header.channels
+
+        if not header.binary:
+            file.seek(header.data_offset)
+            samples = parse_ascii_samples(file.read(), count)
+        else:
+            if os.path.getsize(filename) < header.data_offset + count:
+                raise BadImageException("Image data is truncated")
+
+            if use_mmap:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                file.seek(0)
+                buffer = file.read()
+            samples = np.frombuffer(buffer, dtype=np.uint8, count=count, offset=header.data_offset)
+
+    return header, samples.reshape(header.height, header.width, header.channels)
+
+
+def read_netpbm_rows(filename: str, rows_per_chunk=ROWS_PER_CHUNK):
+    """
+    Reads a binary PPM / PGM image a few lines at a time with plain reads, so only one chunk of lines is ever held
+    in memory, whatever the size of the image.
+    :param filename: Path to the file
+    :param rows_per_chunk: Lines per chunk
+    :return: None if file was not found / (NetpbmHeader, iterator of uint8 arrays of shape (lines, width, channels)).
+    The file is opened again by the iterator, every call gives a new one.
+    :raise: FormatNotSupportedException for plain (P2 / P3) images
+    """
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename, "rb") as file:
+        header = parse_header(file.read(MAX_HEADER_SIZE))
+    if not header.binary:
+        raise FormatNotSupportedException("Only binary images can be read a few lines at a time")
+    if os.path.getsize(filename) < header.data_offset + header.width * header.height * header.channels:
+        raise BadImageException("Image data is truncated")
+
+    return header, _read_rows(filename, header, rows_per_chunk)
+
+
+def _read_rows(filename, header, rows_per_chunk):
+    line_size = header.width * header.channels
+    with open(filename, "rb") as file:
+        file.seek(header.data_offset)
+        for line in range(0, header.height, rows_per_chunk):
+            lines = min(rows_per_chunk, header.height - line)
+            data = file.read(lines * line_size)
+            yield np.frombuffer(data, dtype=np.uint8).reshape(lines, header.width, header.channels)
+
+
+def write_netpbm(filename: str, magic, samples, depth=255, description=None):
+    """
+    Writes a PPM / PGM image straight from a sample buffer, a few lines at a time.
+    :param filename: Path to the file
+    :param magic: Magic number of the output format (b"P2", b"P3", b"P5" or b"P6")
+    :param samples: uint8 array of shape (height, width, channels); may be a strided view (e.g. of planar data)
+    :param depth: Maximum sample value written in the header
+    :param description: Optional comment line, must start with '#'
+    :return: None
+    """
+    with open(filename, "wb") as file:
+        write_netpbm_stream(file, magic, samples, depth, description)
+
+
+def write_netpbm_stream(file, magic, samples, depth=255, description=None):
+    """
+    Writes a PPM / PGM image to a binary file-like object (e.g. io.BytesIO), see write_netpbm.
+    :return: None
+    """
+    if magic not in FORMATS:
+        raise FormatNotSupportedException("Magic number {0} is not supported :(".format(magic))
+
+    channels, binary = FORMATS[magic]
+    height, width = samples.shape[0], samples.shape[1]
+    if samples.shape[2] != channels:
+        raise BadImageException("{0} images need {1} channels, got {2}".format(magic.decode(), channels,
+                                                                             samples.shape[2]))
+
+    file.write(magic + b"\n")
+    if description:
+        file.write(description.encode("latin-1") + b"\n")
+    file.write("{0} {1}\n{2}\n".format(width, height, depth).encode("ascii"))
+
+    for line in range(0, height, ROWS_PER_CHUNK):
+        chunk = np.ascontiguousarray(samples[line:line + ROWS_PER_CHUNK], dtype=np.uint8)
+        if binary:
+            file.write(memoryview(chunk).cast("B"))
+        else:
+            # Plain formats keep one sample per line
+            file.write("\n".join(map(str, chunk.ravel().tolist())).encode("ascii") + b"\n")
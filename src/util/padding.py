@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def get_padded_size(size, multiple):
+    """
+    :return: The smallest multiple of multiple that is at least size
+    """
+    return -(-size // multiple) * multiple
+
+
+def pad_edges(planes, height, width):
+    """
+    Pads planes to a larger size by repeating their last line and column (edge replication), the way the padding of a
+    partial MCU is filled. Only the border is computed, the planes themselves are copied once into the result.
+    :param planes: Array of shape (channels, lines, samples), lines <= height and samples <= width, at least one of each
+    :return: Array of shape (channels, height, width) with the same dtype, or the planes themselves if they already
+    have that size
+    """
+    channels, lines, samples = planes.shape
+    if (lines, samples) == (height, width):
+        return planes
+
+    padded = np.empty((channels, height, width), dtype=planes.dtype)
+    padded[:, :lines, :samples] = planes
+    padded[:, :lines, samples:] = planes[:, :, samples - 1:]
+    padded[:, lines:] = padded[:, lines - 1:lines]
+    return padded
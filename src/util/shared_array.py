@@ -0,0 +1,63 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray:
+    """
+    A numpy array backed by a named shared memory block, so worker processes can read and write it without it
+    being pickled. Only the spec (name, shape, dtype) travels to the workers.
+
+    The creating process owns the block and must call release() (or use it as a context manager) when done.
+    """
+
+    def __init__(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        self.__memory = shared_memory.SharedMemory(create=True, size=size)
+        self.spec = (self.__memory.name, tuple(shape), dtype.str)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.__memory.buf)
+
+    @staticmethod
+    def from_array(array):
+        shared = SharedArray(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def release(self):
+        del self.array
+        self.__memory.close()
+        self.__memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class AttachedArray:
+    """
+    Context manager giving a worker process access to a SharedArray from its spec. Plain numpy arrays are passed
+    through unchanged, so the same task functions run in-process.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.__memory = None
+
+    def __enter__(self):
+        if isinstance(self.spec, np.ndarray):
+            return self.spec
+
+        name, shape, dtype = self.spec
+        self.__memory = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.__memory.buf)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__memory is not None:
+            try:
+                self.__memory.close()
+            except BufferError:
+                # The caller still holds the array, the mapping goes away once the array is collected
+                pass
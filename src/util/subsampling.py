@@ -0,0 +1,88 @@
+import numpy as np
+
+# Chroma subsampling modes -> (horizontal, vertical) sampling factors of Y; Cb and Cr are always sampled 1x1
+SUBSAMPLING_MODES = {
+    "4:4:4": (1, 1),
+    "4:2:2": (2, 1),
+    "4:2:0": (2, 2),
+}
+
+DEFAULT_SUBSAMPLING = "4:2:0"
+
+# box: plain average of the samples a chroma sample covers
+# triangle: 1 3 3 1 tent over the covered samples and their neighbours, which blurs less than it aliases
+FILTERS = ("box", "triangle")
+
+DEFAULT_FILTER = "box"
+
+
+def get_sampling_factors(subsampling):
+    """
+    :return: (horizontal, vertical) sampling factors of Y for a subsampling mode
+    :raise: KeyError for unknown modes
+    """
+    if subsampling not in SUBSAMPLING_MODES:
+        raise KeyError("Unknown subsampling {0}, expected one of {1}".format(subsampling,
+                                                                              ", ".join(SUBSAMPLING_MODES)))
+    return SUBSAMPLING_MODES[subsampling]
+
+
+def decimate(plane, factor, axis, chroma_filter=DEFAULT_FILTER):
+    """
+    Downsamples a plane along one axis. Samples past the edges repeat the edge sample.
+    :param plane: float array, its length along the axis a multiple of the factor
+    :param factor: 1 or 2 (any factor for the box filter)
+    :return: float64 array with the length along the axis divided by the factor
+    """
+    if factor == 1:
+        return plane
+    if chroma_filter not in FILTERS:
+        raise KeyError("Unknown filter {0}, expected one of {1}".format(chroma_filter, ", ".join(FILTERS)))
+
+    plane = np.moveaxis(np.asarray(plane, dtype=np.float64), axis, 0)
+    if chroma_filter == "box":
+        result = plane.reshape((plane.shape[0] // factor, factor) + plane.shape[1:]).mean(axis=1)
+    elif factor == 2:
+        # padded[j] is plane[j - 1], so output i covers plane[2i - 1] .. plane[2i + 2]
+        padded = np.concatenate((plane[:1], plane, plane[-1:]))
+        result = (padded[0:-2:2] + 3 * padded[1:-1:2] + 3 * padded[2::2] + padded[3::2]) / 8
+    else:
+        raise ValueError("The triangle filter only downsamples by 2, got {0}".format(factor))
+    return np.moveaxis(result, 0, axis)
+
+
+def downsample(plane, horizontal, vertical, chroma_filter=DEFAULT_FILTER, top=0, bottom=0):
+    """
+    Downsamples a whole chroma plane once.
+    :param plane: float array of shape (lines, width), lines a multiple of vertical and width of horizontal
+    :param horizontal: Horizontal factor (1 or 2)
+    :param vertical: Vertical factor (1 or 2)
+    :param top: Context lines above the lines to downsample (a multiple of vertical), used by the filter instead of
+    repeating the edge, then cropped; lets stripes of an image be downsampled independently without seams
+    :param bottom: Context lines below, as top
+    :return: float64 array of shape ((lines - top - bottom) / vertical, width / horizontal)
+    """
+    result = decimate(decimate(plane, horizontal, 1, chroma_filter), vertical, 0, chroma_filter)
+    return result[top // vertical:len(result) - bottom // vertical]
+
+
+def downsample_integers(plane, horizontal, vertical, chroma_filter=DEFAULT_FILTER, top=0, bottom=0):
+    """
+    Integer version of downsample, for the integer pipeline. The box filter rounds its sums like libjpeg (jcsample),
+    with a bias alternating between columns so neither rounding direction is favoured; the triangle filter rounds to
+    nearest (its float sums of integers are exact).
+    :param plane: Integer array of shape (lines, width), as for downsample
+    :return: int64 array of shape ((lines - top - bottom) / vertical, width / horizontal)
+    """
+    if chroma_filter != "box":
+        return np.rint(downsample(plane, horizontal, vertical, chroma_filter, top, bottom)).astype(np.int64)
+
+    plane = np.asarray(plane, dtype=np.int64)
+    lines, width = plane.shape
+    area = horizontal * vertical
+    result = plane.reshape(lines // vertical, vertical, width // horizontal, horizontal).sum(axis=(1, 3))
+    if area > 1:
+        # Bias 0, 1, 0, 1... for 2 samples and 1, 2, 1, 2... for 4, then divide by the area (a power of 2)
+        bias = area // 2 - 1 + np.arange(0, result.shape[1]) % 2
+        result = (result + bias) >> (area.bit_length() - 1)
+    return result[top // vertical:len(result) - bottom // vertical]
@@ -0,0 +1,83 @@
+import numpy as np
+
+# Synthetic test images, from easy to hard to compress:
+# gradient: smooth ramps, almost all energy in the DC coefficients
+# photo: smooth shaded regions with sharp edged shapes and fine grain, close to the statistics of photographs
+# checkerboard: hard colour edges that do not line up with the 8x8 block grid, ringing and chroma bleeding
+# noise: uniform white noise, every coefficient significant
+PATTERNS = ("gradient", "photo", "checkerboard", "noise")
+
+# Side of the checkerboard squares, not a divisor of 8 so edges fall inside blocks
+CHECKERBOARD_SIZE = 7
+
+
+def gradient(width, height, seed=0):
+    y, x = np.mgrid[0:height, 0:width]
+    fx = x / max(1, width - 1)
+    fy = y / max(1, height - 1)
+    return np.stack([fx * 255, fy * 255, (1 - (fx + fy) / 2) * 255], axis=-1)
+
+
+def noise(width, height, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3))
+
+
+def checkerboard(width, height, seed=0):
+    y, x = np.mgrid[0:height, 0:width]
+    cells = ((x // CHECKERBOARD_SIZE + y // CHECKERBOARD_SIZE) % 2).astype(bool)
+    return np.where(cells[..., np.newaxis], np.array([230, 200, 40]), np.array([30, 60, 170]))
+
+
+def photo(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # Smooth shading: a coarse random field (one value every 48 pixels) interpolated to full size
+    field = rng.normal(128, 50, (height // 48 + 2, width // 48 + 2, 3))
+    image = _resize(field, width, height)
+
+    # Sharp edged objects
+    y, x = np.mgrid[0:height, 0:width]
+    for _ in range(0, 12):
+        center_x, center_y = rng.uniform(0, width), rng.uniform(0, height)
+        radius = rng.uniform(0.03, 0.2) * min(width, height)
+        inside = (x - center_x) ** 2 + (y - center_y) ** 2 < radius ** 2
+        image[inside] = image[inside] * 0.4 + rng.uniform(0, 255, 3) * 0.6
+
+    # Film grain
+    return image + rng.normal(0, 4, image.shape)
+
+
+GENERATORS = {
+    "gradient": gradient,
+    "noise": noise,
+    "checkerboard": checkerboard,
+    "photo": photo,
+}
+
+
+def _resize(field, width, height):
+    """
+    Bilinear interpolation of a (lines, samples, channels) array, at least 2 x 2, to (height, width, channels).
+    """
+    y = np.linspace(0, len(field) - 1, height)
+    x = np.linspace(0, field.shape[1] - 1, width)
+    y0 = np.minimum(y.astype(int), len(field) - 2)
+    x0 = np.minimum(x.astype(int), field.shape[1] - 2)
+    fy = (y - y0)[:, np.newaxis, np.newaxis]
+    fx = (x - x0)[np.newaxis, :, np.newaxis]
+
+    top = field[y0][:, x0] * (1 - fx) + field[y0][:, x0 + 1] * fx
+    bottom = field[y0 + 1][:, x0] * (1 - fx) + field[y0 + 1][:, x0 + 1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def generate(pattern, width, height, seed=0):
+    """
+    Generates a synthetic RGB image. The same arguments always give the same samples.
+    :param pattern: One of PATTERNS
+    :return: uint8 array of shape (height, width, 3)
+    :raise: KeyError for unknown patterns
+    """
+    if pattern not in GENERATORS:
+        raise KeyError("Unknown pattern {0}, expected one of {1}".format(pattern, ", ".join(PATTERNS)))
+    return np.clip(np.rint(GENERATORS[pattern](width, height, seed)), 0, 255).astype(np.uint8)
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from src.cli import SETTINGS_FILE, main
+from src.util.netpbm import write_netpbm
+from src.util.synthetic import generate
+
+
+@pytest.fixture
+def directory(tmp_path):
+    write_netpbm(str(tmp_path / "a.ppm"), b"P6", generate("photo", 40, 24))
+    os.makedirs(str(tmp_path / "nested"))
+    write_netpbm(str(tmp_path / "nested" / "b.ppm"), b"P6", generate("gradient", 37, 33))
+    return tmp_path
+
+
+def get_files(directory):
+    return sorted(os.path.relpath(os.path.join(root, name), str(directory))
+                  for root, _, files in os.walk(str(directory)) for name in files if name != SETTINGS_FILE)
+
+
+def run(command, directory, *args):
+    assert main([command, str(directory), "-j", "1"] + list(args)) == 0
+
+
+@pytest.mark.parametrize("command, outputs", [
+    ("encode", ["a.jpg", "nested/b.jpg"]),
+    ("roundtrip", ["a.roundtrip.jpg", "a.roundtrip.ppm", "nested/b.roundtrip.jpg", "nested/b.roundtrip.ppm"]),
+])
+def test_rerun_ignores_outputs(directory, command, outputs, capsys):
+    run(command, directory)
+    files = get_files(directory)
+    assert files == sorted(["a.ppm", "nested/b.ppm"] + outputs)
+    run(command, directory)
+    assert get_files(directory) == files
+    assert "0 images" in capsys.readouterr().out.splitlines()[-4]
+
+
+def test_rerun_of_decode_and_transform(directory):
+    run("encode", directory)
+    run("transform", directory, "--transform", "rotate_90")
+    run("transform", directory, "--transform", "rotate_90")
+    assert get_files(directory) == ["a.jpg", "a.ppm", "a.transformed.jpg",
+                                    "nested/b.jpg", "nested/b.ppm", "nested/b.transformed.jpg"]
+    output = directory / "decoded"
+    run("decode", directory, "-o", str(output))
+    run("decode", directory, "-o", str(output))
+    assert get_files(output) == ["a.ppm", "nested/b.ppm"]
+
+
+def test_changed_settings_rerun(directory, capsys):
+    run("encode", directory, "-q", "90")
+    data = (directory / "a.jpg").read_bytes()
+    run("encode", directory, "-q", "90")
+    assert "0 images in" in capsys.readouterr().out
+    run("encode", directory, "-q", "20")
+    assert "2 images in" in capsys.readouterr().out
+    assert len((directory / "a.jpg").read_bytes()) < len(data)
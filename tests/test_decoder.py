@@ -0,0 +1,169 @@
+import io
+import re
+
+import numpy as np
+import pytest
+
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.encoder import JPEGEncoder
+from src.domain.codec.jfif import (OFFSETS_PER_SEGMENT, Component, encode_jpeg, read_restart_index,
+                                   restart_index_segments)
+from src.domain.exceptions.CorruptStreamException import CorruptStreamException
+from src.domain.models.Image import Image, PixelType
+from src.util.netpbm import write_netpbm
+from src.util.synthetic import generate
+
+# 4:2:0, one MCU row per restart interval: 5 intervals
+WIDTH, HEIGHT = 64, 80
+
+
+def encode(restart_index=False):
+    samples = generate("photo", WIDTH, HEIGHT)
+    image = Image("P6", "", WIDTH, HEIGHT, pixel_type=PixelType.RGB,
+                  planes=np.ascontiguousarray(samples.transpose(2, 0, 1)))
+    return JPEGEncoder(quality=75, stripe_rows=1, restart_index=restart_index).encode(image)
+
+
+def get_markers(data):
+    """
+    :return: Offset of every RSTn marker of the file
+    """
+    return [match.start() for match in re.finditer(rb"\xff[\xd0-\xd7]", data)]
+
+
+def drop_marker(data, number):
+    position = get_markers(data)[number]
+    return data[:position] + data[position + 2:]
+
+
+def shorten_interval(data, number):
+    """
+    Drops the last bytes of an interval, so that it reaches its marker before its last MCU
+    """
+    position = get_markers(data)[number]
+    return data[:position - 8] + data[position:]
+
+
+def decode(data, workers, recover):
+    decoder = JPEGDecoder(io.BytesIO(data), workers=workers, recover=recover)
+    return decoder.decode(), decoder.corrupt_intervals
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("restart_index", [False, True])
+def test_intact_file(workers, restart_index):
+    data = encode(restart_index)
+    reference, _ = decode(encode(), 1, False)
+    samples, corrupt_intervals = decode(data, workers, False)
+    assert np.array_equal(samples, reference)
+    assert corrupt_intervals == []
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("damage", [drop_marker, shorten_interval])
+def test_corrupt_interval_raises(workers, damage):
+    with pytest.raises(CorruptStreamException):
+        decode(damage(encode(), 1), workers, False)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("damage", [drop_marker, shorten_interval])
+def test_corrupt_interval_is_recorded(workers, damage):
+    reference, _ = decode(encode(), 1, False)
+    samples, corrupt_intervals = decode(damage(encode(), 1), workers, True)
+    assert corrupt_intervals
+    # The intervals before the damage decode as usual
+    assert np.array_equal(samples[:, :16], reference[:, :16])
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_restart_index_pointing_off_marker(workers):
+    data = encode(restart_index=True)
+    # The index of JPEGEncoder is the only APP9 segment; its last offset is moved by one byte
+    index = data.index(b"RSTIDX\x00")
+    last = index + len(b"RSTIDX\x00") + 6 + 4 * 4
+    data = data[:last + 3] + bytes(((data[last + 3] + 1) % 256,)) + data[last + 4:]
+
+    with pytest.raises(CorruptStreamException):
+        # A region in the last interval makes the serial decoder seek with the index
+        JPEGDecoder(io.BytesIO(data), workers=workers).decode_region(0, HEIGHT - 8, WIDTH, 8)
+    decoder = JPEGDecoder(io.BytesIO(data), workers=workers, recover=True)
+    decoder.decode_region(0, HEIGHT - 8, WIDTH, 8)
+    assert decoder.corrupt_intervals == [4]
+
+
+@pytest.mark.parametrize("horizontal, vertical", [(2, 2), (2, 1), (1, 2)])
+def test_single_component_sampling_factors(horizontal, vertical):
+    """
+    A single component scan is not interleaved, so the sampling factors of a gray file do not change its MCUs
+    """
+    width, height = 53, 37
+    blocks = np.random.default_rng(0).integers(-8, 8, (-(-width // 8) * -(-height // 8), 1, 64))
+    blocks[:, 0, 0] = np.random.default_rng(1).integers(-40, 40, len(blocks))
+    tables = [np.full((8, 8), 4)]
+    reference = encode_jpeg(width, height, [Component(1, 1, 1, 0, 0, 0)], tables, blocks, block_components=[0])
+    data = encode_jpeg(width, height, [Component(1, horizontal, vertical, 0, 0, 0)], tables, blocks,
+                       block_components=[0])
+    samples = JPEGDecoder(io.BytesIO(data)).decode()
+    assert samples.shape == (1, height, width)
+    assert np.array_equal(samples, JPEGDecoder(io.BytesIO(reference)).decode())
+    assert np.array_equal(JPEGDecoder(io.BytesIO(data)).decode_region(11, 5, 30, 20), samples[:, 5:25, 11:41])
+
+
+def get_scan_start(data):
+    """
+    :return: Offset of the entropy-coded data, after the SOS segment
+    """
+    position = data.index(b"\xff\xda")
+    return position + 2 + int.from_bytes(data[position + 2:position + 4], "big")
+
+
+def test_restart_index_segments():
+    offsets = list(range(0, 7 * (OFFSETS_PER_SEGMENT + 5), 7))
+    segments = restart_index_segments(3, offsets)
+    read = []
+    position = 0
+    while position < len(segments):
+        assert segments[position:position + 2] == b"\xff\xe9"
+        length = int.from_bytes(segments[position + 2:position + 4], "big")
+        restart_interval, first, chunk = read_restart_index(segments[position + 4:position + 2 + length])
+        assert restart_interval == 3 and first == len(read)
+        read += chunk
+        position += 2 + length
+    assert read == offsets
+    assert read_restart_index(b"Exif\x00\x00") is None
+
+
+def test_restart_index_offsets():
+    data = encode(restart_index=True)
+    decoder = JPEGDecoder(io.BytesIO(data))
+    assert decoder.interval_count == 5
+    scan_start = get_scan_start(data)
+    # Every interval after the first starts right after the RSTn marker ending the one before
+    assert decoder.restart_offsets == [0] + [position + 2 - scan_start for position in get_markers(data)]
+    assert JPEGDecoder(io.BytesIO(encode())).restart_offsets is None
+
+
+@pytest.mark.parametrize("subsampling", ["4:4:4", "4:2:0"])
+@pytest.mark.parametrize("stripe_rows", [1, 2])
+@pytest.mark.parametrize("restart_index", [False, True])
+def test_parallel_decode_matches_serial(subsampling, stripe_rows, restart_index):
+    width, height = 75, 99
+    samples = generate("noise", width, height)
+    image = Image("P6", "", width, height, pixel_type=PixelType.RGB,
+                  planes=np.ascontiguousarray(samples.transpose(2, 0, 1)))
+    data = JPEGEncoder(subsampling=subsampling, stripe_rows=stripe_rows, restart_index=restart_index).encode(image)
+    serial = JPEGDecoder(io.BytesIO(data)).decode()
+    for workers in (2, 3):
+        assert np.array_equal(JPEGDecoder(io.BytesIO(data), workers=workers).decode(), serial)
+    region = JPEGDecoder(io.BytesIO(data)).decode_region(13, 41, 50, 30)
+    assert np.array_equal(region, serial[:, 41:71, 13:63])
+
+
+def test_streamed_restart_index(tmp_path):
+    samples = generate("photo", WIDTH, HEIGHT)
+    source, target = str(tmp_path / "image.ppm"), str(tmp_path / "image.jpg")
+    write_netpbm(source, b"P6", samples)
+    JPEGEncoder(quality=75, stripe_rows=1, restart_index=True).encode_file(source, target, max_stripes=2)
+    with open(target, "rb") as file:
+        assert file.read() == encode(restart_index=True)
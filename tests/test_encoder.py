@@ -0,0 +1,83 @@
+import io
+
+import numpy as np
+import pytest
+
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.encoder import JPEGEncoder
+from src.domain.models.Image import Image, PixelType
+from src.util.cache import DiskCache
+from src.util.netpbm import write_netpbm
+from src.util.synthetic import generate
+
+
+def get_image(width=70, height=50, pattern="photo"):
+    samples = generate(pattern, width, height)
+    return Image("P6", "", width, height, pixel_type=PixelType.RGB,
+                 planes=np.ascontiguousarray(samples.transpose(2, 0, 1)))
+
+
+@pytest.mark.parametrize("engine", ["aan", "islow"])
+@pytest.mark.parametrize("pattern, width, height", [("photo", 200, 150), ("noise", 200, 150), ("gradient", 120, 90),
+                                                    ("checkerboard", 37, 21)])
+def test_encode_qualities_matches_encode(engine, pattern, width, height):
+    image = get_image(width, height, pattern)
+    qualities = range(1, 101)
+    files = JPEGEncoder(engine=engine).encode_qualities(image, qualities)
+    for quality, data in zip(qualities, files):
+        assert data == JPEGEncoder(engine=engine, quality=quality).encode(image), quality
+
+
+def test_encode_qualities_with_process_pool():
+    image = get_image()
+    files = JPEGEncoder(workers=2, pool="process").encode_qualities(image, [50, 90, 100])
+    assert files == [JPEGEncoder(quality=quality).encode(image) for quality in (50, 90, 100)]
+
+
+def test_cached_encode_with_process_pool(tmp_path):
+    image = get_image()
+    data = JPEGEncoder(quality=75, workers=2, pool="process", cache=DiskCache(str(tmp_path))).encode(image)
+    assert data == JPEGEncoder(quality=75).encode(image)
+    assert JPEGDecoder(io.BytesIO(data)).decode().shape == (3, 50, 70)
+
+
+@pytest.mark.parametrize("pool", ["process", "thread"])
+@pytest.mark.parametrize("subsampling", ["4:4:4", "4:2:0"])
+@pytest.mark.parametrize("stripe_rows", [1, 3])
+def test_parallel_encode_matches_serial(pool, subsampling, stripe_rows):
+    image = get_image(83, 61)
+    serial = JPEGEncoder(quality=80, subsampling=subsampling, stripe_rows=stripe_rows).encode(image)
+    for workers in (2, 3):
+        assert JPEGEncoder(quality=80, subsampling=subsampling, stripe_rows=stripe_rows, workers=workers,
+                           pool=pool).encode(image) == serial
+
+
+def test_parallel_encode_of_gray_image():
+    samples = generate("gradient", 45, 70)[..., 0]
+    image = Image("P5", "", 45, 70, pixel_type=PixelType.GRAY, planes=np.ascontiguousarray(samples[np.newaxis]))
+    serial = JPEGEncoder(stripe_rows=1).encode(image)
+    assert JPEGEncoder(stripe_rows=1, workers=2, pool="process").encode(image) == serial
+    assert JPEGDecoder(io.BytesIO(serial)).decode().shape == (1, 70, 45)
+
+
+def test_parallel_encode_file_matches_serial(tmp_path):
+    source = str(tmp_path / "image.ppm")
+    write_netpbm(source, b"P6", generate("noise", 97, 55))
+    files = []
+    for workers, pool in ((1, "process"), (2, "process"), (3, "thread")):
+        target = str(tmp_path / "image-{0}-{1}.jpg".format(workers, pool))
+        JPEGEncoder(stripe_rows=1, workers=workers, pool=pool).encode_file(source, target, max_stripes=2)
+        with open(target, "rb") as file:
+            files.append(file.read())
+    assert files[1] == files[0] and files[2] == files[0]
+
+
+def test_cached_encode_qualities_matches_encode(tmp_path):
+    image = get_image(120, 90, "gradient")
+    qualities = range(1, 101)
+    cache = DiskCache(str(tmp_path))
+    files = JPEGEncoder(cache=cache).encode_qualities(image, qualities)
+    # Read back from the cache
+    assert JPEGEncoder(cache=cache).encode_qualities(image, qualities) == files
+    for quality, data in zip(qualities, files):
+        assert data == JPEGEncoder(quality=quality).encode(image), quality
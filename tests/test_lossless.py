@@ -0,0 +1,85 @@
+import io
+
+import numpy as np
+import pytest
+
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.encoder import JPEGEncoder
+from src.domain.codec.lossless import TRANSFORMS, get_trimmed_size, transform_jpeg
+from src.domain.models.Image import Image, PixelType
+from src.util.synthetic import generate
+
+
+def encode(width, height, subsampling="4:2:0", progressive=False):
+    samples = generate("photo", width, height)
+    image = Image("P6", "", width, height, pixel_type=PixelType.RGB,
+                  planes=np.ascontiguousarray(samples.transpose(2, 0, 1)))
+    return JPEGEncoder(quality=90, subsampling=subsampling, progressive=progressive).encode(image)
+
+
+def decode(data):
+    return JPEGDecoder(io.BytesIO(data)).decode()
+
+
+def apply(samples, name):
+    """
+    :return: The transform applied to decoded samples of shape (channels, height, width)
+    """
+    transpose, flip_horizontal, flip_vertical = TRANSFORMS[name]
+    if transpose:
+        samples = samples.transpose(0, 2, 1)
+    if flip_horizontal:
+        samples = samples[:, :, ::-1]
+    if flip_vertical:
+        samples = samples[:, ::-1]
+    return samples
+
+
+@pytest.mark.parametrize("name", sorted(TRANSFORMS))
+@pytest.mark.parametrize("subsampling, progressive", [("4:4:4", False), ("4:2:0", False), ("4:2:2", True)])
+def test_transform_matches_transformed_samples(name, subsampling, progressive):
+    # Whole MCUs, so nothing is trimmed
+    data = encode(64, 48, subsampling, progressive)
+    assert np.array_equal(decode(transform_jpeg(io.BytesIO(data), name)), apply(decode(data), name))
+
+
+def test_crop():
+    data = encode(64, 48)
+    cropped = transform_jpeg(io.BytesIO(data), region=(16, 16, 37, 20))
+    assert np.array_equal(decode(cropped), decode(data)[:, 16:36, 16:53])
+    rotated = transform_jpeg(io.BytesIO(data), "rotate_90", region=(16, 16, 32, 32))
+    assert np.array_equal(decode(rotated), apply(decode(data)[:, 16:48, 16:48], "rotate_90"))
+
+
+def test_rotations_are_lossless():
+    data = encode(64, 48)
+    rotated = data
+    for _ in range(4):
+        rotated = transform_jpeg(io.BytesIO(rotated), "rotate_90")
+    coefficients = JPEGDecoder(io.BytesIO(data)).read_coefficients()
+    for plane, original in zip(JPEGDecoder(io.BytesIO(rotated)).read_coefficients(), coefficients):
+        assert np.array_equal(plane, original)
+
+
+# The transforms drop the partial MCUs (16x16 in 4:2:0) of the edges they mirror
+@pytest.mark.parametrize("name, trimmed", [("flip_horizontal", (64, 50)), ("flip_vertical", (70, 48)),
+                                           ("transpose", (70, 50)), ("rotate_90", (70, 48)),
+                                           ("rotate_180", (64, 48))])
+def test_partial_mcus_are_trimmed(name, trimmed):
+    assert get_trimmed_size(70, 50, 16, 16, name) == trimmed
+    data = encode(70, 50)
+    width, height = trimmed
+    assert np.array_equal(decode(transform_jpeg(io.BytesIO(data), name)),
+                          apply(decode(data)[:, :height, :width], name))
+
+
+def test_errors():
+    data = encode(64, 48)
+    with pytest.raises(KeyError):
+        transform_jpeg(io.BytesIO(data), "rotate_45")
+    with pytest.raises(ValueError):
+        transform_jpeg(io.BytesIO(data), region=(8, 0, 16, 16))
+    with pytest.raises(ValueError):
+        transform_jpeg(io.BytesIO(data), region=(48, 32, 32, 16))
+    with pytest.raises(ValueError):
+        get_trimmed_size(12, 40, 16, 16, "flip_horizontal")
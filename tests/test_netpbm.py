@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from src.domain.exceptions.FormatNotSupportedException import FormatNotSupportedException
+from src.util.netpbm import parse_netpbm, read_netpbm
+
+
+@pytest.mark.parametrize("data", [b"P2\n2 1\n15\n0 15\n", b"P5\n2 1\n15\n\x00\x0f", b"P6\n1 1\n65535\n" + bytes(6)])
+def test_depth_other_than_255_is_rejected(data, tmp_path):
+    with pytest.raises(FormatNotSupportedException):
+        parse_netpbm(data)
+    path = tmp_path / "image.pgm"
+    path.write_bytes(data)
+    with pytest.raises(FormatNotSupportedException):
+        read_netpbm(str(path))
+
+
+@pytest.mark.parametrize("data", [b"P2\n2 1\n255\n0 255\n", b"P5\n2 1\n255\n\x00\xff"])
+def test_depth_255(data):
+    header, samples = parse_netpbm(data)
+    assert header.depth == 255
+    assert np.array_equal(samples, [[[0], [255]]])
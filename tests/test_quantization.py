@@ -0,0 +1,64 @@
+import io
+
+import numpy as np
+import pytest
+
+from src.domain.codec.decoder import JPEGDecoder
+from src.domain.codec.encoder import JPEGEncoder
+from src.domain.codec.quantization import (Quantizer, CHROMINANCE, DEFAULT_QUANTIZATION_MATRIX, LUMINANCE,
+                                           STD_CHROMINANCE_QUANTIZATION, STD_LUMINANCE_QUANTIZATION,
+                                           get_scale_factor)
+from src.domain.models.Image import Image, PixelType
+from src.util.synthetic import generate
+
+
+@pytest.mark.parametrize("quality, factor", [(1, 5000), (10, 500), (49, 102), (50, 100), (75, 50), (100, 0),
+                                             (0, 5000), (150, 0)])
+def test_scale_factor(quality, factor):
+    assert get_scale_factor(quality) == factor
+
+
+def test_tables():
+    assert np.array_equal(Quantizer().tables[LUMINANCE], DEFAULT_QUANTIZATION_MATRIX)
+    assert np.array_equal(Quantizer(50).tables[LUMINANCE], STD_LUMINANCE_QUANTIZATION)
+    assert np.array_equal(Quantizer(50).tables[CHROMINANCE], STD_CHROMINANCE_QUANTIZATION)
+    assert np.array_equal(Quantizer(100).tables[LUMINANCE], np.ones((8, 8)))
+    # IJG: (16 * 50 + 50) // 100 and (16 * 5000 + 50) // 100 clamped to 255
+    assert Quantizer(75).tables[LUMINANCE][0, 0] == 8
+    assert Quantizer(1).tables[LUMINANCE].max() == 255
+
+
+def test_with_quality_keeps_custom_tables():
+    table = np.arange(1, 65).reshape(8, 8).tolist()
+    quantizer = Quantizer(luminance_table=table).with_quality(50)
+    assert np.array_equal(quantizer.tables[LUMINANCE], table)
+    assert np.array_equal(quantizer.tables[CHROMINANCE], STD_CHROMINANCE_QUANTIZATION)
+    assert np.array_equal(quantizer.transposed().tables[LUMINANCE], np.transpose(table))
+
+
+def test_quantize():
+    quantizer = Quantizer(50)
+    coefficients = np.array(STD_LUMINANCE_QUANTIZATION, dtype=np.float64) * 3.4
+    assert np.array_equal(quantizer.quantize(coefficients), np.full((8, 8), 3))
+    assert np.array_equal(quantizer.quantize(-coefficients), np.full((8, 8), -3))
+    assert np.array_equal(quantizer.dequantize(quantizer.quantize(coefficients)),
+                          np.array(STD_LUMINANCE_QUANTIZATION) * 3)
+
+
+def test_quantize_integers_rounds_half_away_from_zero():
+    quantizer = Quantizer(50)
+    table = np.array(STD_LUMINANCE_QUANTIZATION, dtype=np.int64)
+    # 2.5 and -2.5 of the table entry, times the scale
+    coefficients = np.stack([table * 5 * 4 // 2, -table * 5 * 4 // 2])
+    quantized = quantizer.quantize_integers(coefficients, LUMINANCE, scale=4)
+    assert np.array_equal(quantized[0], np.full((8, 8), 3)) and np.array_equal(quantized[1], np.full((8, 8), -3))
+
+
+@pytest.mark.parametrize("quality", [1, 25, 50, 90, 100])
+def test_file_tables(quality):
+    samples = generate("photo", 32, 24)
+    image = Image("P6", "", 32, 24, pixel_type=PixelType.RGB, planes=np.ascontiguousarray(samples.transpose(2, 0, 1)))
+    decoder = JPEGDecoder(io.BytesIO(JPEGEncoder(quality=quality).encode(image)))
+    tables = Quantizer(quality).tables
+    assert np.array_equal(decoder.quantization_tables[0], tables[LUMINANCE])
+    assert np.array_equal(decoder.quantization_tables[1], tables[CHROMINANCE])